@@ -4,23 +4,66 @@ import pyopencl as cl
 import pyopencl.array as cl_array
 import pyopencl.tools
 import time
+from cache import FileCache
 
 # Enables a work-around for the PyOpenCL issue #56 in versions 2013 and 2014
 FINISH_CL_ARRAYS = cl.VERSION[0] in (2013, 2014)
 
+# compiled program binaries, see Accelerator.build_program
+PROGRAM_CACHE_SIZE = 256 * 1024 * 1024
+
+def get_devices(interactive=False, n_sub_devices=None):
+    """
+    Devices of the context chosen by cl.create_some_context. If
+    n_sub_devices is given, each device is split to (at most) that many
+    sub-devices by device fission
+    """
+    devices = cl.create_some_context(interactive).devices
+    
+    if n_sub_devices is not None:
+        sub_devices = []
+        for device in devices:
+            units = max(device.max_compute_units // n_sub_devices, 1)
+            sub_devices += device.create_sub_devices( \
+                [cl.device_partition_property.EQUALLY, units])
+        devices = sub_devices
+    
+    return devices
+
 class Accelerator:
     """
     PyOpenCL initialization, as well as, management of buffers,
     kernel calls and command queues are encapsulated here
+    
+    In asynchronous mode, kernel calls and host-to-device copies do not
+    block the host. The copies are done on a separate transfer queue
+    so that they can overlap kernels that do not use the same buffers,
+    and the kernel profiling information is collected at finish()
     """
     
-    def __init__(self, interactive=False):
-        self.ctx = cl.create_some_context(interactive)
+    def __init__(self, interactive=False, asynchronous=False, device=None):
+        if device is None:
+            self.ctx = cl.create_some_context(interactive)
+        else:
+            self.ctx = cl.Context([device])
         prop = cl.command_queue_properties.PROFILING_ENABLE
         self.queue = cl.CommandQueue(self.ctx, properties=prop)
         self._cl_arrays = []
         self._scan_kernel = None
         
+        self.asynchronous = asynchronous
+        if asynchronous:
+            self.transfer_queue = cl.CommandQueue(self.ctx)
+            # (kernel name, event) pairs waiting for profiling
+            self._unresolved_events = []
+            # last kernel event using each buffer and pending writes
+            # to each buffer, used for synchronizing the two queues
+            self._last_buffer_use = {}
+            self._pending_buffer_writes = {}
+            # host copies of the uploaded data must stay alive until
+            # the copies have finished
+            self._upload_host_buffers = []
+        
         devices = self.ctx.get_info(cl.context_info.DEVICES)
         assert(len(devices) == 1)
         self.device = devices[0]
@@ -35,18 +78,46 @@ class Accelerator:
     
     def finish(self):
         """Call finish on relevant CL queues and arrays"""
+        if self.asynchronous:
+            # the copies may wait for kernels and vice versa
+            self.queue.flush()
+            self.transfer_queue.finish()
         self.queue.finish()
         if FINISH_CL_ARRAYS:
             for a in self._cl_arrays:
                 a.finish()
+        
+        if self.asynchronous:
+            self._resolve_profiling_events()
+            self._last_buffer_use = {}
+            self._pending_buffer_writes = {}
+            self._upload_host_buffers = []
     
     def build_program(self, prog_code, options=[]):
         prog_code = prog_code.encode('ascii')
         
         with open('last_code.cl', 'w') as f:
             f.write(prog_code)
-            
+        
+        # the binaries are specific to the device and the driver
+        device = self.device
+        cache = FileCache('programs', PROGRAM_CACHE_SIZE)
+        key = cache.key(prog_code, options, device.name, device.version, \
+            device.driver_version, device.platform.name, cl.VERSION_TEXT)
+        
+        binary = cache.get(key)
+        if binary is not None:
+            try:
+                self.prog = cl.Program(self.ctx, [device], [binary]) \
+                    .build(options)
+                print 'loaded a cached program binary'
+                return
+            except cl.Error as e:
+                print 'invalid cached program binary:', e
+        
         self.prog = cl.Program(self.ctx, prog_code).build(options)
+        
+        cache.put(key, self.prog.get_info(cl.program_info.BINARIES)[0])
     
     def get_max_work_group_size(self, kernel_name):
         return self._get_kernel_work_group_info(kernel_name, \
@@ -77,19 +148,63 @@ class Accelerator:
                 x = x.data
             arg.append(x)
         arg = tuple(arg) + value_args
-        event = kernel(self.queue, ndrange_size, work_group_size, *arg)
-        event.wait()
         
-        t = (event.profile.end - event.profile.start)
+        if self.asynchronous:
+            buffers = [x for x in arg if isinstance(x, cl.Buffer)]
+            wait_for = [self._pending_buffer_writes.pop(b) \
+                for b in buffers if b in self._pending_buffer_writes]
+            
+            event = kernel(self.queue, ndrange_size, work_group_size, *arg, \
+                wait_for=wait_for)
+            
+            for b in buffers:
+                self._last_buffer_use[b] = event
+            self._unresolved_events.append((kernel_name, event))
+            
+            self._add_profiling_info(kernel_name, None, time.time() - t1)
+        else:
+            event = kernel(self.queue, ndrange_size, work_group_size, *arg)
+            event.wait()
+            self._add_profiling_info(kernel_name, event, time.time() - t1)
+    
+    def _add_profiling_info(self, kernel_name, event, host_time):
         if kernel_name not in self.profiling_info:
             self.profiling_info[kernel_name] = {'n':0, 't':0, 'ta':0}
-            
-        self.profiling_info[kernel_name]['t'] += t
-        self.profiling_info[kernel_name]['n'] += 1
-        self.profiling_info[kernel_name]['ta'] += time.time() - t1
+        
+        info = self.profiling_info[kernel_name]
+        if event is not None:
+            info['t'] += event.profile.end - event.profile.start
+        if host_time is not None:
+            info['n'] += 1
+            info['ta'] += host_time
+    
+    def _resolve_profiling_events(self):
+        for kernel_name, event in self._unresolved_events:
+            event.wait()
+            self._add_profiling_info(kernel_name, event, None)
+        self._unresolved_events = []
     
-    def enqueue_copy( self, dest, src ):
-        cl.enqueue_copy(self.queue, dest, src)
+    def enqueue_copy( self, dest, src, device_offset=0 ):
+        if self.asynchronous and isinstance(src, np.ndarray):
+            # the caller may modify src right after this call
+            src = np.array(src)
+            self._upload_host_buffers.append(src)
+            
+            # do not overwrite data still used by queued kernels
+            wait_for = [self._last_buffer_use[dest]] \
+                if dest in self._last_buffer_use else None
+            
+            # an event of another queue can only be waited for after
+            # its queue has been flushed
+            if wait_for is not None:
+                self.queue.flush()
+            
+            self._pending_buffer_writes[dest] = cl.enqueue_copy( \
+                self.transfer_queue, dest, src, device_offset=device_offset, \
+                is_blocking=False, wait_for=wait_for)
+            self.transfer_queue.flush()
+        else:
+            cl.enqueue_copy(self.queue, dest, src, device_offset=device_offset)
     
     def to_device( self, cpuarray ):
         arr = cl_array.to_device(self.queue, cpuarray)
@@ -153,6 +268,9 @@ class Accelerator:
         return arr
     
     def output_profiling_info(self):
+        if self.asynchronous:
+            self._resolve_profiling_events()
+        
         total = 0
         tatotal = 0
         for (k, v) in self.profiling_info.items():
@@ -193,7 +311,7 @@ class Accelerator:
         def free(self):
             self.buffer_idx = 0
 
-    def find_non_negative(self, in_array, out_array, n):
+    def _init_scan_kernel(self):
         
         from pyopencl.scan import GenericScanKernel
         
@@ -212,6 +330,10 @@ class Accelerator:
             self._mem_pool = Accelerator.MemPool(self.ctx)
             
             self._out_int = self.new_array( (1,), np.int32 )
+
+    def find_non_negative(self, in_array, out_array, n):
+        
+        self._init_scan_kernel()
         
         ev = self._scan_kernel(in_array, out_array, self._out_int, \
             size=n, queue=self.queue, allocator=self._mem_pool)
@@ -221,9 +343,43 @@ class Accelerator:
         
         return int(self._out_int.get()[0])
     
+    def compact_non_negative(self, in_array, out_array, n):
+        """
+        Like find_non_negative, but does not wait for the result or read
+        the count back to the host. The rest of the first n elements of
+        out_array are set to -1
+        """
+        
+        self._init_scan_kernel()
+        
+        out_array[:n].view(np.int32).fill(-1)
+        self._scan_kernel(in_array, out_array, self._out_int, \
+            size=n, queue=self.queue, allocator=self._mem_pool)
+        
+        # the temporary buffers are only reused by later commands
+        # in the same in-order queue
+        self._mem_pool.free()
+    
+    def start_read(self, array):
+        """
+        Non-blocking device-to-host copy of a CL array. Returns the
+        host array and an event, see is_complete
+        """
+        host_array = np.empty(array.shape, dtype=array.dtype)
+        event = cl.enqueue_copy(self.queue, host_array, array.data, \
+            is_blocking=False)
+        self.queue.flush()
+        return host_array, event
+    
+    @staticmethod
+    def is_complete(event):
+        return event.command_execution_status == \
+            cl.command_execution_status.COMPLETE
+    
     def device_memcpy(self, dest, src, n=None):
         kwargs = {}
         if n is not None:
             kwargs['byte_count'] = n * 4 # assuming 32-bit values
         ev = cl.enqueue_copy(self.queue, dest.data, src.data, **kwargs)
-        ev.wait()
+        if not self.asynchronous:
+            ev.wait()
@@ -0,0 +1,97 @@
+import numpy as np
+
+class ObjectBVH:
+    """
+    Bounding volume hierarchy over the objects of a scene, built from their
+    global axis-aligned bounding boxes. Objects without a bounding box
+    (e.g., half-spaces) are kept in a separate list that is always tested.
+    
+    The tree is split at the median of the object centers along the longest
+    axis, so its shape only depends on the number of bounded objects.
+    The serialized nodes are stored as:
+    
+        * bounds: (2*n_nodes, 3) array, rows 2*i and 2*i+1 are the minimum
+          and maximum corners of node i
+        * nodes: (n_nodes, 2) array, for a leaf (first, count) points to
+          the object list, for an inner node (first_child, 0). The second
+          child is always first_child+1
+        * objects: object ids (1-based) of the leaves
+    """
+    
+    def __init__(self, boxes, max_leaf_size=2):
+        """boxes: list of (min, max) pairs or None, indexed by object_id-1"""
+        
+        self.max_leaf_size = max_leaf_size
+        self.unbounded_objects = [i+1 for i in range(len(boxes)) \
+            if boxes[i] is None]
+        
+        bounded = [i for i in range(len(boxes)) if boxes[i] is not None]
+        self.n_bounded_objects = len(bounded)
+        
+        self.bounds = []
+        self.nodes = []
+        self.objects = []
+        self.depth = 0
+        
+        if len(bounded) > 0:
+            self._new_node()
+            self._build(0, np.array(bounded), boxes, 0)
+        
+        self.bounds = np.array(self.bounds, dtype=np.float32).reshape((-1, 3))
+        self.nodes = np.array(self.nodes, dtype=np.int32).reshape((-1, 2))
+    
+    def _new_node(self):
+        self.bounds += [None, None]
+        self.nodes.append(None)
+        return len(self.nodes) - 1
+    
+    def _build(self, node_idx, ids, boxes, depth):
+        box_min = np.array([boxes[i][0] for i in ids], dtype=float)
+        box_max = np.array([boxes[i][1] for i in ids], dtype=float)
+        
+        self.bounds[2*node_idx] = np.min(box_min, 0)
+        self.bounds[2*node_idx+1] = np.max(box_max, 0)
+        self.depth = max(self.depth, depth)
+        
+        if len(ids) <= self.max_leaf_size:
+            self.nodes[node_idx] = [len(self.objects), len(ids)]
+            self.objects += [i+1 for i in ids]
+            return
+        
+        centers = (box_min + box_max) * 0.5
+        axis = np.argmax(np.max(centers, 0) - np.min(centers, 0))
+        ids = ids[np.argsort(centers[:, axis], kind='mergesort')]
+        half = len(ids) // 2
+        
+        first_child = self._new_node()
+        self._new_node()
+        self.nodes[node_idx] = [first_child, 0]
+        
+        self._build(first_child, ids[:half], boxes, depth+1)
+        self._build(first_child+1, ids[half:], boxes, depth+1)
+    
+    @property
+    def n_nodes(self):
+        return self.nodes.shape[0]
+    
+    @property
+    def stack_size(self):
+        # both children of each node on the current path may be pushed
+        return self.depth + 2
+    
+    @property
+    def objects_offset(self):
+        return self.nodes.size
+    
+    @property
+    def unbounded_objects_offset(self):
+        return self.objects_offset + len(self.objects)
+    
+    def get_integer_data(self):
+        """nodes, leaf objects and unbounded objects as a flat array"""
+        return np.concatenate([
+            np.ravel(self.nodes),
+            self.objects,
+            self.unbounded_objects,
+            [0] # avoid empty buffers
+        ]).astype(np.int32)
@@ -0,0 +1,148 @@
+"""
+Persistent on-disk caches of byte strings, e.g., compiled OpenCL programs
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+import io
+import numpy as np
+
+def cache_root():
+    """
+    Directory of all caches: $CLRAY_CACHE_DIR or ~/.cache/clray.
+    Setting CLRAY_CACHE_DIR to an empty string disables the caches
+    """
+    root = os.environ.get('CLRAY_CACHE_DIR')
+    if root is None:
+        root = os.path.join(os.path.expanduser('~'), '.cache', 'clray')
+    return root
+
+class FileCache:
+    """
+    A cache of byte strings stored as files in a directory. Entries are
+    written to temporary files that are then renamed, so the cache can be
+    shared by several processes that never see partially written entries.
+    When the total size exceeds max_size bytes, the least recently used
+    entries (by file modification time) are removed.
+    """
+    
+    # temporary files older than this (seconds) were left by writers
+    # that failed before renaming them
+    TMP_FILE_MAX_AGE = 3600
+    
+    def __init__(self, name, max_size):
+        root = cache_root()
+        if root == '':
+            self.directory = None
+        else:
+            self.directory = os.path.join(root, name)
+        self.max_size = max_size
+    
+    @staticmethod
+    def key(*parts):
+        """Cache key of the given strings"""
+        h = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = str(part).encode('utf-8')
+            # separate the parts unambiguously
+            h.update(str(len(part)).encode('ascii') + b':' + part)
+        return h.hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+    
+    def get(self, key):
+        """The cached bytes or None"""
+        if self.directory is None: return None
+        
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            # mark as recently used
+            os.utime(self._path(key), None)
+            return data
+        except (IOError, OSError):
+            return None
+    
+    def put(self, key, data):
+        if self.directory is None: return
+        
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._path(key))
+            
+            self._evict()
+        except (IOError, OSError) as e:
+            # the cache is only an optimization
+            print 'could not write to cache %s: %s' % (self.directory, e)
+    
+    def _evict(self):
+        entries = []
+        # the temporary files of concurrent writers count but are kept
+        tmp_size = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith('.tmp'):
+                    if time.time() - stat.st_mtime > self.TMP_FILE_MAX_AGE:
+                        os.remove(path)
+                    else:
+                        tmp_size += stat.st_size
+                    continue
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        
+        total_size = tmp_size + sum([size for _, size, __ in entries])
+        
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size: break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total_size -= size
+
+def array_hash(*arrays):
+    """Hash of the contents, shapes and types of numpy arrays"""
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str, a.shape)).encode('ascii'))
+        h.update(a)
+    return h.hexdigest()
+
+def cached_arrays(cache, key, compute):
+    """
+    Dictionary of numpy arrays stored in the FileCache cache as an .npz.
+    If there is no entry for the key, compute() is called to create it
+    """
+    
+    data = cache.get(key)
+    if data is not None:
+        try:
+            npz = np.load(io.BytesIO(data))
+            arrays = dict([(name, npz[name]) for name in npz.files])
+            print 'loaded cached arrays from %s' % cache.directory
+            return arrays
+        except (IOError, ValueError) as e:
+            print 'invalid cache entry:', e
+    
+    arrays = compute()
+    
+    if cache.directory is not None:
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        cache.put(key, buf.getvalue())
+    
+    return arrays
@@ -0,0 +1,66 @@
+"""
+Render checkpoints: the accumulated image sum together with the number of
+samples, the random number generator state and a hash of the scene and
+the OpenCL program, so that an interrupted render can be resumed
+(see clray.py --resume)
+"""
+
+import numpy as np
+import hashlib
+import os
+
+def scene_hash(program_code, arrays):
+    """Hash of the program code and the scene data arrays"""
+    h = hashlib.sha1(program_code)
+    for a in arrays:
+        h.update(np.ascontiguousarray(a, dtype=np.float64))
+    return h.hexdigest()
+
+class Checkpoint:
+
+    def __init__(self, image, n_samples, rng_seed, scene_hash, np_rng_state=None):
+        self.image = image
+        self.n_samples = n_samples
+        self.rng_seed = rng_seed
+        self.scene_hash = scene_hash
+        if np_rng_state is None:
+            np_rng_state = np.random.get_state()
+        self.np_rng_state = np_rng_state
+    
+    def save(self, filename):
+        """
+        Write atomically: the previous checkpoint is replaced only
+        after the new one has been completely written
+        """
+        
+        algorithm, keys, pos, has_gauss, cached_gaussian = self.np_rng_state
+        
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f,
+                image = self.image,
+                n_samples = self.n_samples,
+                rng_seed = self.rng_seed,
+                scene_hash = self.scene_hash,
+                np_rng_algorithm = algorithm,
+                np_rng_keys = keys,
+                np_rng_params = np.array([pos, has_gauss]),
+                np_rng_cached_gaussian = cached_gaussian)
+            f.flush()
+            os.fsync(f.fileno())
+        
+        os.rename(tmp_filename, filename)
+    
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        pos, has_gauss = data['np_rng_params']
+        np_rng_state = (str(data['np_rng_algorithm']), data['np_rng_keys'],
+            int(pos), int(has_gauss), float(data['np_rng_cached_gaussian']))
+        
+        return Checkpoint(data['image'], int(data['n_samples']),
+            int(data['rng_seed']), str(data['scene_hash']), np_rng_state)
+    
+    def restore_rng_state(self, renderer):
+        np.random.set_state(self.np_rng_state)
+        renderer.set_rng_seed(self.rng_seed)
@@ -3,6 +3,20 @@ from accelerator import Accelerator
 import numpy as np
 import jinja2
 
+_template_env = None
+
+def template_env():
+    """
+    The Jinja2 environment shared by all Compilers, which keeps the
+    compiled templates
+    """
+    global _template_env
+    if _template_env is None:
+        _template_env = jinja2.Environment(\
+            loader=jinja2.PackageLoader('clray', 'cl_templates'),
+            line_statement_prefix='###')
+    return _template_env
+
 class Compiler:
     """
     The part of the Renderer that generates OpenCL code using Jinja2 templates.
@@ -16,15 +30,12 @@ class Compiler:
     
     def make_program(self):
         scene = self.scene
-        
-        template_env = jinja2.Environment(\
-            loader=jinja2.PackageLoader('clray', 'cl_templates'),
-            line_statement_prefix='###')
+        env = template_env()
     
-        kernels, functions = collect_tracer_kernels(scene.objects, template_env)
+        kernels, functions = collect_tracer_kernels(scene.objects, env)
         function_declarations = [body[:body.find('{')] + ';' for body in functions]
 
-        return template_env.get_template('main.cl').render({
+        return env.get_template('main.cl').render({
             'shader': self.shader,
             'renderer': self.renderer,
             'objects': scene.objects,
@@ -49,8 +60,17 @@ def collect_tracer_kernels(objects, template_env):
     functions = set([])
     kernels = set([])
     
+    # the code of a tracer is determined by its class, template and id,
+    # which also determine the function names
+    generated = set([])
+    
     for obj in objects:
         
+        tracer = obj.tracer
+        key = (tracer.__class__, tracer.template_name(), tracer.unique_tracer_id)
+        if key in generated: continue
+        generated.add(key)
+        
         for (name, body) in obj.tracer.make_functions(template_env).items():
             push_func(name,body)
             functions.add(body)
@@ -59,5 +79,6 @@ def collect_tracer_kernels(objects, template_env):
             push_func(name,body)
             kernels.add(body)
     
-    return (list(kernels),list(functions))
+    # sorted so that the same scene always gives the same program code
+    return (sorted(kernels),sorted(functions))
     
@@ -1,9 +1,17 @@
 
+// address spaces of the mesh data and the object parameters,
+// chosen by the renderer based on their sizes and the device limits
+#define TRACER_DATA {{ renderer.tracer_data_memory }}
+#define PARAM_DATA {{ renderer.param_data_memory }}
+
 {% include 'static.cl' %}
 
 {% include 'shader.cl' %}
 
-#define TRACER_DATA __constant
+### if renderer.scene.bin_rays
+// the normal kernels get their rays from the binned ray list
+#define BIN_RAYS
+### endif
 
 // Declarations
 ### for k in functions.declarations
@@ -28,3 +36,7 @@
 ### for k in functions.kernels
 {{ k }}
 ### endfor
+
+### if renderer.scene_bvh
+{% include 'scene_bvh.cl' %}
+### endif
@@ -0,0 +1,86 @@
+### extends 'tracer.cl'
+
+### import 'objects/TriangleMesh.cl' as tri_mesh
+
+{#/*
+    Sets box_dist to the distance to the entry point of the ray and the
+    axis-aligned box (minimum and maximum corners), or a negative value
+    if the ray misses the box before isec_dist
+*/#}
+### macro ray_box_distance(box)
+    {
+        const float3 t1 = ({{box}}[0].xyz - origin) * inv_ray;
+        const float3 t2 = ({{box}}[1].xyz - origin) * inv_ray;
+        const float3 t_near = fmin(t1, t2), t_far = fmax(t1, t2);
+        
+        const float t_begin = max(max(t_near.x, t_near.y), max(t_near.z, 0.0f));
+        const float t_end = min(min(t_far.x, t_far.y), min(t_far.z, isec_dist));
+        
+        box_dist = t_begin > t_end ? -1.0f : t_begin;
+    }
+### endmacro
+
+### macro tracer_function(obj)
+    ### call tracer_function_base(obj)
+    
+        TRACER_DATA const float4 *node_bounds = vector_data + node_bounds_offset;
+        TRACER_DATA const int *face_list = integer_data + face_list_offset;
+        TRACER_DATA const int *node_data = integer_data + node_data_offset;
+        
+        uint old_subobject = *p_subobject, subobject;
+        float isec_dist = old_isec_dist;
+        
+        const float3 inv_ray = 1.0f / ray;
+        
+        // both children of each node on the current path may be pushed
+        int stack[{{ obj.__class__.MAX_DEPTH + 2 }}];
+        int stack_size = 0;
+        
+        float box_dist;
+        if (n_nodes > 0) {
+            {{ ray_box_distance('node_bounds') }}
+            if (box_dist >= 0.0f) stack[stack_size++] = 0;
+        }
+        
+        while (stack_size > 0) {
+            const int node = stack[--stack_size];
+            const int first = node_data[2*node];
+            const int count = node_data[2*node+1];
+            
+            if (count > 0) {
+                // leaf
+                const int n_triangles = count;
+                
+                ### call(j) tri_mesh.tracer_function_core()
+                    face_list[first + {{ j }}]
+                ### endcall
+            }
+            else {
+                // push the children that are hit, the nearest one last
+                float d1, d2;
+                {{ ray_box_distance('(node_bounds + 2*first)') }}
+                d1 = box_dist;
+                {{ ray_box_distance('(node_bounds + 2*(first+1))') }}
+                d2 = box_dist;
+                int c1 = first, c2 = first+1;
+                
+                if (d1 >= 0.0f && d2 >= 0.0f && d1 < d2) {
+                    float tmp_d = d1; d1 = d2; d2 = tmp_d;
+                    c1 = first+1; c2 = first;
+                }
+                
+                if (d1 >= 0.0f) stack[stack_size++] = c1;
+                if (d2 >= 0.0f) stack[stack_size++] = c2;
+            }
+        }
+        
+        if (isec_dist < old_isec_dist) {
+            *p_new_isec_dist = isec_dist;
+            *p_subobject = subobject;
+        }
+    ### endcall
+### endmacro
+
+### macro normal_function(obj)
+    {{ tri_mesh.normal_function(obj) }}
+### endmacro
@@ -0,0 +1,100 @@
+### import 'tracer.cl' as tracer_macros
+
+### set bvh = renderer.scene_bvh
+
+#define SCENE_BVH_N_NODES {{ bvh.n_nodes }}
+#define SCENE_BVH_OBJECTS_OFFSET {{ bvh.objects_offset }}
+#define SCENE_BVH_UNBOUNDED_OFFSET {{ bvh.unbounded_objects_offset }}
+#define SCENE_BVH_N_UNBOUNDED {{ bvh.unbounded_objects|length }}
+#define SCENE_BVH_STACK_SIZE {{ bvh.stack_size }}
+
+// Distance to the entry point of a ray and an axis-aligned box,
+// or a negative value if the ray misses the box
+float ray_box_distance(
+        PARAM_DATA const float4 *p_box,
+        const float3 origin,
+        const float3 inv_ray,
+        const float max_dist)
+{
+    const float3 t1 = (p_box[0].xyz - origin) * inv_ray;
+    const float3 t2 = (p_box[1].xyz - origin) * inv_ray;
+    const float3 t_near = fmin(t1, t2), t_far = fmax(t1, t2);
+    
+    const float t_begin = max(max(t_near.x, t_near.y), max(t_near.z, 0.0f));
+    const float t_end = min(min(t_far.x, t_far.y), min(t_far.z, max_dist));
+    
+    if (t_begin > t_end) return -1.0f;
+    return t_begin;
+}
+
+{#/*
+    Calls the tracer function of the object object_id. The objects are
+    sorted by tracer so that each group is a contiguous range of ids.
+*/#}
+### macro trace_any_object()
+    ### for tracer, count, offset in renderer.object_groups
+    {% if not loop.first %}else {% endif %}if (object_id <= {{ offset + count }})
+        {{ tracer_macros.trace_object(tracer) }}
+    ### endfor
+### endmacro
+
+__kernel void scene_bvh_tracer_kernel(
+    {{ tracer_macros.tracer_kernel_arguments() }},
+    PARAM_DATA const float4 *bvh_bounds,
+    PARAM_DATA const int *bvh_data)
+{
+    const int thread_idx = get_global_id(0);
+    const int ray_idx = pixel[thread_idx];
+    if (ray_idx < 0) return;
+    
+    {{ tracer_macros.load_ray_state() }}
+    
+    const float3 inv_ray = 1.0f / ray;
+    int i;
+    
+    // objects without bounding boxes are always tested
+    for (i = 0; i < SCENE_BVH_N_UNBOUNDED; i++) {
+        const int object_id = bvh_data[SCENE_BVH_UNBOUNDED_OFFSET + i];
+        {{ trace_any_object() }}
+    }
+    
+    ### if bvh.n_nodes > 0
+    
+    int stack[SCENE_BVH_STACK_SIZE];
+    int stack_size = 0;
+    
+    if (ray_box_distance(bvh_bounds, pos, inv_ray, isec_dist) >= 0.0f)
+        stack[stack_size++] = 0;
+    
+    while (stack_size > 0) {
+        const int node = stack[--stack_size];
+        const int first = bvh_data[2*node];
+        const int count = bvh_data[2*node+1];
+        
+        if (count > 0) {
+            // leaf
+            for (i = 0; i < count; i++) {
+                const int object_id = bvh_data[SCENE_BVH_OBJECTS_OFFSET + first + i];
+                {{ trace_any_object() }}
+            }
+        }
+        else {
+            // push the children that are hit, the nearest one last
+            float d1 = ray_box_distance(bvh_bounds + 2*first, pos, inv_ray, isec_dist);
+            float d2 = ray_box_distance(bvh_bounds + 2*(first+1), pos, inv_ray, isec_dist);
+            int c1 = first, c2 = first+1;
+            
+            if (d1 >= 0.0f && d2 >= 0.0f && d1 < d2) {
+                float tmp_d = d1; d1 = d2; d2 = tmp_d;
+                c1 = first+1; c2 = first;
+            }
+            
+            if (d1 >= 0.0f) stack[stack_size++] = c1;
+            if (d2 >= 0.0f) stack[stack_size++] = c2;
+        }
+    }
+    
+    ### endif
+    
+    {{ tracer_macros.store_closest_hit() }}
+}
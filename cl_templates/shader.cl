@@ -10,6 +10,8 @@
 ### else
     #define COLOR(prop, id) material_scalars[prop + id]
     #define WHITE 1.0f
+    #define N_WAVELENGTHS {{ shader.n_wavelengths }}
+    #define N_MATERIAL_SCALARS {{ shader.n_material_scalars }}
     #define COLOR2PROB(color) color
 ### endif
 
@@ -50,6 +52,10 @@ __kernel void shader_{{name}}(
         // 0 if in ambient space. (notice however, that the ambient
         // space also has fog and IoR material properties)
         global uint *inside,
+### if not shader.rgb
+        // index of the wavelength of the ray, see init_wavelengths
+        global const int *wavelength,
+### endif
 ### if renderer.bidirectional
         // visibility mask for light point
         global float *shadow_mask,
@@ -62,22 +68,35 @@ __kernel void shader_{{name}}(
         // material properties of the current object
 ### if shader.rgb
         constant float4 *material_colors,
-### endif
         constant float *material_scalars,
+### else
+        // material properties and color responses at each wavelength
+        global const float *material_scalars,
+        constant float4 *wavelength_colors,
+### endif
         // a random unit vector and a random gaussian vector
-        constant float4 *rvecs_cmask_and_light)
+        constant float4 *rvecs_cmask_and_light
+### if renderer.scene.device_rng
+        // inputs of the counter-based random number generator
+        , uint rng_seed, uint sample_index, uint path_index
+### endif
+        )
 {
     const int thread_idx = get_global_id(0);
     pixel += thread_idx;
     
     const int ray_idx = *pixel;
-    //if (ray_idx < 0) return;
+    if (ray_idx < 0) return;
     
     p_p += thread_idx;
     pipeline_color += thread_idx;
     
     // the random sample [0,1) that decides what to do
+### if renderer.scene.device_rng and name == 'volumetric'
+    float p = random_uniform4(rng_seed, ray_idx, sample_index, path_index, RNG_STREAM_PATH).x;
+### else
     float p = *p_p;
+### endif
     if (p < 0.0f) return;
         
     ray += ray_idx;
@@ -94,11 +113,22 @@ __kernel void shader_{{name}}(
     suppress_emission += ray_idx;
     shadow_mask += thread_idx;
 ### endif
+### if not shader.rgb
+    // the material properties at the wavelength of the ray
+    material_scalars += wavelength[ray_idx] * N_MATERIAL_SCALARS;
+### endif
     
     float3 r = *ray;
     float3 n = *normal;
+### if renderer.scene.device_rng
+    const float3 rvec = random_unit_vector(
+        random_uniform4(rng_seed, ray_idx, sample_index, path_index, RNG_STREAM_PATH).yz);
+    float3 gauss_rvec = random_gaussian_vector(
+        random_uniform4(rng_seed, ray_idx, sample_index, path_index, RNG_STREAM_GAUSSIAN));
+### else
     const float3 rvec = rvecs_cmask_and_light[0].xyz;
     float3 gauss_rvec = rvecs_cmask_and_light[1].xyz;
+### endif
     
     float cur_prob = 0.0f;
     {{ shader.color_cl_type }} cur_col;
@@ -106,7 +136,7 @@ __kernel void shader_{{name}}(
 ### if shader.rgb
     const float cmask = 1.0f;
 ### else
-    const float3 cmask = rvecs_cmask_and_light[2].xyz;
+    const float3 cmask = wavelength_colors[wavelength[ray_idx]].xyz;
 ### endif
     
     {{ caller() }}
@@ -352,6 +382,44 @@ __kernel void shader_{{name}}(
 
 ### endcall
 
+### if not shader.rgb
+__kernel void init_wavelengths(
+        // output: index of the wavelength of each ray
+        global int *wavelength,
+        // divided by the probability of the wavelength
+        global float *ray_color,
+        // cumulative distribution and probabilities of the wavelengths
+        constant float *wavelength_cdf,
+        constant float *wavelength_pdf,
+### if renderer.scene.device_rng
+        uint rng_seed, uint sample_index)
+### else
+        // the same wavelength for all rays
+        float wavelength_sample)
+### endif
+{
+    const int ray_idx = get_global_id(0);
+    
+### if renderer.scene.device_rng
+    const float u = random_uniform4(rng_seed, ray_idx, sample_index, 0, RNG_STREAM_WAVELENGTH).x;
+### else
+    const float u = wavelength_sample;
+### endif
+    
+    // inverse CDF: the first wavelength whose cumulative probability
+    // exceeds u (never one with a zero probability)
+    int begin = 0, end = N_WAVELENGTHS-1;
+    while (begin < end) {
+        const int mid = (begin + end) / 2;
+        if (wavelength_cdf[mid] > u) end = mid;
+        else begin = mid + 1;
+    }
+    
+    wavelength[ray_idx] = begin;
+    ray_color[ray_idx] /= wavelength_pdf[begin];
+}
+### endif
+
 __kernel void init_shadow_mask(
     global const int *pixel,
     global float *shadow_mask,
@@ -360,7 +428,7 @@ __kernel void init_shadow_mask(
     const int thread_idx = get_global_id(0);
     const int ray_idx = pixel[thread_idx];
     
-    if (diffusions_left[ray_idx] < 1) {
+    if (ray_idx < 0 || diffusions_left[ray_idx] < 1) {
         shadow_mask[thread_idx] = 0.0f;
     }
     else {
@@ -374,20 +442,35 @@ __kernel void culler(
         // current ray color: a filter that multiplies everything
         // added to the image
         global {{ shader.color_cl_type }} *ray_color,
+        // output: number of rays that are still active
+        global int *n_active,
+### if renderer.scene.device_rng
+        // inputs of the counter-based random number generator
+        uint rng_seed, uint sample_index, uint path_index)
+### else
         // probability sample for Russian roulette
         float russian_roulette_sample)
+### endif
 {
     const int thread_idx = get_global_id(0);
     pixel += thread_idx;
     
+    // rays culled earlier (negative ray index) still take part in the
+    // work group barriers below
     const int ray_idx = *pixel;
+    const bool active = ray_idx >= 0;
     ray_color += ray_idx;
     
     const int local_idx = get_local_id(0);
     
-    const float cur_intensity = COLOR2PROB(*ray_color);
+    const float cur_intensity = active ? COLOR2PROB(*ray_color) : 0.0f;
     
     local float scratch[{{renderer.warp_size}}];
+    local int group_active;
+    
+    if (local_idx == 0) group_active = 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (active) atomic_inc(&group_active);
     
     float max_value;
     scratch[local_idx] = cur_intensity;
@@ -410,6 +493,12 @@ __kernel void culler(
     ### if renderer.scene.min_russian_prob
         local float russian_prob;
         
+        ### if renderer.scene.device_rng
+        // one sample per work group
+        const float russian_roulette_sample = random_uniform4(rng_seed,
+            get_group_id(0), sample_index, path_index, RNG_STREAM_RUSSIAN_ROULETTE).x;
+        ### endif
+        
         if (local_idx == 0) {
             if (max_value > 0.0f) {
                 russian_prob = clamp(max_value, (float){{renderer.scene.min_russian_prob}}, 1.0f);
@@ -426,9 +515,13 @@ __kernel void culler(
     if (max_value == 0.0f) {
         *pixel = -1;
     }
+    else {
+        if (local_idx == 0) atomic_add(n_active, group_active);
+        
     ### if renderer.scene.min_russian_prob
-        else if (russian_prob < 1.0f) {
+        if (active && russian_prob < 1.0f) {
             *ray_color /= russian_prob;
         }
     ### endif
+    }
 }
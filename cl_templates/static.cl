@@ -63,21 +63,21 @@ ia_type ia_pow4(ia_type a)
 // TODO: write more of these dynamically
 
 
-float3 apply_linear_transform(constant const float4 *p_matrix, float3 vector) {
+float3 apply_linear_transform(PARAM_DATA const float4 *p_matrix, float3 vector) {
     return (float3)(
         dot(p_matrix[0].xyz, vector),
         dot(p_matrix[1].xyz, vector),
         dot(p_matrix[2].xyz, vector));
 }
 
-float3 apply_transposed_linear_transform(constant const float4 *p_matrix, float3 vector) {
+float3 apply_transposed_linear_transform(PARAM_DATA const float4 *p_matrix, float3 vector) {
     return (float3)(
         dot((float3)(p_matrix[0].x, p_matrix[1].x, p_matrix[2].x), vector),
         dot((float3)(p_matrix[0].y, p_matrix[1].y, p_matrix[2].y), vector),
         dot((float3)(p_matrix[0].z, p_matrix[1].z, p_matrix[2].z), vector));
 }
 
-float3 apply_affine_transform(constant const float4 *p_mat_and_vec, float3 vector) {
+float3 apply_affine_transform(PARAM_DATA const float4 *p_mat_and_vec, float3 vector) {
     return apply_linear_transform(p_mat_and_vec, vector) + p_mat_and_vec[3].xyz;
 }
 
@@ -100,12 +100,226 @@ float4 quaternion_square( float4 q )
    return r;
 }
 
+// Counter-based random numbers: Philox4x32-10 from Salmon et al., "Parallel
+// random numbers: as easy as 1, 2, 3" (2011). The random numbers are a pure
+// function of the ray index, sample index, path segment and stream, so there
+// is no generator state to store or upload
+
+#define RNG_STREAM_CAMERA 0
+#define RNG_STREAM_PATH 1
+#define RNG_STREAM_GAUSSIAN 2
+#define RNG_STREAM_RUSSIAN_ROULETTE 3
+#define RNG_STREAM_WAVELENGTH 4
+
+uint4 philox4x32_10(uint4 ctr, uint2 key)
+{
+    for (int round = 0; round < 10; round++) {
+        const uint hi0 = mul_hi(0xD2511F53u, ctr.x);
+        const uint lo0 = 0xD2511F53u * ctr.x;
+        const uint hi1 = mul_hi(0xCD9E8D57u, ctr.z);
+        const uint lo1 = 0xCD9E8D57u * ctr.z;
+        ctr = (uint4)(hi1 ^ ctr.y ^ key.x, lo1, hi0 ^ ctr.w ^ key.y, lo0);
+        key += (uint2)(0x9E3779B9u, 0xBB67AE85u);
+    }
+    return ctr;
+}
+
+// four independent uniform random numbers in [0,1)
+float4 random_uniform4(uint seed, uint idx, uint sample_index, uint path_index, uint stream)
+{
+    const uint4 bits = philox4x32_10(
+        (uint4)(idx, sample_index, path_index, stream),
+        (uint2)(seed, 0x2545F491u));
+    return convert_float4(bits >> 8) * (1.0f / 16777216.0f);
+}
+
+// uniformly distributed random unit vector
+float3 random_unit_vector(float2 u)
+{
+    const float z = 1.0f - 2.0f*u.x;
+    const float r = sqrt(max(1.0f - z*z, 0.0f));
+    const float phi = 2.0f * (float)M_PI * u.y;
+    return (float3)(r*cos(phi), r*sin(phi), z);
+}
+
+// normally distributed random vector (Box-Muller)
+float3 random_gaussian_vector(float4 u)
+{
+    const float2 r = sqrt(-2.0f * log(1.0f - u.xz));
+    const float2 phi = 2.0f * (float)M_PI * u.yw;
+    return (float3)(r.x*cos(phi.x), r.x*sin(phi.x), r.y*cos(phi.y));
+}
+
+// Counting sort of the ray list by the id of the hit object (bin 0 for
+// no hit), so that the rays hitting the same object, and hence the same
+// material, are contiguous
+
+__kernel void bin_rays_count(
+		global const int *pixel,
+		global const uint *whichobject,
+		global int *bin_count)
+{
+	const int ray_idx = pixel[get_global_id(0)];
+	if (ray_idx < 0) return;
+	atomic_inc(bin_count + whichobject[ray_idx]);
+}
+
+// run as a single work item: turns the counts into write positions
+// and stores the start of each bin (and the total count) to bin_start
+__kernel void bin_rays_offsets(
+		global int *bin_count,
+		global int *bin_start,
+		int n_bins)
+{
+	int sum = 0;
+	for (int i = 0; i < n_bins; i++) {
+		bin_start[i] = sum;
+		sum += bin_count[i];
+		bin_count[i] = bin_start[i];
+	}
+	bin_start[n_bins] = sum;
+}
+
+__kernel void bin_rays_scatter(
+		global const int *pixel,
+		global const float *isec_dist,
+		global const uint *whichobject,
+		global int *bin_position,
+		global int *new_pixel,
+		global float *new_isec_dist)
+{
+	const int thread_idx = get_global_id(0);
+	const int ray_idx = pixel[thread_idx];
+	if (ray_idx < 0) return;
+	
+	const int dest = atomic_inc(bin_position + whichobject[ray_idx]);
+	new_pixel[dest] = ray_idx;
+	new_isec_dist[dest] = isec_dist[thread_idx];
+}
+
+// Adaptive sampling: adds the image slots of a batch of samples of
+// the active pixels to the per-pixel sums
+__kernel void accumulate_pixel_samples(
+		global const float3 *img,
+		global const int *active_pixels,
+		global float3 *pixel_sum,
+		global float *pixel_sum_sq,
+		global int *pixel_count,
+		int n_active,
+		int n_samples)
+{
+	const int i = get_global_id(0);
+	const int p = active_pixels[i];
+	
+	float3 sum = (float3)(0.0f, 0.0f, 0.0f);
+	float sum_sq = 0.0f;
+	for (int k = 0; k < n_samples; k++) {
+		const float3 v = img[k*n_active + i];
+		const float brightness = (v.x + v.y + v.z) / 3.0f;
+		sum += v;
+		sum_sq += brightness*brightness;
+	}
+	
+	pixel_sum[p] += sum;
+	pixel_sum_sq[p] += sum_sq;
+	pixel_count[p] += n_samples;
+}
+
+// Pixel p is active (active[p] = p) if its brightness has a relative
+// standard error above max_error, otherwise active[p] = -1
+__kernel void select_active_pixels(
+		global const float3 *pixel_sum,
+		global const float *pixel_sum_sq,
+		global const int *pixel_count,
+		global int *active,
+		float max_error,
+		int min_samples)
+{
+	const int p = get_global_id(0);
+	const int n = pixel_count[p];
+	
+	const float3 s = pixel_sum[p];
+	const float mean = (s.x + s.y + s.z) / 3.0f / n;
+	const float variance = max(pixel_sum_sq[p] / n - mean*mean, 0.0f);
+	
+	if (n < min_samples || sqrt(variance / n) > max_error * mean)
+		active[p] = p;
+	else
+		active[p] = -1;
+}
+
 __kernel void fill_vec_broadcast(global float3 *a, constant float3 *v)
 {
 	const int gid = get_global_id(0);
 	a[gid] = *v;
 }
 
+### if renderer.scene.device_rng
+
+__kernel void subsample_transform_camera(
+		global const float3 *original_rays,
+		global float3 *new_rays,
+		global int *pixel,
+		global float3 *new_pos,
+		// rows: camera basis vectors (right, down, forward),
+		// (camera position, sharp distance), (pixel angle, DOF f-stop)
+		constant float4 *camera,
+		uint rng_seed,
+		uint sample_index,
+		// the rays of several samples may be traced at once, ray
+		// gid belongs to pixel gid % n_pixels
+		int n_pixels
+		### if renderer.adaptive_sampling
+		// ...of the list of pixels that still need samples
+		, global const int *active_pixels
+		### endif
+		)
+{
+	const int gid = get_global_id(0);
+	pixel[gid] = gid;
+	
+	const float4 rnd = random_uniform4(rng_seed, gid, sample_index, 0, RNG_STREAM_CAMERA);
+	const float3 right = camera[0].xyz, down = camera[1].xyz, forward = camera[2].xyz;
+	const float sharp_distance = camera[3].w;
+	const float pixel_angle = camera[4].x, dof_fstop = camera[4].y;
+	
+	// random position within the pixel
+	float2 s = rnd.xy;
+	### if renderer.scene.tent_filter
+	// Tent filter as in smallpt
+	s *= 2.0f;
+	s = (float2)(
+		s.x < 1.0f ? sqrt(s.x)-1.0f : 1.0f-sqrt(2.0f-s.x),
+		s.y < 1.0f ? sqrt(s.y)-1.0f : 1.0f-sqrt(2.0f-s.y));
+	### endif
+	const float2 theta = (s - 0.5f) * pixel_angle;
+	
+	// tilt the ray in camera coordinates, first in the xz-plane and
+	// then in the yz-plane
+	### if renderer.adaptive_sampling
+	const float3 ray = original_rays[active_pixels[gid % n_pixels]];
+	### else
+	const float3 ray = original_rays[gid % n_pixels];
+	### endif
+	float3 c = (float3)(dot(right, ray), dot(down, ray), dot(forward, ray));
+	c = (float3)(cos(theta.x)*c.x - sin(theta.x)*c.z, c.y, sin(theta.x)*c.x + cos(theta.x)*c.z);
+	c = (float3)(c.x, cos(theta.y)*c.y - sin(theta.y)*c.z, sin(theta.y)*c.y + cos(theta.y)*c.z);
+	const float3 rot_ray = c.x*right + c.y*down + c.z*forward;
+	
+	// random point on the aperture (depth of field)
+	const float dof_r = sqrt(rnd.z) * dof_fstop, dof_phi = 2.0f * (float)M_PI * rnd.w;
+	const float3 dof_pos = dof_r * (cos(dof_phi) * right + sin(dof_phi) * down);
+	
+	new_pos[gid] = camera[3].xyz + dof_pos;
+	
+	if (sharp_distance > 0.0)
+		new_rays[gid] = fast_normalize( sharp_distance * rot_ray - dof_pos );
+	else
+		new_rays[gid] = rot_ray;
+}
+
+### else
+
 __kernel void subsample_transform_camera(
 		global const float3 *original_rays,
 		global float3 *new_rays,
@@ -130,4 +344,4 @@ __kernel void subsample_transform_camera(
 		new_rays[gid] = rot_ray;
 }
 
-
+### endif
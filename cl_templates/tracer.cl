@@ -66,12 +66,10 @@ void {{ obj.tracer_function_name }}(
 
 ### macro get_coordinate_system(obj)
     ### set affine_params_index = obj.parameter_declarations()|length
-    constant const float4 *p_inverse_affine = param_float3_data + data_offsets[DATA_PARAM_float3] + {{ obj.local_param_offsets[affine_params_index] }};
+    PARAM_DATA const float4 *p_inverse_affine = param_float3_data + data_offsets[DATA_PARAM_float3] + {{ obj.local_param_offsets[affine_params_index] }};
 ### endmacro
 
-### macro tracer_kernel(obj)
-
-__kernel void {{ obj.tracer_kernel_name }}(
+### macro tracer_kernel_arguments()
     __global const int *pixel,
     __global const float3 *p_pos,
     __global const float3 *p_ray,
@@ -83,25 +81,42 @@ __kernel void {{ obj.tracer_kernel_name }}(
     __global const uint *p_inside,
     TRACER_DATA const float4 *vector_data,
     TRACER_DATA const int *integer_data,
-    constant const float4 *param_float3_data,
-    constant const int *param_int_data,
-    constant const float *param_float_data,
-    int object_id)
-{
-    const int thread_idx = get_global_id(0);
-    const int ray_idx = pixel[thread_idx];
-    
-    const float old_isec_dist = p_isec_dist[thread_idx];
-    float isec_dist = old_isec_dist;
-    const uint old_subobject =  p_last_which_subobject[ray_idx];
-    uint subobject, whichobject;
-    
-    const uint inside_current = p_inside[ray_idx] == object_id,
-               origin_self = p_last_whichobject[ray_idx] == object_id;
+    PARAM_DATA const float4 *param_float3_data,
+    PARAM_DATA const int *param_int_data,
+    PARAM_DATA const float *param_float_data
+### endmacro
+
+### macro load_ray_state()
+    const float3 pos = p_pos[ray_idx];
+    const float3 ray = p_ray[ray_idx];
+    const uint inside = p_inside[ray_idx],
+               last_whichobject = p_last_whichobject[ray_idx],
+               old_subobject = p_last_which_subobject[ray_idx];
     
-    constant const int *data_offsets = param_int_data + DATA_N_TYPES*(object_id-1) + DATA_POINTER_BUFFER_OFFSET;
+    // the closest hit found so far is kept in these
+    float isec_dist = p_isec_dist[thread_idx];
+    uint whichobject, subobject;
+    bool hit = false;
+### endmacro
+
+### macro store_closest_hit()
+    if (hit) {
+        p_isec_dist[thread_idx] = isec_dist;
+        p_which_subobject[ray_idx] = subobject;
+        p_whichobject[ray_idx] = whichobject;
+    }
+### endmacro
+
+### macro trace_object(obj)
+{#/*
+    Intersects the ray with the object object_id (whose tracer is obj)
+    and updates the closest hit if the intersection is closer
+*/#}
+{
+    const uint inside_current = inside == object_id,
+               origin_self = last_whichobject == object_id;
     
-    // call tracer
+    PARAM_DATA const int *data_offsets = param_int_data + DATA_N_TYPES*(object_id-1) + DATA_POINTER_BUFFER_OFFSET;
     
     ### if obj.convex
     if (!origin_self || inside_current) {
@@ -112,8 +127,8 @@ __kernel void {{ obj.tracer_kernel_name }}(
         
         {{ get_coordinate_system(obj) }}
     
-        const float3 local_pos = apply_affine_transform(p_inverse_affine, p_pos[ray_idx]);
-        const float3 local_ray = apply_linear_transform(p_inverse_affine, p_ray[ray_idx]);
+        const float3 local_pos = apply_affine_transform(p_inverse_affine, pos);
+        const float3 local_ray = apply_linear_transform(p_inverse_affine, ray);
         const float stretch = length(local_ray);
     
         {{ obj.tracer_function_name }}(
@@ -126,9 +141,10 @@ __kernel void {{ obj.tracer_kernel_name }}(
         {
             new_isec_dist /= stretch;
             if (new_isec_dist < isec_dist) {
-                p_isec_dist[thread_idx] = new_isec_dist;
-                p_which_subobject[ray_idx] = cur_subobject;
-                p_whichobject[ray_idx] = object_id;
+                isec_dist = new_isec_dist;
+                subobject = cur_subobject;
+                whichobject = object_id;
+                hit = true;
             }
         }
     
@@ -136,6 +152,26 @@ __kernel void {{ obj.tracer_kernel_name }}(
     }
     ### endif
 }
+### endmacro
+
+### macro tracer_kernel(obj)
+
+__kernel void {{ obj.tracer_kernel_name }}(
+    {{ tracer_kernel_arguments() }},
+    int offset, int count)
+{
+    const int thread_idx = get_global_id(0);
+    const int ray_idx = pixel[thread_idx];
+    if (ray_idx < 0) return;
+    
+    {{ load_ray_state() }}
+    
+    // call tracer for each object in the range
+    for (int object_id = offset; object_id < offset+count; object_id++)
+        {{ trace_object(obj) }}
+    
+    {{ store_closest_hit() }}
+}
 
 
 ### endmacro
@@ -152,9 +188,9 @@ __kernel void {{ obj.shadow_kernel_name }}(
     __global float *p_shadow_mask,
     TRACER_DATA const float4 *vector_data,
     TRACER_DATA const int *integer_data,
-    constant const float4 *param_float3_data,
-    constant const int *param_int_data,
-    constant const float *param_float_data,
+    PARAM_DATA const float4 *param_float3_data,
+    PARAM_DATA const int *param_int_data,
+    PARAM_DATA const float *param_float_data,
     constant float4 *p_dest_point,
     int light_id,
     int offset, int count)
@@ -162,7 +198,7 @@ __kernel void {{ obj.shadow_kernel_name }}(
     const int thread_idx = get_global_id(0);
     const int ray_idx = pixel[thread_idx];
     
-    if (p_shadow_mask[thread_idx] == 0.0) return;
+    if (ray_idx < 0 || p_shadow_mask[thread_idx] == 0.0) return;
     
     const int object_index = get_global_id(1);
     //if (object_index >= count) return;
@@ -189,7 +225,7 @@ __kernel void {{ obj.shadow_kernel_name }}(
     
     float new_isec_dist = 0;
     
-    constant const int *data_offsets = param_int_data + DATA_N_TYPES*(object_id-1) + DATA_POINTER_BUFFER_OFFSET;
+    PARAM_DATA const int *data_offsets = param_int_data + DATA_N_TYPES*(object_id-1) + DATA_POINTER_BUFFER_OFFSET;
     
     // call tracer
     
@@ -233,13 +269,24 @@ __kernel void {{ obj.normal_kernel_name }}(
     __global const uint *p_inside,
     TRACER_DATA const float4 *vector_data,
     TRACER_DATA const int *integer_data,
-    constant float4 *param_float3_data,
-    constant int *param_int_data,
-    constant float *param_float_data,
-    int offset, int count)
+    PARAM_DATA float4 *param_float3_data,
+    PARAM_DATA int *param_int_data,
+    PARAM_DATA float *param_float_data,
+    int offset, int count
+#ifdef BIN_RAYS
+    // start of the rays hitting each object in the binned ray list
+    , global const int *bin_start
+#endif
+    )
 {
+#ifdef BIN_RAYS
+    const int thread_idx = bin_start[offset] + get_global_id(0);
+    if (thread_idx >= bin_start[offset+count]) return;
+#else
     const int thread_idx = get_global_id(0);
+#endif
     const int ray_idx = pixel[thread_idx];
+    if (ray_idx < 0) return;
     
     p_whichobject += ray_idx;
     const uint whichobject = *p_whichobject;
@@ -260,7 +307,7 @@ __kernel void {{ obj.normal_kernel_name }}(
         *p_pos = pos;
         const uint subobject = *p_which_subobject;
         
-        constant const int *data_offsets = param_int_data + DATA_N_TYPES*(whichobject-1) + DATA_POINTER_BUFFER_OFFSET;
+        PARAM_DATA const int *data_offsets = param_int_data + DATA_N_TYPES*(whichobject-1) + DATA_POINTER_BUFFER_OFFSET;
         
         {{ get_coordinate_system(obj) }}
         const float3 local_pos = apply_affine_transform(p_inverse_affine, pos);
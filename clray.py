@@ -14,29 +14,59 @@ specified by the command line arguments).
 
 if __name__ == '__main__':
     
+    import time
+    startup_time = time.time()
+    
     import numpy as np
-    import time, sys, os, os.path, argparse
-    import renderer
+    import sys, os, os.path, argparse
+    import renderer, accelerator, render_farm, checkpoint
 
-    from imgutils import Image
-
-    startup_time = time.time()
+    from imgutils import Image, BackgroundWriter
+    
+    # durations of the startup stages, printed after the first batch
+    startup_stages = [('imports', time.time() - startup_time)]
 
     PNG_OUTPUT_FILE = 'out.png'
     RAW_OUTPUT_FILE = 'out.raw.npy'
+    CHECKPOINT_FILE = 'out.checkpoint.npz'
 
     # ------- Parse options
 
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-a', '--append', action='store_true')
+    arg_parser.add_argument('-r', '--resume', action='store_true', \
+        help='continue from the checkpoint of an interrupted render')
+    arg_parser.add_argument('--continuous', action='store_true', \
+        help='keep rendering after samples_per_pixel samples')
     arg_parser.add_argument('-n', '--no_window', action='store_true')
     arg_parser.add_argument('-itr', '--itr_per_refresh', type=int, default=100)
     arg_parser.add_argument('-o', '--cl_build_options', default='')
     arg_parser.add_argument('-c', '--choose_opencl_context', \
         action='store_true')
+    arg_parser.add_argument('--asynchronous', action='store_true', \
+        help='do not wait for each kernel call to finish')
+    arg_parser.add_argument('--multi_device', action='store_true', \
+        help='render on all devices of the OpenCL context')
+    arg_parser.add_argument('--sub_devices', type=int, default=None, \
+        help='split each device to this many sub-devices (device fission)')
+    arg_parser.add_argument('--coordinator', metavar='[HOST:]PORT', \
+        help='merge the results of render farm workers, do not render')
+    arg_parser.add_argument('--worker', metavar='[HOST:]PORT', \
+        help='render the samples given by a render farm coordinator')
+    arg_parser.add_argument('--farm_key', default=None, \
+        help='secret key of the render farm connections, or @file ' + \
+            'to read it from a file (default: $%s)' % \
+            render_farm.FARM_KEY_VARIABLE)
     
     arg_parser.add_argument('scene')
     args = arg_parser.parse_args()
+    
+    if args.coordinator is not None or args.worker is not None:
+        # refuse to open unauthenticated render farm connections
+        try:
+            farm_key = render_farm.farm_key(args.farm_key)
+        except (RuntimeError, IOError) as e:
+            arg_parser.error(str(e))
 
     # ------- Import scene (not pretty...)
     def import_scene():
@@ -44,7 +74,9 @@ if __name__ == '__main__':
         scene_name = os.path.basename(args.scene).split('.')[0]
         scene_module = __import__(scene_name)
         return scene_module.scene
+    t0 = time.time()
     scene = import_scene()
+    startup_stages.append(('scene', time.time() - t0))
 
     # ------------- Initialize image
 
@@ -55,23 +87,107 @@ if __name__ == '__main__':
         img = Image( old_raw_file, settings=scene.image )
         return img
     image = init_image()
+    
+    def show_image(imgdata):
+        print 'image mean:', np.mean(np.ravel(imgdata))
+        
+        # the window is only touched from the main thread
+        if not args.no_window:
+            image.show( imgdata )
+    
+    def save_image(imgdata):
+        image.save_raw( RAW_OUTPUT_FILE, imgdata )
+        image.save_png( PNG_OUTPUT_FILE, imgdata )
+
+    # ------------- Render farm coordinator
+    
+    if args.coordinator is not None:
+        writer = BackgroundWriter(save_image)
+        
+        def refresh(imgdata):
+            show_image(imgdata)
+            writer.submit(imgdata)
+        
+        render_farm.run_coordinator( \
+            render_farm.parse_address(args.coordinator), farm_key, \
+            scene, args.itr_per_refresh, refresh)
+        writer.close()
+        sys.exit(0)
 
     # ------------- Initialize CL
 
-    renderer = renderer.Renderer(scene, args)
-    acc = renderer.acc
+    t0 = time.time()
+    if args.multi_device or args.sub_devices is not None:
+        devices = accelerator.get_devices(args.choose_opencl_context, \
+            args.sub_devices)
+        renderer = renderer.MultiDeviceRenderer(scene, args, devices)
+    else:
+        renderer = renderer.Renderer(scene, args)
+    startup_stages.append(('renderer', time.time() - t0))
+    
+    if args.worker is not None:
+        render_farm.run_worker(render_farm.parse_address(args.worker), \
+            farm_key, renderer)
+        renderer.output_profiling_info()
+        sys.exit(0)
 
+    def is_refresh_sample(j):
+        return j % args.itr_per_refresh == 0 or j == scene.samples_per_pixel-1 or \
+           (j % max(1,int(args.itr_per_refresh/10)) == 0 and \
+            j < args.itr_per_refresh)
+
+    # ------------- Checkpoints
+    
+    samples_done = 0
+    
+    if args.resume and os.path.exists(CHECKPOINT_FILE):
+        ckpt = checkpoint.Checkpoint.load(CHECKPOINT_FILE)
+        if ckpt.scene_hash != renderer.scene_hash:
+            raise RuntimeError('%s is a checkpoint of a different scene' \
+                % CHECKPOINT_FILE)
+        
+        print 'resuming from %d samples' % ckpt.n_samples
+        ckpt.restore_rng_state(renderer)
+        image.data = ckpt.image
+        # the sample indices continue from the checkpoint so that the
+        # device random numbers of the new samples are different
+        samples_done = ckpt.n_samples
+    
+    def save_checkpoint(imgdata, n_samples, np_rng_state):
+        checkpoint.Checkpoint(image._sum(imgdata), n_samples, \
+            renderer.rng_seed, renderer.scene_hash, np_rng_state) \
+            .save(CHECKPOINT_FILE)
+    
+    def write_output(imgdata, n_samples, np_rng_state):
+        save_image(imgdata)
+        save_checkpoint(imgdata, n_samples, np_rng_state)
+    
+    # the output files are written on a background thread while the
+    # rendering continues
+    writer = BackgroundWriter(write_output)
+    
     # Do it
-    for j in xrange(scene.samples_per_pixel):
+    first_sample = samples_done
+    while args.continuous or samples_done < scene.samples_per_pixel:
+        
+        j = samples_done
+        n_samples = renderer.samples_per_batch
+        if not args.continuous:
+            n_samples = min(n_samples, scene.samples_per_pixel-j)
         
         t0 = time.time()
-        depth = renderer.render_sample(j)
+        depth = renderer.render_sample(j, n_samples)
         tcur = time.time()
         
+        if j == first_sample:
+            startup_stages.append(('first batch', tcur - t0))
+            print 'time to first sample: %.2f s (%s)' % (tcur - startup_time, \
+                ', '.join(['%s %.2f s' % s for s in startup_stages]))
+        
         elapsed = (tcur-startup_time)
-        samples_done = j+1
-        samples_per_second = float(j+1) / elapsed
-        samples_left = scene.samples_per_pixel - samples_done
+        samples_done = j+n_samples
+        samples_per_second = float(samples_done - first_sample) / elapsed
+        samples_left = max(scene.samples_per_pixel - samples_done, 0)
         eta = samples_left / samples_per_second
         rays_per_second = int(renderer.rays_per_sample() * samples_per_second)
         
@@ -83,19 +199,12 @@ if __name__ == '__main__':
         print "elapsed: %.2f s," % (tcur-startup_time),
         print "eta: %.1f min" % (eta/60.0)
         
-        if j % args.itr_per_refresh == 0 or j == scene.samples_per_pixel-1 or \
-           (j % max(1,int(args.itr_per_refresh/10)) == 0 and \
-            j < args.itr_per_refresh):
+        if any([is_refresh_sample(i) for i in range(j, samples_done)]):
             
             imgdata = renderer.get_image()
-            print 'image mean:', np.mean(np.ravel(imgdata))
-            
-            if not args.no_window:
-                image.show( imgdata )
-            
-            image.save_raw( RAW_OUTPUT_FILE, imgdata )
-            image.save_png( PNG_OUTPUT_FILE, imgdata )
-            
-            acc.output_profiling_info()
+            show_image(imgdata)
+            writer.submit(imgdata, samples_done, np.random.get_state())
+            renderer.output_profiling_info()
         
-    acc.output_profiling_info()
+    writer.close()
+    renderer.output_profiling_info()
@@ -2,6 +2,7 @@
 # ------- Image input/output utils
 
 import numpy as np
+import threading
 #from graphics import PygameGraphics as Graphics # Uncomment for pygame
 from graphics import PySdlGraphics as Graphics
 
@@ -91,6 +92,57 @@ class Image:
         self._graphics.blit_3d_numpy_array(img)
         self._graphics.update()
 
+class BackgroundWriter:
+    """
+    Calls write(*snapshot) for the submitted snapshots on a background
+    thread. If several snapshots are submitted while the previous one is
+    being written, only the latest of them is written
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._lock = threading.Condition()
+        self._pending = None
+        self._closed = False
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, *snapshot):
+        with self._lock:
+            self._raise_error()
+            self._pending = snapshot
+            self._lock.notify()
+
+    def close(self):
+        """Write the last pending snapshot and stop the thread"""
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._pending is None and not self._closed:
+                    self._lock.wait()
+                snapshot = self._pending
+                self._pending = None
+            if snapshot is None: return
+
+            try:
+                self._write(*snapshot)
+            except Exception as e:
+                self._error = e
+                return
+
 def init_window_from_image(img):
     graphics = Graphics()
 
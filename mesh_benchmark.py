@@ -0,0 +1,103 @@
+"""
+Benchmark of the triangle mesh accelerators (Octree and MeshBVH): build
+time and rendering speed on the same meshes. The meshes are random
+triangles on a sphere, either uniformly distributed or with half of the
+triangles in a small detailed region, or read from files (OFF, PLY, STL
+or OBJ).
+
+    python mesh_benchmark.py -t 10000 100000
+    python mesh_benchmark.py -t -f bunny.ply
+"""
+
+if __name__ == '__main__':
+
+    import time
+    import numpy as np
+    import argparse
+    
+    import renderer
+    import mesh_formats
+    from objects import TriangleMesh, Octree, MeshBVH
+    from scenes.default_scenes import BoxScene
+    
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-t', '--triangles', type=int, nargs='*', \
+        default=[10000, 100000], help='sizes of the random meshes')
+    arg_parser.add_argument('-f', '--mesh_files', nargs='+', default=[])
+    arg_parser.add_argument('-s', '--samples', type=int, default=16)
+    arg_parser.add_argument('--octree_depth', type=int, default=5)
+    arg_parser.add_argument('--faces_per_leaf', type=int, default=8)
+    arg_parser.add_argument('-o', '--cl_build_options', default='')
+    arg_parser.add_argument('-c', '--choose_opencl_context', \
+        action='store_true')
+    arg_parser.add_argument('--asynchronous', action='store_true')
+    args = arg_parser.parse_args()
+    
+    def random_mesh(n_triangles, uneven):
+        rs = np.random.RandomState(0)
+        centers = rs.normal(size=(n_triangles, 3))
+        centers /= np.sqrt(np.sum(centers**2, 1))[:, np.newaxis]
+        if uneven:
+            centers[:n_triangles//2] = centers[:n_triangles//2]*0.05 + 0.6
+        
+        triangle_size = 2.0 / np.sqrt(n_triangles)
+        vertices = np.repeat(centers, 3, 0) + \
+            rs.normal(scale=triangle_size, size=(3*n_triangles, 3))
+        faces = np.arange(3*n_triangles).reshape((n_triangles, 3))
+        return vertices, faces
+    
+    meshes = []
+    for n in args.triangles:
+        meshes.append(('uniform %d' % n, random_mesh(n, False)))
+        meshes.append(('uneven %d' % n, random_mesh(n, True)))
+    for filename in args.mesh_files:
+        vertices, faces = mesh_formats.read_mesh(filename)
+        faces = mesh_formats.remove_duplicate_faces(faces)
+        meshes.append((filename, (vertices, faces)))
+    
+    accelerators = [
+        ('Octree', lambda mesh: Octree(mesh, \
+            max_depth=args.octree_depth, \
+            max_faces_per_leaf=args.faces_per_leaf)),
+        ('MeshBVH', lambda mesh: MeshBVH(mesh, \
+            max_faces_per_leaf=args.faces_per_leaf))
+    ]
+    
+    results = []
+    
+    for mesh_name, (vertices, faces) in meshes:
+        for acc_name, make_accelerator in accelerators:
+        
+            mesh = TriangleMesh(vertices, faces, \
+                center=(0,0,0.7), scale=0.7, auto_scale=True)
+            
+            t0 = time.time()
+            obj = make_accelerator(mesh)
+            build_time = time.time() - t0
+            
+            scene = BoxScene()
+            scene.add_object(obj, 'white')
+            scene.samples_per_pixel = args.samples
+            
+            r = renderer.Renderer(scene, args)
+            
+            # the first batch includes the data transfers
+            r.render_sample(0, 1)
+            
+            t0 = time.time()
+            j = 1
+            while j < args.samples:
+                n_samples = min(r.samples_per_batch, args.samples - j)
+                r.render_sample(j, n_samples)
+                j += n_samples
+            r.get_image()
+            render_time = time.time() - t0
+            
+            rays_per_second = r.rays_per_sample() * (j - 1) / render_time
+            results.append((mesh_name, acc_name, build_time, rays_per_second))
+    
+    print
+    print '%-20s %-8s %10s %12s' % ('mesh', 'tracer', 'build (s)', 'rays/s')
+    for mesh_name, acc_name, build_time, rays_per_second in results:
+        print '%-20s %-8s %10.2f %12d' % \
+            (mesh_name, acc_name, build_time, rays_per_second)
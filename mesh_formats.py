@@ -1,19 +1,83 @@
-# 10-minute implementations of reading different mesh formats
+# Reading different mesh formats with bulk numpy parsing
 
-def open_or_yield(filename_or_file):
+import numpy
+import os
+import re
+
+def open_or_yield(filename_or_file, mode='r'):
     if isinstance(filename_or_file, str):
-        with open(filename_or_file, 'r') as f:
+        with open(filename_or_file, mode) as f:
             yield(f)
     else:
         yield(filename_or_file)
 
-def poly_to_triangle_fan(vertices):
-    for offset in range(len(vertices)-2):
-        yield([vertices[0],vertices[offset+1],vertices[offset+2]])
+def triangle_fans(indices, starts, counts):
+    """
+    Triangulates polygons as triangle fans. The vertex indices of
+    polygon i are indices[starts[i]:starts[i]+counts[i]]
+    """
+    
+    n_triangles = numpy.maximum(counts - 2, 0)
+    polygon = numpy.repeat(numpy.arange(len(counts)), n_triangles)
+    offset = numpy.arange(len(polygon)) - \
+        numpy.repeat(numpy.cumsum(n_triangles) - n_triangles, n_triangles)
+    first = starts[polygon]
+    
+    return numpy.column_stack((indices[first], \
+        indices[first + offset + 1], indices[first + offset + 2]))
+
+def read_ascii_lines(text, n_lines):
+    """
+    Parses the numbers on the first n_lines lines of text. Returns the
+    numbers as a flat array, the number of numbers on each line, the
+    index of the first number of each line and the rest of the text
+    """
+    
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    newlines = numpy.nonzero(chars == ord('\n'))[0]
+    
+    if n_lines <= len(newlines):
+        end = newlines[n_lines-1] + 1 if n_lines > 0 else 0
+    elif n_lines == len(newlines) + 1 and len(text.strip()) > 0:
+        # the last line does not end with a newline
+        end = len(text)
+    else:
+        raise RuntimeError('expected %d lines, got %d' % (n_lines, len(newlines)))
+    
+    # a number begins where whitespace ends
+    whitespace = numpy.zeros(end, dtype=bool)
+    for c in [' ', '\t', '\r', '\n']:
+        whitespace |= chars[:end] == ord(c)
+    token_starts = numpy.nonzero(~whitespace & \
+        numpy.concatenate(([True], whitespace[:-1])))[0]
+    line_lengths = numpy.bincount( \
+        numpy.searchsorted(newlines[:n_lines], token_starts), minlength=n_lines)
+    
+    values = numpy.fromstring(text[:end], sep=' ')
+    if len(values) != len(token_starts):
+        raise RuntimeError('could not parse numbers')
+    
+    line_starts = numpy.cumsum(line_lengths) - line_lengths
+    return values, line_lengths, line_starts, text[end:]
+
+def read_ascii_polygons(text, n_polygons):
+    """
+    Parses n_polygons lines of the form 'n i_1 ... i_n ...' and
+    triangulates the polygons. Returns the triangles and the rest of
+    the text
+    """
+    
+    values, line_lengths, line_starts, rest = read_ascii_lines(text, n_polygons)
+    indices = values.astype(int)
+    counts = indices[line_starts]
+    if numpy.any(counts + 1 > line_lengths):
+        raise RuntimeError('invalid polygon')
+    
+    return triangle_fans(indices, line_starts + 1, counts), rest
 
 def read_off(f):
     for off in open_or_yield(f):
-        
+    
         first_line = off.readline().strip()
         none, sep, rest = first_line.partition('OFF')
         if len(none) > 0 or sep != 'OFF':
@@ -25,58 +89,378 @@ def read_off(f):
         
         print 'reading OFF with', n_points, 'points and', n_faces, 'faces'
         
-        vertices = []
-        for v in xrange(n_points):
-            vertices.append([float(x) for x in off.readline().split()])
+        values, _, line_starts, text = read_ascii_lines(off.read(), n_points)
+        vertices = values[line_starts[:, numpy.newaxis] + numpy.arange(3)]
+        
+        faces, _ = read_ascii_polygons(text, n_faces)
         
-        faces = []
-        for f in xrange(n_faces):
-            face_vertices = [int(x) for x in off.readline().split()]
-            assert(face_vertices[0] == len(face_vertices)-1)
-            
-            faces += list(poly_to_triangle_fan(face_vertices[1:]))
-            
         print "constructed", len(faces), "triangles"
         return vertices, faces
 
-def read_zipper(f):
-    """the Stanford bunny is published in this format"""
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'
+}
+
+def read_ply_header(ply):
+    """
+    Returns the format and a list of (name, count, properties) elements,
+    where a property is (name, type) or (name, (count_type, item_type))
+    for a list property
+    """
+    
+    if ply.readline().strip() != b'ply':
+        raise RuntimeError('not PLY format')
     
-    for zipper in open_or_yield(f):
+    ply_format = None
+    elements = []
+    
+    while True:
+        line = ply.readline()
+        if len(line) == 0: raise RuntimeError("unexpected eof")
+        line = str(line.decode('ascii')).strip().split()
+        if len(line) == 0: continue
         
-        while True:
-            line = zipper.readline().strip().split()
-            if len(line) == 0: raise RuntimeError("unexpected eof/empty line")
-            if line[0] == 'element':
-                if line[1] == 'vertex':
-                    n_vertices = int(line[2])
-                elif line[1] == 'face':
-                    n_faces = int(line[2])
-            elif line[0] == 'end_header':
-                break
+        if line[0] == 'format':
+            ply_format = line[1]
+        elif line[0] == 'element':
+            elements.append((line[1], int(line[2]), []))
+        elif line[0] == 'property':
+            if line[1] == 'list':
+                elements[-1][2].append((line[4], \
+                    (PLY_TYPES[line[2]], PLY_TYPES[line[3]])))
+            else:
+                elements[-1][2].append((line[2], PLY_TYPES[line[1]]))
+        elif line[0] == 'end_header':
+            return ply_format, elements
+
+def read_ply(f):
+    """ASCII or binary PLY, the Stanford bunny is published in this format"""
+    
+    for ply in open_or_yield(f, 'rb'):
+    
+        ply_format, elements = read_ply_header(ply)
+        data = ply.read()
         
-        vertices = []
-        faces = []
+        if ply_format == 'ascii':
+            byte_order = None
+        elif ply_format == 'binary_little_endian':
+            byte_order = '<'
+        elif ply_format == 'binary_big_endian':
+            byte_order = '>'
+        else:
+            raise RuntimeError('unknown PLY format %s' % ply_format)
         
-        for i in xrange(n_vertices):
-            line = zipper.readline().strip().split()
-            vertices.append([float(line[c]) for c in range(3)])
+        vertices = None
+        faces = None
+        offset = 0
         
-        for i in xrange(n_faces):
-            face_vertices = [int(x) for x in zipper.readline().strip().split()]
-            assert(face_vertices[0] == len(face_vertices)-1)
-            faces += list(poly_to_triangle_fan(face_vertices[1:]))
+        for name, count, properties in elements:
+            is_list = [isinstance(t, tuple) for _, t in properties]
+            
+            if any(is_list):
+                if len(properties) != 1:
+                    raise RuntimeError('unsupported PLY element %s' % name)
+                
+                if byte_order is None:
+                    polygons, data = read_ascii_polygons(data, count)
+                else:
+                    polygons, offset = read_binary_ply_polygons(data, offset, \
+                        count, properties[0][1], byte_order)
+                
+                if name == 'face': faces = polygons
+            else:
+                if byte_order is None:
+                    values, line_lengths, _, data = read_ascii_lines(data, count)
+                    if numpy.any(line_lengths != len(properties)):
+                        raise RuntimeError('invalid PLY element %s' % name)
+                    table = values.reshape((count, len(properties)))
+                    columns = dict([(p[0], table[:,i]) for i, p in enumerate(properties)])
+                else:
+                    dtype = numpy.dtype([(p, byte_order + t) for p, t in properties])
+                    table = numpy.frombuffer(data, dtype, count, offset)
+                    offset += count * dtype.itemsize
+                    columns = dict([(p, table[p]) for p, _ in properties])
+                
+                if name == 'vertex':
+                    vertices = numpy.column_stack([columns[c] for c in 'xyz'])
+        
+        if vertices is None or faces is None:
+            raise RuntimeError('no vertices or faces in the PLY file')
+        
+        return vertices, faces
+
+def read_binary_ply_polygons(data, offset, count, list_type, byte_order):
+    """Returns the triangles and the offset after the polygons"""
+    
+    count_type, item_type = [numpy.dtype(byte_order + t) for t in list_type]
     
+    if count > 0:
+        # usually all polygons have the same number of vertices
+        n = int(numpy.frombuffer(data, count_type, 1, offset)[0])
+        dtype = numpy.dtype([('n', count_type), ('indices', item_type, (n,))])
+        if offset + count * dtype.itemsize <= len(data):
+            polygons = numpy.frombuffer(data, dtype, count, offset)
+            if numpy.all(polygons['n'] == n):
+                indices = polygons['indices'].reshape((count, n))
+                faces = triangle_fans(numpy.ravel(indices), \
+                    numpy.arange(count) * n, numpy.repeat(n, count))
+                return faces, offset + count * dtype.itemsize
+    
+    # mixed polygons are read one by one
+    counts = numpy.zeros(count, dtype=int)
+    indices = [numpy.zeros(0, dtype=int)]
+    for i in xrange(count):
+        counts[i] = numpy.frombuffer(data, count_type, 1, offset)[0]
+        offset += count_type.itemsize
+        indices.append(numpy.frombuffer(data, item_type, counts[i], offset))
+        offset += counts[i] * item_type.itemsize
+    
+    indices = numpy.concatenate(indices)
+    starts = numpy.cumsum(counts) - counts
+    return triangle_fans(indices, starts, counts), offset
+
+def read_zipper(f):
+    """the Stanford bunny is published in this format (ASCII PLY)"""
+    return read_ply(f)
+
+def read_stl(f):
+    """Binary or ASCII STL, the vertices of the triangles are not shared"""
+    
+    for stl in open_or_yield(f, 'rb'):
+        data = stl.read()
+        
+        n_triangles = 0
+        if len(data) >= 84:
+            n_triangles = int(numpy.frombuffer(data, '<u4', 1, 80)[0])
+        
+        if len(data) == 84 + 50*n_triangles:
+            dtype = numpy.dtype([('normal', '<f4', (3,)), \
+                ('vertices', '<f4', (3,3)), ('attributes', '<u2')])
+            triangles = numpy.frombuffer(data, dtype, n_triangles, 84)
+            vertices = triangles['vertices'].reshape((-1, 3))
+        elif data.lstrip().startswith(b'solid'):
+            coordinates = re.findall(br'vertex\s+(\S+\s+\S+\s+\S+)', data)
+            vertices = numpy.fromstring(b' '.join(coordinates), sep=' ')
+            vertices = vertices.reshape((-1, 3))
+        else:
+            raise RuntimeError('not STL format')
+        
+        faces = numpy.arange(vertices.shape[0]).reshape((-1, 3))
         return vertices, faces
 
+def read_obj(f):
+    """Wavefront OBJ, only the vertex positions and the faces are read"""
+    
+    for obj in open_or_yield(f, 'rb'):
+        vertex_lines = []
+        face_lines = []
+        # for the relative (negative) vertex indices
+        face_vertex_counts = []
+        
+        for line in obj.read().splitlines():
+            # the keyword may be followed by any whitespace
+            fields = line.split(None, 1)
+            if len(fields) < 2: continue
+            keyword, rest = fields
+            if keyword == b'v':
+                vertex_lines.append(rest)
+            elif keyword == b'f':
+                face_lines.append(rest)
+                face_vertex_counts.append(len(vertex_lines))
+        
+        values, _, line_starts, _ = read_ascii_lines( \
+            b'\n'.join(vertex_lines), len(vertex_lines))
+        vertices = values[line_starts[:, numpy.newaxis] + numpy.arange(3)]
+        
+        # drop the texture coordinate and normal indices: v/vt/vn -> v
+        face_text = re.sub(br'/\S*', b'', b'\n'.join(face_lines))
+        values, counts, line_starts, _ = read_ascii_lines(face_text, len(face_lines))
+        indices = values.astype(int)
+        
+        n_previous = numpy.repeat(face_vertex_counts, counts)
+        indices = numpy.where(indices < 0, n_previous + indices, indices - 1)
+        
+        faces = triangle_fans(indices, line_starts, counts)
+        return vertices, faces
+
+MESH_READERS = {
+    '.off': read_off,
+    '.ply': read_ply,
+    '.stl': read_stl,
+    '.obj': read_obj
+}
+
+def read_mesh(filename, use_cache=True):
+    """
+    Reads a mesh file (format by extension, see MESH_READERS) as float32
+    vertices and int32 triangles. These are cached as .npy files next to
+    the mesh file, which are loaded memory-mapped when newer than it.
+    The mapping is copy-on-write: modifying the arrays does not modify
+    the cache files
+    """
+    
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in MESH_READERS:
+        raise RuntimeError('unknown mesh format %s' % extension)
+    
+    cache_files = [filename + '.vertices.npy', filename + '.faces.npy']
+    
+    if use_cache and all([os.path.exists(c) and \
+            os.path.getmtime(c) >= os.path.getmtime(filename) \
+            for c in cache_files]):
+        print 'loading cached', ', '.join(cache_files)
+        return [numpy.load(c, mmap_mode='c') for c in cache_files]
+    
+    vertices, faces = MESH_READERS[extension](filename)
+    arrays = [numpy.asarray(vertices, dtype=numpy.float32), \
+        numpy.asarray(faces, dtype=numpy.int32)]
+    
+    if use_cache:
+        try:
+            for cache_file, array in zip(cache_files, arrays):
+                # written to a temporary file first so that other
+                # processes never see a partially written file
+                tmp_file = cache_file + '.tmp'
+                with open(tmp_file, 'wb') as out:
+                    numpy.save(out, array)
+                os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            print 'could not cache %s: %s' % (filename, e)
+    
+    return arrays
+
+def unique_rows(rows):
+    """
+    Returns the indices of the first occurrences of the unique rows of
+    a 2D array and, for each row, the number of its unique row (in the
+    lexicographic order)
+    """
+    
+    # lexsort is stable: the first occurrence comes first in each group
+    order = numpy.lexsort(rows.T[::-1])
+    sorted_rows = rows[order]
+    is_first = numpy.concatenate(([True], \
+        numpy.any(sorted_rows[1:] != sorted_rows[:-1], 1)))
+    
+    inverse = numpy.empty(len(rows), dtype=int)
+    inverse[order] = numpy.cumsum(is_first) - 1
+    return order[is_first], inverse
+
 def remove_duplicate_faces(faces, verbose=False):
-    face_set = set([])
-    new_faces = []
-    for face in faces:
-        f = frozenset(face)
-        if f in face_set:
-            if verbose: print "WARNING: removed duplicate face %s" % face
-        else:
-            face_set.add(f)
-            new_faces.append(face)
-    return new_faces
+    """Removes the faces with the same vertices as an earlier face"""
+    
+    faces = numpy.asarray(faces)
+    if len(faces) == 0: return faces
+    
+    first, _ = unique_rows(numpy.sort(faces, 1))
+    keep = numpy.zeros(len(faces), dtype=bool)
+    keep[first] = True
+    
+    if verbose:
+        for face in faces[~keep]:
+            print "WARNING: removed duplicate face %s" % face
+    return faces[keep]
+
+# multipliers of the grid cell coordinates in cell_hash
+CELL_HASH_MULTIPLIERS = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9]
+
+def cell_hash(cells):
+    """
+    Hash keys (uint64) of integer grid cells (rows). The hash is linear, so
+    the key of cell + offset is cell_hash(cell) + cell_hash(offset)
+    """
+    cells = numpy.atleast_2d(cells).astype(numpy.int64).astype(numpy.uint64)
+    key = numpy.zeros(len(cells), dtype=numpy.uint64)
+    for coord in range(3):
+        key += cells[:,coord] * numpy.uint64(CELL_HASH_MULTIPLIERS[coord])
+    return key
+
+def matching_pairs(keys, queries, order=None):
+    """
+    All index pairs (i, j) such that keys[i] == queries[j]. The order
+    that sorts the keys can be given if known
+    """
+    
+    if order is None: order = numpy.argsort(keys)
+    sorted_keys = keys[order]
+    
+    begin = numpy.searchsorted(sorted_keys, queries, 'left')
+    counts = numpy.searchsorted(sorted_keys, queries, 'right') - begin
+    
+    group_start = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    rank = numpy.arange(numpy.sum(counts)) - group_start
+    return order[numpy.repeat(begin, counts) + rank], \
+        numpy.repeat(numpy.arange(len(queries)), counts)
+
+def weld_vertices(vertices, faces, tolerance):
+    """
+    Merges the vertices that are closer than tolerance to each other
+    (also through chains of such vertices) to the first one of them and
+    removes the faces that become degenerate. Returns the new vertices
+    and faces and the indices of the kept vertices
+    """
+    
+    vertices = numpy.asarray(vertices)
+    faces = numpy.asarray(faces)
+    n = len(vertices)
+    
+    # the close pairs are in the same or in neighboring grid cells.
+    # Hash collisions only add pairs that fail the distance test
+    cell_keys, cell = numpy.unique( \
+        cell_hash(numpy.floor(vertices / float(tolerance))), return_inverse=True)
+    cell_vertices = numpy.argsort(cell, kind='mergesort')
+    cell_count = numpy.bincount(cell)
+    cell_start = numpy.cumsum(cell_count) - cell_count
+    
+    offsets = [(x,y,z) for x in [0,1] for y in [-1,0,1] for z in [-1,0,1] \
+        if (x,y,z) >= (0,0,0)]
+    
+    pairs = []
+    for offset in offsets:
+        cell_a, cell_b = matching_pairs(cell_keys, \
+            cell_keys + cell_hash(offset)[0], numpy.arange(len(cell_keys)))
+        
+        # all pairs of the vertices of the two cells
+        n_pairs = cell_count[cell_a] * cell_count[cell_b]
+        rank = numpy.arange(numpy.sum(n_pairs)) - \
+            numpy.repeat(numpy.cumsum(n_pairs) - n_pairs, n_pairs)
+        count_b = numpy.repeat(cell_count[cell_b], n_pairs)
+        i = cell_vertices[numpy.repeat(cell_start[cell_a], n_pairs) + rank // count_b]
+        j = cell_vertices[numpy.repeat(cell_start[cell_b], n_pairs) + rank % count_b]
+        
+        # each pair of the same cell once
+        distinct = (i < j) if offset == (0,0,0) else (i != j)
+        close = distinct & \
+            (numpy.sum((vertices[i] - vertices[j])**2, 1) <= tolerance**2)
+        pairs.append((i[close], j[close]))
+    i = numpy.concatenate([numpy.zeros(0, dtype=int)] + [p[0] for p in pairs])
+    j = numpy.concatenate([numpy.zeros(0, dtype=int)] + [p[1] for p in pairs])
+    
+    # connected components: each vertex is labeled with the smallest
+    # vertex index of its component
+    labels = numpy.arange(n)
+    while True:
+        old_labels = labels.copy()
+        smaller = numpy.minimum(labels[i], labels[j])
+        numpy.minimum.at(labels, i, smaller)
+        numpy.minimum.at(labels, j, smaller)
+        labels = labels[labels]
+        if numpy.all(labels == old_labels): break
+    
+    # the first vertex of each component is kept, in the original order
+    kept = numpy.nonzero(labels == numpy.arange(n))[0]
+    new_index = numpy.zeros(n, dtype=int)
+    new_index[kept] = numpy.arange(len(kept))
+    vertex_map = new_index[labels]
+    
+    faces = vertex_map[faces]
+    degenerate = (faces[:,0] == faces[:,1]) | (faces[:,1] == faces[:,2]) | \
+        (faces[:,2] == faces[:,0])
+    
+    print 'welded %d vertices to %d, removed %d degenerate faces' % \
+        (len(vertices), len(kept), numpy.sum(degenerate))
+    
+    return vertices[kept], faces[~degenerate], kept
@@ -9,4 +9,5 @@ from implicit_surface import *
 from julia_sets import *
 from triangle_mesh import *
 from octree import *
+from mesh_bvh import *
 from distance_field import *
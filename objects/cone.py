@@ -21,6 +21,9 @@ class Cone(FixedConvexIntersection):
         rotation = Affine(linear=rotation_aligning_vectors((0,0,1), self.axis))
         scaling = Affine(scaling=(self.R, self.R, self.height))
         return rotation(scaling)
+    
+    def get_bounding_box(self):
+        return [[-1.0, 1.0], [-1.0, 1.0], [0.0, 1.0]]
 
 class ConeComponent(ConvexIntersection.Component):
     """Infinte cone"""
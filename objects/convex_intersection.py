@@ -1,7 +1,10 @@
 
 from tracer import Tracer
+import itertools
 import numpy
 
+_instance_ids = itertools.count()
+
 class ConvexIntersection(Tracer):
     """Intersection of convex objects represented by Components"""
     
@@ -9,6 +12,13 @@ class ConvexIntersection(Tracer):
         
         def __init__( self, pos = (0, 0, 0) ):
             Tracer.__init__(self, position=pos)
+        
+        def bounding_half_spaces(self):
+            """
+            List of half-spaces (normal, h), defined by dot(normal, x) <= h,
+            containing the component, in the coordinates of the intersection
+            """
+            return []
     
     # freeze template name
     def template_name(self):
@@ -51,6 +61,20 @@ class ConvexIntersection(Tracer):
     @property
     def convex(self):
         return True
+    
+    def get_bounding_box(self):
+        half_spaces = []
+        box = numpy.array([[-numpy.inf, numpy.inf]]*3)
+        
+        for c in self.components:
+            half_spaces += c.bounding_half_spaces()
+            c_box = c.get_bounding_box()
+            if c_box is not None:
+                c_box = numpy.array(c_box) + numpy.ravel(c.position)[:,numpy.newaxis]
+                box[:,0] = numpy.maximum(box[:,0], c_box[:,0])
+                box[:,1] = numpy.minimum(box[:,1], c_box[:,1])
+        
+        return polyhedron_bounding_box(half_spaces, box)
         
     def parameter_declarations(self):
         params = []
@@ -71,7 +95,7 @@ class UniqueConvexIntersection(ConvexIntersection):
     
     def __init__(self, origin, components):
         ConvexIntersection.__init__(self, origin, components)
-        self.unique_tracer_id = str(id(self))
+        self.unique_tracer_id = '_%d' % next(_instance_ids)
         
     def parameter_declarations(self):
         return []
@@ -118,3 +142,48 @@ class FixedConvexIntersection(UniqueConvexIntersection):
     def __init__(self, *args, **kwargs):
         UniqueConvexIntersection.__init__(self, *args, **kwargs)
         self.unique_tracer_id = ''
+
+def polyhedron_bounding_box(half_spaces, box=None):
+    """
+    Bounding box of the intersection of the given half-spaces (normal, h)
+    and an optional box with possibly infinite limits. Computed by
+    enumerating the vertices of the polyhedron. Returns None if unbounded.
+    """
+    
+    # infinite limits are replaced by a large box whose faces are
+    # detected among the vertices afterwards
+    BIG = 1e6
+    
+    if box is None: box = [[-numpy.inf, numpy.inf]]*3
+    box = numpy.clip(numpy.array(box, dtype=float), -BIG, BIG)
+    
+    normals = [numpy.ravel(n) for n, _ in half_spaces]
+    offsets = [h for _, h in half_spaces]
+    for i in range(3):
+        axis = numpy.zeros(3)
+        axis[i] = 1.0
+        normals += [-axis, axis]
+        offsets += [-box[i,0], box[i,1]]
+    
+    normals = numpy.array(normals)
+    offsets = numpy.array(offsets)
+    
+    triples = numpy.array([(i,j,k) \
+        for i in range(len(offsets)) \
+        for j in range(i+1, len(offsets)) \
+        for k in range(j+1, len(offsets))])
+    
+    mats = normals[triples]
+    regular = numpy.abs(numpy.linalg.det(mats)) > 1e-9
+    vertices = numpy.linalg.solve(mats[regular], \
+        offsets[triples[regular]][:,:,numpy.newaxis])[:,:,0]
+    
+    eps = 1e-6 * (1.0 + numpy.abs(offsets))
+    inside = numpy.all(numpy.dot(vertices, normals.T) <= offsets + eps, axis=1)
+    vertices = vertices[inside]
+    
+    if vertices.shape[0] == 0: return None
+    
+    bbox = [[numpy.min(vertices[:,i]), numpy.max(vertices[:,i])] for i in range(3)]
+    if numpy.max(numpy.abs(bbox)) >= BIG*0.5: return None
+    return bbox
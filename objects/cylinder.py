@@ -17,6 +17,9 @@ class Cylinder(FixedConvexIntersection):
         rotation = Affine(linear=rotation_aligning_vectors((0,0,1), self.axis))
         scaling = Affine(scaling=(self.R, self.R, self.height))
         return rotation(scaling)
+    
+    def get_bounding_box(self):
+        return [[-1.0, 1.0], [-1.0, 1.0], [0.0, 1.0]]
 
 class CylinderComponent(ConvexIntersection.Component):
     """Infinite cylinder"""
@@ -1,4 +1,7 @@
 from tracer import Tracer
+import itertools
+
+_instance_ids = itertools.count()
 
 class DistanceField(Tracer):
     
@@ -14,4 +17,10 @@ class DistanceField(Tracer):
         self.tracer_code = tracer_code.strip()
         self.normal_code = normal_code
         
-        self.unique_tracer_id = str(id(self))
+        # deterministic, so that the same scene gives the same program
+        self.unique_tracer_id = '_%d' % next(_instance_ids)
+        self.bndR = bndR
+    
+    def get_bounding_box(self):
+        if self.bndR is None: return None
+        return [[-self.bndR, self.bndR]]*3
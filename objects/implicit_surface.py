@@ -2,6 +2,128 @@
 # Tracer objects: Implicit surfaces
 
 from tracer import Tracer
+from cache import FileCache
+import itertools
+import json
+
+_instance_ids = itertools.count()
+
+# the code derived from the equations with sympy is cached on disk
+# (bump the version if the code generation changes)
+EQUATION_CODE_VERSION = 1
+EQUATION_CODE_CACHE_SIZE = 16 * 1024 * 1024
+_equation_code = {}
+
+def equation_code(eq):
+    """
+    OpenCL code of the implicit surface equation eq = 0 in ray coordinates:
+    (f, df, gradient), where f and its derivative along the ray, df, are
+    interval arithmetic expressions and gradient is a list of three
+    expressions
+    """
+    
+    if eq in _equation_code: return _equation_code[eq]
+    
+    cache = FileCache('implicit_surfaces', EQUATION_CODE_CACHE_SIZE)
+    key = cache.key(EQUATION_CODE_VERSION, eq)
+    data = cache.get(key)
+    
+    if data is not None:
+        f, df, gradient = json.loads(data.decode('utf-8'))
+        code = (f, df, gradient)
+    else:
+        code = derive_equation_code(eq)
+        cache.put(key, json.dumps(code).encode('utf-8'))
+    
+    _equation_code[eq] = code
+    return code
+
+def derive_equation_code(eq):
+    """The uncached equation_code, uses sympy"""
+    
+    import sympy
+    import sympy.core.numbers
+    
+    xyz = sympy.symbols('x y z')
+    t = sympy.symbols('t')
+    ray = sympy.symbols('ray_x ray_y ray_z')
+    origin = sympy.symbols('origin_x origin_y origin_z')
+    pos = sympy.symbols('pos.x pos.y pos.z')
+    
+    eq = sympy.sympify(eq)
+    
+    ray_paramd = eq.subs([
+        (xyz[i], ray[i]*t + origin[i]) \
+        for i in range(3) ])
+        
+    pos_eq = eq.subs([(xyz[i], pos[i]) for i in range(3)])
+    
+    gradient = [sympy.diff(pos_eq, pos[i]) for i in range(3)]
+    derivative = sympy.diff(ray_paramd, t)
+    
+    # Must replace some expressions to make them OpenCL
+    class Printer(sympy.printing.str.StrPrinter):
+        def _print_Pow(self, expr):
+            return print_pow(expr, self._print)
+    
+    # Print as an interval arithmetic macro expression
+    class IAPrinter(sympy.printing.str.StrPrinter):
+        
+        def _print_Float(self, expr):
+            return "%gf" % expr
+        
+        def _print_Pow(self, expr):
+            base = expr.args[0]
+            exponent = expr.args[1]
+            return "ia_pow%d(%s)" % (int(exponent), self._print(base))
+            
+        
+        def _print_mul_rec(self, args):
+            
+            a = args[0]
+            b = args[1]
+            
+            if b.is_number:
+                a, b = b, a
+            
+            if len(args) > 2:
+                bstr = self._print_mul_rec(args[1:])
+            else:
+                bstr = self._print(b)
+            
+            if a.is_number: 
+                if b.is_number:
+                    return "((%s)*(%s))" % (self._print(a), self._print(b))
+                
+                if a >= 0:
+                    return "ia_mul_pos_exact(%s,%s)" % (bstr, self._print(a))
+                else:
+                    return "ia_mul_neg_exact(%s,%s)" % (bstr, self._print(a))
+            else:
+                return "ia_mul(%s,%s)" % (self._print(a), bstr)
+        
+        def _print_Mul(self, expr):
+            return self._print_mul_rec(expr.args)
+    
+    ia_printer = IAPrinter()
+    printer = Printer()
+    return (ia_printer.doprint(eq), ia_printer.doprint(derivative),
+        [printer.doprint(g) for g in gradient])
+
+def print_pow(expr, to_str=str):
+    "Print sympy pow expression in an OpenCL-friendly format"
+    
+    base = expr.args[0]
+    exponent = expr.args[1]
+    f = "pow"
+    if exponent.is_integer:
+        # pown was really slow on my gpu...
+        n = int(exponent)
+        if n > 0:
+            base_str = "("+to_str(base)+")"
+            return "("+('*'.join([base_str]*n))+")" 
+        
+    return "%s(%s,%s)" % (f, to_str(base), to_str(exponent))
 
 class ImplicitSurface(Tracer):
 
@@ -13,7 +135,8 @@ class ImplicitSurface(Tracer):
                 max_itr=1500, precision=0.001, self_intersection=True):
         
         Tracer.__init__(self, position=center, scaling=scale)
-        self.unique_tracer_id = str(id(self))
+        # deterministic, so that the same scene gives the same program
+        self.unique_tracer_id = '_%d' % next(_instance_ids)
         
         self.center = tuple(center)
         self.no_self_intersection = not self_intersection
@@ -21,111 +144,27 @@ class ImplicitSurface(Tracer):
         self.max_itr = max_itr
         self.bndR = bndR
         
-        import sympy
-        import sympy.core.numbers
-        
-        xyz = sympy.symbols('x y z')
-        t = sympy.symbols('t')
-        ray = sympy.symbols('ray_x ray_y ray_z')
-        origin = sympy.symbols('origin_x origin_y origin_z')
-        pos = sympy.symbols('pos.x pos.y pos.z')
-        
-        self.eq = sympy.sympify(eq)
-        
-        self.ray_paramd = self.eq.subs([
-            (xyz[i], ray[i]*t + origin[i]) \
-            for i in range(3) ])
-            
-        pos_eq = self.eq.subs([(xyz[i], pos[i]) for i in range(3)])
-        
-        self.gradient = [sympy.diff(pos_eq, pos[i]) for i in range(3)]
-        self.derivative = sympy.diff(self.ray_paramd, t)
-        
-        # Must replace some expressions to make them OpenCL
-        class Printer(sympy.printing.str.StrPrinter):
-            def _print_Pow(self, expr):
-                return ImplicitSurface.print_pow(expr)
+        self.f_ia_code, self.df_ia_code, self.gradient_code = \
+            equation_code(eq)
         
-        old_ptr = sympy.Basic.__str__
-        
-        sympy.Basic.__str__ = Printer().doprint
-        
-        # Print as an interval arithmetic macro expression
-        class IAPrinter(sympy.printing.str.StrPrinter):
-            
-            def _print_Float(self, expr):
-                return "%gf" % expr
-            
-            def _print_Pow(self, expr):
-                base = expr.args[0]
-                exponent = expr.args[1]
-                return "ia_pow%d(%s)" % (int(exponent), base)
-                
-            
-            def _print_mul_rec(self, args):
-                
-                a = args[0]
-                b = args[1]
-                
-                if b.is_number:
-                    a, b = b, a
-                
-                if len(args) > 2:
-                    bstr = self._print_mul_rec(args[1:])
-                else:
-                    bstr = str(b)
-                
-                if a.is_number: 
-                    if b.is_number:
-                        return "((%s)*(%s))" % (a, b)
-                    
-                    if a >= 0:
-                        return "ia_mul_pos_exact(%s,%s)" % (bstr, a)
-                    else:
-                        return "ia_mul_neg_exact(%s,%s)" % (bstr, a)
-                else:
-                    return "ia_mul(%s,%s)" % (a, bstr)
-            
-            def _print_Mul(self, expr):
-                return self._print_mul_rec(expr.args)
-                
-        sympy.Basic.__str__ = lambda self: IAPrinter().doprint(self)
         self.f_code = self.compute_f_code()
         self.df_code = self.compute_df_code()
-        
-        sympy.Basic.__str__ = lambda self: Printer().doprint(self)
-        self.gradient_code = [str(self.gradient[i]) for i in range(3)]
-        sympy.Basic.__str__ = old_ptr
-        
-        #print self.tracer_code
     
     # freeze template name
     def template_name(self):
         return 'ImplicitSurface'
     
+    def get_bounding_box(self):
+        if self.bndR is None: return None
+        return [[-self.bndR, self.bndR]]*3
+    
     def f_code_template(self):
         return None
         
     def compute_f_code(self):
         return """
-            f = %s;""" % str(self.eq)
+            f = %s;""" % self.f_ia_code
     
     def compute_df_code(self):
         return """
-            df = %s; """ % str(self.derivative)
-
-    @staticmethod
-    def print_pow(expr):
-        "Print sympy pow expression in an OpenCL-friendly format"
-        
-        base = expr.args[0]
-        exponent = expr.args[1]
-        f = "pow"
-        if exponent.is_integer:
-            # pown was really slow on my gpu...
-            n = int(exponent)
-            if n > 0:
-                base_str = "("+str(base)+")"
-                return "("+('*'.join([base_str]*n))+")" 
-            
-        return "%s(%s,%s)" % (f, base, exponent)
+            df = %s; """ % self.df_ia_code
@@ -1,9 +1,12 @@
 
 # Tracer objects: Implicit surfaces
 
+import itertools
 from tracer import Tracer
 from objects import ImplicitSurface
 
+_instance_ids = itertools.count()
+
 class QuaternionJuliaSet(ImplicitSurface):
     
     def __init__(self, c, julia_itr, *args, **argd):
@@ -26,6 +29,8 @@ class QuaternionJuliaSet2(Tracer):
     
     def __init__(self, c, julia_itr, center=(0,0,0), scale=1.0, **kwargs):
         Tracer.__init__(self, position=center, scaling=scale)
+        # the parameters are written in the code
+        self.unique_tracer_id = '_%d' % next(_instance_ids)
         self.c = c
         self.julia_itr = julia_itr
         self.bndR = 4.0
@@ -36,6 +41,9 @@ class QuaternionJuliaSet2(Tracer):
         for (k, v) in kwargs.items():
             setattr(self, k, v)
     
+    def get_bounding_box(self):
+        return [[-self.bndR, self.bndR]]*3
+    
     @property
     def c_as_float4(self):
         return "(float4)%s" % (tuple(self.c),)
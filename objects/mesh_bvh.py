@@ -0,0 +1,291 @@
+from tracer import Tracer
+from triangle_mesh import cached_acceleration_structure
+import numpy
+
+class MeshBVH(Tracer):
+    """
+    A bounding volume hierarchy over the faces of a triangle mesh built
+    with the binned surface area heuristic (SAH). Unlike the Octree, the
+    tree adapts to uneven triangle densities.
+    
+    The serialized tree uses the same node layout as the scene BVH
+    (see bvh.ObjectBVH): a leaf is (first, count) in the face list and
+    an inner node is (first_child, 0) with the second child at
+    first_child+1. The node bounds are stored after the mesh vertices
+    (and normals) in the vector data.
+    """
+    
+    MAX_DEPTH = 48
+    
+    # number of bins per axis in the SAH split search
+    N_BINS = 16
+    
+    # bump if the build or the data layout changes (invalidates the cache)
+    DATA_VERSION = 1
+    
+    def __init__(self, triangle_mesh, max_faces_per_leaf=4):
+    
+        original_coordinates = triangle_mesh.coordinates
+        self.triangle_mesh = triangle_mesh
+        Tracer.__init__(self)
+        self.coordinates = original_coordinates
+        self.unique_tracer_id = triangle_mesh.unique_tracer_id
+        
+        if max_faces_per_leaf < 1:
+            raise RuntimeError("max_faces_per_leaf < 1")
+        self.max_faces_per_leaf = max_faces_per_leaf
+        
+        def build():
+            self.build()
+            return { 'node_bounds': self.node_bounds, 'nodes': self.nodes, \
+                'face_list': self.face_list, 'depth': self.depth }
+        
+        tree = cached_acceleration_structure(triangle_mesh, \
+            ['MeshBVH', self.DATA_VERSION, self.N_BINS, max_faces_per_leaf], \
+            build)
+        self.node_bounds = tree['node_bounds']
+        self.nodes = tree['nodes']
+        self.face_list = tree['face_list']
+        self.depth = int(tree['depth'])
+        
+        # the tree is stored after the mesh data, see get_data
+        self.node_bounds_offset = triangle_mesh.n_vertices
+        if triangle_mesh.normals is not None:
+            self.node_bounds_offset += triangle_mesh.n_vertices
+        self.face_list_offset = triangle_mesh.faces.size
+        self.node_data_offset = self.face_list_offset + len(self.face_list)
+    
+    @property
+    def auto_flip_normal(self):
+        return self.triangle_mesh.auto_flip_normal
+    
+    @property
+    def shading(self):
+        return self.triangle_mesh.shading
+    
+    @property
+    def coordinates(self):
+        return self.triangle_mesh.coordinates
+    
+    @coordinates.setter
+    def coordinates(self, var):
+        self.triangle_mesh.coordinates = var
+    
+    def _shallow_copy(self):
+        # the coordinates are stored in the triangle mesh
+        tracer = Tracer._shallow_copy(self)
+        tracer.triangle_mesh = self.triangle_mesh._shallow_copy()
+        return tracer
+    
+    def build(self):
+        """
+        Builds the tree one level at a time: the best split of every node
+        of the level is searched at once from the face bins, whose keys
+        are node*N_BINS + bin
+        """
+        
+        vertices = self.triangle_mesh.vertices.astype(numpy.float64)
+        triangles = numpy.dstack([vertices[self.triangle_mesh.faces[:,i], :] \
+            for i in range(3)])
+        face_min = numpy.min(triangles, -1)
+        face_max = numpy.max(triangles, -1)
+        centroids = (face_min + face_max) * 0.5
+        
+        n_bins = self.__class__.N_BINS
+        
+        node_bounds = []
+        node_data = []
+        face_list = []
+        n_listed_faces = 0
+        n_nodes = 0
+        n_leaves = 0
+        
+        # the faces of the nodes of the current level, sorted by node,
+        # and their bounding boxes and centroids in the same order
+        faces = numpy.arange(self.triangle_mesh.n_faces)
+        face_nodes = numpy.zeros(len(faces), dtype=int)
+        n_level_nodes = 1 if len(faces) > 0 else 0
+        depth = 0
+        
+        while n_level_nodes > 0:
+        
+            counts = numpy.bincount(face_nodes, minlength=n_level_nodes)
+            starts = numpy.cumsum(counts) - counts
+            
+            bmin, bmax = segment_bounds(face_min, face_max, \
+                face_nodes, n_level_nodes, keys_sorted=True)
+            node_bounds.append(numpy.dstack((bmin, bmax)))
+            
+            is_leaf = counts <= self.max_faces_per_leaf
+            if depth == self.__class__.MAX_DEPTH - 1:
+                is_leaf[:] = True
+            
+            # search the best split of each inner node
+            cmin, cmax = segment_bounds(centroids, centroids, \
+                face_nodes, n_level_nodes, keys_sorted=True)
+            extent = cmax - cmin
+            scale = numpy.where(extent > 0, n_bins / numpy.maximum(extent, 1e-300), 0)
+            bins = ((centroids - cmin[face_nodes]) * scale[face_nodes]).astype(int)
+            bins = numpy.clip(bins, 0, n_bins-1)
+            
+            best_cost = numpy.empty(n_level_nodes)
+            best_cost[:] = numpy.inf
+            best_axis = numpy.zeros(n_level_nodes, dtype=int)
+            best_bin = numpy.zeros(n_level_nodes, dtype=int)
+            
+            for axis in range(3):
+                keys = face_nodes*n_bins + bins[:, axis]
+                bin_min, bin_max = segment_bounds(face_min, face_max, \
+                    keys, n_level_nodes*n_bins)
+                bin_counts = numpy.bincount(keys, \
+                    minlength=n_level_nodes*n_bins).reshape((-1, n_bins))
+                bin_min = bin_min.reshape((-1, n_bins, 3))
+                bin_max = bin_max.reshape((-1, n_bins, 3))
+                
+                # the split after bin i: bins 0...i are on the left side
+                left_cost = sweep_cost(bin_min, bin_max, bin_counts)
+                right_cost = sweep_cost(bin_min[:,::-1,:], bin_max[:,::-1,:], \
+                    bin_counts[:,::-1])[:,::-1]
+                cost = left_cost[:,:-1] + right_cost[:,1:]
+                
+                # both sides must have faces
+                left_counts = numpy.cumsum(bin_counts, 1)[:,:-1]
+                cost[(left_counts == 0) | (left_counts == counts[:,numpy.newaxis])] \
+                    = numpy.inf
+                
+                axis_bin = numpy.argmin(cost, 1)
+                axis_cost = cost[numpy.arange(n_level_nodes), axis_bin]
+                better = axis_cost < best_cost
+                best_cost[better] = axis_cost[better]
+                best_axis[better] = axis
+                best_bin[better] = axis_bin[better]
+            
+            # the faces of nodes whose centroids cannot be separated
+            # by the bins are split in two halves
+            rank = numpy.arange(len(faces)) - starts[face_nodes]
+            go_right = numpy.where(numpy.isinf(best_cost)[face_nodes],
+                rank >= counts[face_nodes] // 2,
+                bins[numpy.arange(len(faces)), best_axis[face_nodes]] > \
+                    best_bin[face_nodes])
+            
+            # leaves: (first, count) in the face list
+            leaf_faces = is_leaf[face_nodes]
+            leaf_counts = counts*is_leaf
+            leaf_first = n_listed_faces + numpy.cumsum(leaf_counts) - leaf_counts
+            face_list.append(faces[leaf_faces])
+            n_listed_faces += numpy.sum(leaf_counts)
+            
+            # inner nodes: (first_child, 0), the children of the level
+            # are numbered after the nodes of this level
+            split = ~is_leaf
+            split_rank = numpy.cumsum(split) - 1
+            first_child = n_nodes + n_level_nodes + 2*split_rank
+            node_data.append(numpy.where(is_leaf[:,numpy.newaxis],
+                numpy.column_stack((leaf_first, counts)),
+                numpy.column_stack((first_child, numpy.zeros(n_level_nodes, dtype=int)))))
+            
+            n_leaves += numpy.sum(is_leaf)
+            n_nodes += n_level_nodes
+            
+            remaining = numpy.nonzero(~leaf_faces)[0]
+            face_nodes = 2*split_rank[face_nodes[remaining]] + go_right[remaining]
+            order = numpy.argsort(face_nodes, kind='mergesort')
+            remaining = remaining[order]
+            
+            face_nodes = face_nodes[order]
+            faces = faces[remaining]
+            face_min = face_min[remaining]
+            face_max = face_max[remaining]
+            centroids = centroids[remaining]
+            
+            n_level_nodes = 2*numpy.sum(split)
+            depth += 1
+        
+        self.depth = depth
+        print 'mesh BVH: %d nodes, %d leaves, depth %d' % \
+            (n_nodes, n_leaves, depth)
+        if n_nodes > 0:
+            self.node_bounds = numpy.vstack(node_bounds)
+            self.nodes = numpy.vstack(node_data)
+        else:
+            self.node_bounds = numpy.zeros((0, 3, 2))
+            self.nodes = numpy.zeros((0, 2), dtype=int)
+        self.face_list = numpy.concatenate([[]] + face_list).astype(int)
+    
+    @property
+    def n_nodes(self):
+        return self.nodes.shape[0]
+    
+    def get_data(self):
+        mesh_data = self.triangle_mesh.get_data()
+        
+        # rows 2*i and 2*i+1 are the minimum and maximum corners of node i
+        bounds = numpy.transpose(self.node_bounds, (0, 2, 1)).reshape((-1, 3))
+        
+        mesh_data['vector'] = numpy.vstack([mesh_data['vector'], bounds])
+        mesh_data['integer'] = numpy.concatenate([
+            numpy.ravel(mesh_data['integer']),
+            self.face_list,
+            numpy.ravel(self.nodes)
+        ])
+        
+        return mesh_data
+    
+    def get_bounding_box(self):
+        return self.triangle_mesh.get_bounding_box()
+    
+    def parameter_declarations(self):
+        return [
+            'int n_vertices',
+            'int n_triangles',
+            'int n_nodes',
+            'int node_bounds_offset',
+            'int face_list_offset',
+            'int node_data_offset']
+    
+    def parameter_values(self):
+        return [
+            self.triangle_mesh.n_vertices,
+            self.triangle_mesh.n_faces,
+            self.n_nodes,
+            self.node_bounds_offset,
+            self.face_list_offset,
+            self.node_data_offset]
+
+def segment_bounds(box_min, box_max, keys, n_keys, keys_sorted=False):
+    """
+    Bounding boxes of the boxes with the same key. Returns the minimum
+    and maximum corners as (n_keys, 3) arrays, empty keys get +inf/-inf
+    """
+    
+    bmin = numpy.empty((n_keys, 3))
+    bmax = numpy.empty((n_keys, 3))
+    bmin[:] = numpy.inf
+    bmax[:] = -numpy.inf
+    if len(keys) == 0: return bmin, bmax
+    
+    if not keys_sorted:
+        order = numpy.argsort(keys, kind='mergesort')
+        keys, box_min, box_max = keys[order], box_min[order], box_max[order]
+    starts = numpy.nonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))[0]
+    
+    bmin[keys[starts]] = numpy.minimum.reduceat(box_min, starts)
+    bmax[keys[starts]] = numpy.maximum.reduceat(box_max, starts)
+    return bmin, bmax
+
+def sweep_cost(bin_min, bin_max, bin_counts):
+    """
+    SAH cost (number of faces times half surface area) of bins 0...i
+    for each i, computed for all nodes (rows) at once
+    """
+    
+    extent = numpy.maximum.accumulate(bin_max, 1) - \
+        numpy.minimum.accumulate(bin_min, 1)
+    n = numpy.cumsum(bin_counts, 1)
+    
+    # empty prefixes have infinite extents
+    extent[n == 0] = 0
+    area = extent[...,0]*extent[...,1] + extent[...,1]*extent[...,2] + \
+        extent[...,2]*extent[...,0]
+    
+    return area * n
@@ -1,27 +1,50 @@
 from tracer import Tracer
+from triangle_mesh import cached_acceleration_structure
 import numpy
 
 class Octree(Tracer):
     
     MAX_DEPTH=7
     
+    # bump if the build or the data layout changes (invalidates the cache)
+    DATA_VERSION = 1
+    
     def __init__(self, triangle_mesh, max_depth=3, max_faces_per_leaf=5):
         
         original_coordinates = triangle_mesh.coordinates
         self.triangle_mesh = triangle_mesh
         Tracer.__init__(self)
         self.coordinates = original_coordinates
+        self.unique_tracer_id = triangle_mesh.unique_tracer_id
         
         self.max_depth = max_depth
         self.max_faces_per_leaf = max_faces_per_leaf
         if self.max_depth >= self.__class__.MAX_DEPTH:
             raise RuntimeError("max_depth >= MAX_DEPTH")
-        self.build()
+        
+        self.center, self.size = self.triangle_mesh.get_bounding_cube()
+        self.size *= 1.01
+        self.origin = numpy.array(self.center) - numpy.array([self.size*0.5]*3)
+        
+        def build_and_serialize():
+            self.build()
+            tree_data, root_data_offset = self.serialize()
+            return { 'tree_data': tree_data, 'root_data_offset': root_data_offset }
+        
+        tree = cached_acceleration_structure(triangle_mesh, \
+            ['Octree', self.DATA_VERSION, max_depth, max_faces_per_leaf], \
+            build_and_serialize)
+        self.tree_data = tree['tree_data']
+        self.root_data_offset = int(tree['root_data_offset'])
     
     @property
     def auto_flip_normal(self):
         return self.triangle_mesh.auto_flip_normal
     
+    @property
+    def shading(self):
+        return self.triangle_mesh.shading
+    
     @property
     def coordinates(self):
         return self.triangle_mesh.coordinates
@@ -30,131 +53,188 @@ class Octree(Tracer):
     def coordinates(self, var):
         self.triangle_mesh.coordinates = var
     
-    class Node:
+    def _shallow_copy(self):
+        # the coordinates are stored in the triangle mesh
+        tracer = Tracer._shallow_copy(self)
+        tracer.triangle_mesh = self.triangle_mesh._shallow_copy()
+        return tracer
+    
+    # the children of a node in the order of the serialized data
+    child_order = numpy.array([[x,y,z] for x in [0,1] for y in [0,1] for z in [0,1]])
+    
+    # maximum number of (node, face) pairs tested at once
+    CHUNK_SIZE = 2**16
+    
+    def build(self):
+        """
+        Builds the tree one level at a time. The faces of a node are
+        stored as (node, face) pairs and only the faces of a node are
+        tested against its children, so the memory use is linear in the
+        number of faces (times their average number of leaves)
+        """
         
-        child_order = [[x,y,z] for x in [0,1] for y in [0,1] for z in [0,1]]
+        faces = FaceBounds(self.triangle_mesh.vertices, self.triangle_mesh.faces)
         
-        def __init__(self, origin, size, parent = None, coordinates = [[0],[0],[0]]):
-            self.children = []
-            self.faces = []
-            self.origin = origin
-            self.size = size
-            self.coordinates = coordinates
-            self.parent = parent
+        # one entry per level: node origins, node size, the (node, face)
+        # pairs sorted by node and face, and which nodes are leaves
+        self.levels = []
         
-        def is_empty(self):
-            return len(self.faces) == 0
+        origins = self.origin[numpy.newaxis, :]
+        size = self.size
+        pair_nodes, pair_faces = faces.intersecting(origins, size, \
+            numpy.zeros((faces.n, 1), dtype=int), numpy.arange(faces.n), \
+            self.CHUNK_SIZE)
         
-        def is_leaf(self):
-            return len(self.children) == 0
+        n_leaves = 0
+        depth = 0
         
-        def get_bounding_sphere(self):
-            return self.center, numpy.sqrt(3)*self.size*0.5
-            
-        @property
-        def center(self):
-            return numpy.array([self.size*0.5]*3) + self.origin
+        while True:
         
-        def get_children(self):
-            if len(self.children) > 0: return self.children
-            for xyz in Octree.Node.child_order:
-                self.children.append(Octree.Node(\
-                    origin = self.origin + numpy.array(xyz)*0.5*self.size, \
-                    size = self.size*0.5, \
-                    parent = self,
-                    coordinates = \
-                        [self.coordinates[i] + [xyz[i]] for i in range(3)]))
-            return self.children
+            n_nodes = origins.shape[0]
+            smaller = faces.radii[pair_faces] < size*0.5
+            n_smaller_faces = numpy.bincount(pair_nodes[smaller], minlength=n_nodes)
+            
+            if depth == self.max_depth:
+                is_leaf = numpy.ones(n_nodes, dtype=bool)
+            else:
+                is_leaf = n_smaller_faces <= self.max_faces_per_leaf
+            
+            n_leaves += numpy.sum(is_leaf)
+            print 'depth:', depth, \
+                'active nodes:', n_nodes, \
+                'total leaves:', n_leaves, \
+                'active faces:', numpy.count_nonzero(numpy.bincount(pair_faces, minlength=faces.n))
+            
+            self.levels.append((origins, size, pair_nodes, pair_faces, is_leaf))
+            if numpy.all(is_leaf): break
+            
+            # children of the split nodes in the child order
+            split = numpy.nonzero(~is_leaf)[0]
+            child_offsets = Octree.child_order*0.5*size
+            origins = (origins[split, numpy.newaxis, :] + \
+                child_offsets[numpy.newaxis, :, :]).reshape((-1, 3))
+            size = size*0.5
+            
+            # the faces of a split node are tested against its children
+            split_rank = numpy.cumsum(~is_leaf) - 1
+            parent_pairs = numpy.nonzero(~is_leaf[pair_nodes])[0]
+            child_nodes = (split_rank[pair_nodes[parent_pairs]]*8)[:, numpy.newaxis] + \
+                numpy.arange(8)[numpy.newaxis, :]
+            
+            pair_nodes, pair_faces = faces.intersecting(origins, size, \
+                child_nodes, pair_faces[parent_pairs], self.CHUNK_SIZE // 8)
+            
+            # the faces of each parent were sorted, so sorting by node is enough
+            order = numpy.argsort(pair_nodes, kind='mergesort')
+            pair_nodes, pair_faces = pair_nodes[order], pair_faces[order]
+            
+            depth += 1
     
-    def build(self):
+    def serialize(self):
+        """
+        Serializes the octree data structure built by build(). Returns
+        the data and the offset of the root node. The data of each node
+        is stored after the data of its children (in the child order):
         
-        self.center, self.size = self.triangle_mesh.get_bounding_cube()
-        self.size *= 1.01
+            * a leaf: number of faces followed by the face indices
+            * an inner node: a (child mask, data offset) header for each
+              child, where an empty child is (0x100, -99999)
         
-        self.origin = numpy.array(self.center) - numpy.array([self.size*0.5]*3) 
-        self.root = Octree.Node(self.origin, self.size)
+        The header of the root node is stored last
+        """
         
-        face_centers, face_radii = face_bounding_spheres(\
-            self.triangle_mesh.vertices, self.triangle_mesh.faces)
+        EMPTY = [0x100, -99999]
         
-        face_normals, face_h = face_planes(\
-            self.triangle_mesh.vertices, self.triangle_mesh.faces)
+        # bottom-up: the sizes of the own data and the data of the subtree
+        # of each node, and the headers of the nodes
+        level_data = [None]*len(self.levels)
+        child_subtree_size = None
+        child_headers = None
         
-        self.leaves = []
+        for depth in reversed(range(len(self.levels))):
+            _, __, pair_nodes, pair_faces, is_leaf = self.levels[depth]
+            n_nodes = len(is_leaf)
+            
+            n_faces = numpy.bincount(pair_nodes, minlength=n_nodes)
+            own_size = numpy.where(n_faces > 0, n_faces + 1, 0)
+            subtree_size = own_size.copy()
+            header_mask = numpy.where(n_faces > 0, 0, EMPTY[0])
+            
+            split = numpy.nonzero(~is_leaf)[0]
+            if len(split) > 0:
+                # the child_mask bit is set for the non-leaf and
+                # non-empty children
+                child_is_set = child_headers[:, 0].reshape((-1, 8)) != EMPTY[0]
+                child_is_set |= ~self.levels[depth+1][4].reshape((-1, 8))
+                child_mask = numpy.sum(child_is_set << numpy.arange(8), 1)
+                
+                own_size[split] = numpy.where(child_mask != 0, 16, 0)
+                subtree_size[split] = own_size[split] + \
+                    child_subtree_size.reshape((-1, 8)).sum(1)
+                header_mask[split] = numpy.where(child_mask != 0, child_mask, EMPTY[0])
+            
+            level_data[depth] = (own_size, subtree_size, header_mask)
+            child_subtree_size = subtree_size
+            # the data offsets are filled in top-down below
+            child_headers = numpy.column_stack((header_mask, numpy.zeros(n_nodes, dtype=int)))
         
-        depth = 0
-        active_nodes = [self.root]
-        active_faces = range(self.triangle_mesh.n_faces)
+        # top-down: the start of the data of each subtree
+        tree_data = numpy.zeros(level_data[0][1][0] + 2, dtype=int)
+        starts = numpy.zeros(1, dtype=int)
+        headers = []
         
-        while len(active_nodes) > 0:
+        for depth in range(len(self.levels)):
+            _, __, pair_nodes, pair_faces, is_leaf = self.levels[depth]
+            own_size, subtree_size, header_mask = level_data[depth]
             
-            intersections, active_faces = all_intersections(\
-                active_nodes, active_faces, \
-                self.triangle_mesh.faces, self.triangle_mesh.vertices,
-                face_centers, face_radii, face_normals, face_h)
+            data_offsets = starts + subtree_size - own_size
+            header = numpy.column_stack((header_mask, data_offsets))
+            header[header_mask == EMPTY[0], 1] = EMPTY[1]
+            headers.append(header)
             
-            for node, face_idx in intersections:
-                node.faces.append(face_idx)
+            # leaves: number of faces and the face indices
+            leaf_data = is_leaf & (own_size > 0)
+            tree_data[data_offsets[leaf_data]] = own_size[leaf_data] - 1
+            pair_rank = numpy.arange(len(pair_nodes)) - \
+                numpy.searchsorted(pair_nodes, pair_nodes)
+            leaf_pairs = is_leaf[pair_nodes]
+            tree_data[data_offsets[pair_nodes[leaf_pairs]] + 1 + \
+                pair_rank[leaf_pairs]] = pair_faces[leaf_pairs]
             
-            new_active = []
-            for node in active_nodes:
-                n_smaller_faces = len([f for f in node.faces \
-                    if face_radii[f] < node.size*0.5])
-                
-                if n_smaller_faces <= self.max_faces_per_leaf \
-                        or depth == self.max_depth:
-                    self.leaves.append(node)
-                else:
-                    node.faces = []
-                    new_active += node.get_children()
+            split = numpy.nonzero(~is_leaf)[0]
+            if len(split) > 0:
+                child_subtree_size = level_data[depth+1][1].reshape((-1, 8))
+                starts = (starts[split, numpy.newaxis] + \
+                    numpy.cumsum(child_subtree_size, 1) - child_subtree_size).ravel()
+        
+        # inner node data: the headers of the children
+        for depth in range(len(self.levels)-1):
+            is_leaf = self.levels[depth][4]
+            own_size = level_data[depth][0]
+            data_offsets = headers[depth][:, 1]
             
-            print 'depth:', depth, \
-                'active nodes:', len(active_nodes), \
-                'total leaves:', len(self.leaves), \
-                'active faces:', len(active_faces)
+            split = numpy.nonzero(~is_leaf)[0]
+            child_headers = headers[depth+1].reshape((-1, 16))
+            has_data = own_size[split] > 0
             
-            active_nodes = new_active
-            depth += 1
+            indices = data_offsets[split[has_data], numpy.newaxis] + numpy.arange(16)
+            tree_data[indices] = child_headers[has_data]
         
+        tree_data[-2:] = headers[0][0]
+        return tree_data, len(tree_data) - 2
+    
     def get_data(self):
-        """serializes the octree data structure"""
-        
-        def write_node(node, tree_data):
-            child_mask = 0
-            if node.is_leaf():
-                if node.is_empty():
-                    return [0x100, -99999]
-                else:
-                    data = [len(node.faces)] + node.faces
-            else:
-                data = []
-                for i in range(len(node.children)):
-                    c = node.children[i]
-                    if c.is_empty() and c.is_leaf():
-                        node_header = [0x100, -99999]
-                    else:
-                        child_mask = child_mask | (0x1 << i)
-                        node_header = write_node(c, tree_data)
-                        #assert(node_header[0] != 0x100)
-                    data += node_header
-                if child_mask == 0: return [0x100, -99999]
-            data_offset = len(tree_data)
-            tree_data.extend(data)
-            return [child_mask, data_offset]
-        
-        tree_data = []
-        root_data = write_node(self.root, tree_data)
-        self.root_data_offset = len(tree_data)
-        tree_data.extend(root_data)
-        
         mesh_data = self.triangle_mesh.get_data()
         mesh_data['integer'] = numpy.concatenate([
             numpy.ravel(mesh_data['integer']),
-            tree_data
+            self.tree_data
         ])
         
         return mesh_data
     
+    def get_bounding_box(self):
+        return self.triangle_mesh.get_bounding_box()
+    
     @property
     def total_faces(self):
         return len(self.triangle_mesh.faces)
@@ -174,8 +254,8 @@ class Octree(Tracer):
             self.triangle_mesh.n_faces,
             self.root_data_offset,
             self.total_faces*3,
-            self.root.origin,
-            self.root.size]
+            self.origin,
+            self.size]
 
 def face_bounding_spheres(vertices, faces):
     triangles = numpy.dstack([vertices[faces[:,i], :] for i in range(3)])
@@ -198,36 +278,47 @@ def face_planes(vertices, faces):
     plane_h = numpy.sum(p0*normals,1)
     return (normals, plane_h)
 
-def all_intersections(active_nodes, active_faces, \
-    faces, vertices, \
-    face_centers, face_radii, \
-    face_normals, face_h):
-    
-    node_centers = []
-    node_radii = []
-    for node in active_nodes:
-        c, r = node.get_bounding_sphere()
-        node_centers.append(c)
-        node_radii.append(r)
-    node_centers = numpy.array(node_centers)
-    node_radii = numpy.array(node_radii)
-    
-    nc = numpy.transpose(node_centers[...,numpy.newaxis], (0,2,1))
-    fc = numpy.transpose(face_centers[...,numpy.newaxis], (2,0,1))
-    fn = numpy.transpose(face_normals[...,numpy.newaxis], (2,0,1))
-    
-    dist_mat = numpy.sqrt(numpy.sum((nc-fc)**2,2))
-    dist_mat = dist_mat - node_radii[:,numpy.newaxis] - face_radii[numpy.newaxis,:]
-    
-    dot_prod_mat = numpy.sum(nc*fn,2)
-    dist_mat = numpy.maximum(dist_mat, \
-        numpy.abs(dot_prod_mat - face_h[numpy.newaxis,:]) - node_radii[:,numpy.newaxis])
-    
-    isecs = numpy.transpose(numpy.nonzero(dist_mat < 0))
-    
-    isecs = [(active_nodes[ni], active_faces[fi])  for ni, fi in isecs]
+class FaceBounds:
+    """Bounding spheres and planes of the triangles of a mesh"""
     
-    any_intersections = numpy.any(dist_mat < 0, 0)
-    active_faces = numpy.array(active_faces)[any_intersections]
+    def __init__(self, vertices, faces):
+        centers, self.radii = face_bounding_spheres(vertices, faces)
+        normals, self.plane_h = face_planes(vertices, faces)
+        # one contiguous array per coordinate for fast indexing
+        self.centers = [numpy.ascontiguousarray(centers[:,i]) for i in range(3)]
+        self.normals = [numpy.ascontiguousarray(normals[:,i]) for i in range(3)]
+        self.n = faces.shape[0]
     
-    return (isecs, active_faces)
+    def intersecting(self, node_origins, node_size, node_idx, face_idx, chunk_size):
+        """
+        Finds the (node, face) pairs where the face may intersect the node:
+        the bounding sphere of the node intersects both the bounding sphere
+        and the plane of the face. Each face in face_idx is tested against
+        the nodes on the same row of the 2D array node_idx
+        """
+        
+        node_radius = numpy.sqrt(3)*node_size*0.5
+        node_centers = [numpy.ascontiguousarray(node_origins[:,i]) + node_size*0.5 \
+            for i in range(3)]
+        hits = numpy.zeros(node_idx.shape, dtype=bool)
+        
+        for begin in range(0, len(face_idx), chunk_size):
+            end = begin + chunk_size
+            n = node_idx[begin:end, :]
+            f = face_idx[begin:end, numpy.newaxis]
+            
+            sq_dist = 0
+            plane_dist = 0
+            for i in range(3):
+                nc = node_centers[i][n]
+                sq_dist = sq_dist + (nc - self.centers[i][f])**2
+                plane_dist = plane_dist + nc*self.normals[i][f]
+            
+            dist = numpy.sqrt(sq_dist) - node_radius - self.radii[f]
+            plane_dist = numpy.abs(plane_dist - self.plane_h[f])
+            dist = numpy.maximum(dist, plane_dist - node_radius)
+            
+            hits[begin:end, :] = dist < 0
+        
+        rows, cols = numpy.nonzero(hits)
+        return node_idx[rows, cols], face_idx[rows]
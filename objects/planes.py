@@ -32,6 +32,10 @@ class HalfSpaceComponent(ConvexIntersection.Component):
     def parameter_declarations(self):
         return ['float3 normal', 'float h']
     
+    def bounding_half_spaces(self):
+        n = numpy.array(self.normal)
+        return [(n, self.h + numpy.dot(n, self.position))]
+    
     n_subobjects = 1
 
 class LayerComponent(HalfSpaceComponent):
@@ -44,6 +48,11 @@ class LayerComponent(HalfSpaceComponent):
             h = h
         HalfSpaceComponent.__init__(self, axis, h)
     
+    def bounding_half_spaces(self):
+        n = numpy.array(self.normal)
+        d = numpy.dot(n, self.position)
+        return [(n, self.h + d), (-n, -d)]
+    
     n_subobjects = 2
 
 class ZLayerComponent(LayerComponent):
@@ -27,6 +27,9 @@ class Sphere(Tracer):
     def tracer_coordinate_system(self):
         return Affine(scaling=self.R)
     
+    def get_bounding_box(self):
+        return [[-1.0, 1.0]]*3
+    
     @property
     def convex(self):
         return True
@@ -48,3 +51,6 @@ class SphereComponent(ConvexIntersection.Component):
     def parameter_declarations(self):
         return ['float R']
     
+    def get_bounding_box(self):
+        return [[-self.R, self.R]]*3
+    
@@ -1,19 +1,31 @@
 from tracer import Tracer
 from utils import normalize
+from cache import FileCache, array_hash, cached_arrays
+from mesh_formats import weld_vertices
 import numpy
 
+ACCELERATION_STRUCTURE_CACHE_SIZE = 1024 * 1024 * 1024
+
 class TriangleMesh(Tracer):
     
     def __init__(self, vertices, faces, normals=None, \
                  center=(0,0,0), scale=1.0, \
                  auto_scale=False, auto_flip_normal=False,
-                 shading='flat', auto_smooth_normals=False):
+                 shading='flat', auto_smooth_normals=False,
+                 weld_tolerance=None):
         
         center = numpy.reshape(numpy.array(center), (1,3))
         
         self.vertices = to_vector_array(vertices)
         self.faces = to_vector_array(faces, dtype=numpy.int32)
         
+        if weld_tolerance is not None:
+            # merge coincident vertices (e.g., STL meshes share none)
+            self.vertices, faces, kept = \
+                weld_vertices(self.vertices, self.faces, weld_tolerance)
+            self.faces = to_vector_array(faces, dtype=numpy.int32)
+            if normals is not None: normals = numpy.asarray(normals)[kept]
+        
         if auto_scale:
             current_center, current_size = self.get_bounding_cube()
             self.vertices = self.vertices - current_center[numpy.newaxis,:]
@@ -82,6 +94,18 @@ class TriangleMesh(Tracer):
     def parameter_values(self):
         return [self.n_vertices, self.n_faces]
 
+def cached_acceleration_structure(triangle_mesh, key_parts, build):
+    """
+    The dictionary of arrays returned by build(), cached on disk with a key
+    of the vertices and faces of the mesh and key_parts (e.g., the name,
+    data version and build parameters of the acceleration structure)
+    """
+    
+    cache = FileCache('acceleration_structures', ACCELERATION_STRUCTURE_CACHE_SIZE)
+    key = cache.key(array_hash(triangle_mesh.vertices, triangle_mesh.faces), \
+        *key_parts)
+    return cached_arrays(cache, key, build)
+
 def to_vector_array(array_of_arrays, dtype=numpy.float32):
     vec_array = numpy.array(array_of_arrays, dtype=dtype)
     if len(vec_array.shape) != 2 or vec_array.shape[-1] != 3:
@@ -89,29 +113,27 @@ def to_vector_array(array_of_arrays, dtype=numpy.float32):
     return vec_array
 
 def generate_smooth_normals(vertices, faces):
+    """
+    The normal of a vertex is the average of the unit normals of the
+    faces around it
+    """
     
     print 'generating normals for', vertices.shape[0], 'vertices'
     
-    vertex_normals = [[] for _ in xrange(vertices.shape[0])]
+    v1, v2, v3 = [vertices[faces[:,j],:] for j in range(3)]
+    face_normals = normalize(numpy.cross(v2-v1, v3-v1))
     
-    print len(vertex_normals), 'vertices'
-    
-    normalize = lambda n: n / numpy.sqrt(numpy.sum(n**2))
-    
-    for i in range(faces.shape[0]):
-        face_vertices = faces[i,:]
-        v1,v2,v3 = [vertices[face_vertices[j],:] for j in range(3)]
-        
-        n = normalize(numpy.cross(v2-v1,v3-v1))
-        for v in face_vertices:
-            vertex_normals[v].append(n)
+    # each face adds its normal to its three vertices
+    vertex_idx = numpy.ravel(faces)
+    n_vertices = vertices.shape[0]
+    normals = numpy.column_stack([numpy.bincount(vertex_idx, \
+            weights=numpy.repeat(face_normals[:,c], 3), minlength=n_vertices) \
+        for c in range(3)])
+    normals = normalize(normals)
     
-    normals = numpy.ones(vertices.shape)
-    for i in range(normals.shape[0]):
-        if len(vertex_normals[i]) == 0:
-            print "WARNING: no normal for vertex", i
-            continue
-        avg_normal = numpy.mean(numpy.vstack(vertex_normals[i]),0)
-        normals[i,:] = normalize(avg_normal)
+    no_faces = numpy.bincount(vertex_idx, minlength=n_vertices) == 0
+    if numpy.any(no_faces):
+        print "WARNING: no normal for", numpy.sum(no_faces), "vertices"
+        normals[no_faces,:] = 1
     
     return normals
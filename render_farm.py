@@ -0,0 +1,333 @@
+"""
+Distributed rendering: a coordinator process hands out disjoint sample
+ranges to worker processes (see clray.py --coordinator and --worker) and
+merges the partial image sums they send back. If a worker fails, only its
+current sample range is lost and it is handed out again.
+
+The connections unpickle what they receive, so they are authenticated
+with a secret key that every farm must set (see farm_key).
+"""
+
+from multiprocessing.connection import Listener, Client, \
+    deliver_challenge, answer_challenge
+import numpy as np
+import threading
+import time
+import os
+
+DEFAULT_HOST = '127.0.0.1'
+
+# environment variable that holds the key if --farm_key is not given
+FARM_KEY_VARIABLE = 'CLRAY_FARM_KEY'
+
+def parse_address(address):
+    """'host:port' or 'port' -> (host, port), the default host is local"""
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+    else:
+        host, port = '', address
+    if host == '': host = DEFAULT_HOST
+    return (host, int(port))
+
+def farm_key(key=None):
+    """
+    The authentication key of the farm connections: key, or the contents
+    of the file key if it starts with '@', or the FARM_KEY_VARIABLE
+    environment variable. There is no default key
+    """
+    if key is None:
+        key = os.environ.get(FARM_KEY_VARIABLE)
+    if key is not None and key.startswith('@'):
+        with open(key[1:]) as f:
+            key = f.read().strip()
+    if not key:
+        raise RuntimeError('the render farm requires a secret key, ' + \
+            'set --farm_key or %s' % FARM_KEY_VARIABLE)
+    return key
+
+class FarmError(RuntimeError):
+    pass
+
+class _HandshakeConnection:
+    """
+    The parts of a Connection used by the authentication handshake, but
+    receiving times out
+    """
+    
+    def __init__(self, conn, timeout):
+        self.conn = conn
+        self.timeout = timeout
+    
+    def send_bytes(self, *args):
+        self.conn.send_bytes(*args)
+    
+    def recv_bytes(self, *args):
+        if not self.conn.poll(self.timeout):
+            raise FarmError('authentication timed out')
+        return self.conn.recv_bytes(*args)
+
+class Coordinator:
+    """
+    Accepts worker connections and merges their results. The image sum
+    and the number of merged samples are accessed through get_image
+    """
+    
+    # seeds of consecutive workers are this far apart
+    SEED_STRIDE = 65536
+    
+    # seconds a new connection has for authenticating
+    HANDSHAKE_TIMEOUT = 10.0
+    
+    def __init__(self, address, authkey, n_samples):
+        self.n_samples = n_samples
+        # the connections are authenticated by _serve, not by accept
+        self.listener = Listener(address)
+        self.authkey = authkey
+        
+        self.lock = threading.Condition()
+        self.next_sample = 0
+        # sample ranges of the failed workers, rendered again
+        self.returned_ranges = []
+        # number of ranges being rendered by the workers
+        self.n_in_flight = 0
+        self.image_sum = None
+        self.samples_merged = 0
+        
+        self.n_workers = 0
+        self.n_connected = 0
+        self.base_seed = np.random.randint(2**31 - 1000*self.SEED_STRIDE)
+    
+    def start(self):
+        thread = threading.Thread(target=self._accept_workers)
+        thread.daemon = True
+        thread.start()
+    
+    def _accept_workers(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                print 'failed to accept a connection: %r' % (e, )
+                continue
+            
+            # authenticated on its own thread so that a client that
+            # stalls the handshake does not block the others
+            thread = threading.Thread(target=self._serve, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+    
+    def _authenticate(self, conn):
+        handshake = _HandshakeConnection(conn, self.HANDSHAKE_TIMEOUT)
+        deliver_challenge(handshake, self.authkey)
+        answer_challenge(handshake, self.authkey)
+    
+    def _assign(self, n):
+        """
+        The next sample range to render, or None if all samples have
+        been merged. Waits while the only remaining ranges are being
+        rendered by other workers, since they may fail
+        """
+        with self.lock:
+            while True:
+                if len(self.returned_ranges) > 0:
+                    assigned = self.returned_ranges.pop(0)
+                    break
+                
+                n = min(n, self.n_samples - self.next_sample)
+                if n > 0:
+                    assigned = (self.next_sample, n)
+                    self.next_sample += n
+                    break
+                
+                if self.n_in_flight == 0: return None
+                self.lock.wait()
+            
+            self.n_in_flight += 1
+            return assigned
+    
+    def _merge(self, imgdata, n):
+        with self.lock:
+            if self.image_sum is None:
+                self.image_sum = imgdata.astype(np.float64)
+            else:
+                self.image_sum += imgdata
+            self.samples_merged += n
+            self.n_in_flight -= 1
+            self.lock.notify_all()
+    
+    def _return_range(self, assigned):
+        with self.lock:
+            self.returned_ranges.append(assigned)
+            self.n_in_flight -= 1
+            self.lock.notify_all()
+    
+    def _check_result(self, msg, assigned):
+        if len(msg) != 4:
+            raise FarmError('malformed result')
+        _, first, n, imgdata = msg
+        if assigned is None or (first, n) != assigned:
+            raise FarmError('result of samples %r, expected %r' % \
+                ((first, n), assigned))
+        if not isinstance(imgdata, np.ndarray):
+            raise FarmError('result is not an array')
+        with self.lock:
+            if self.image_sum is not None and \
+                    imgdata.shape != self.image_sum.shape:
+                raise FarmError('result has shape %r, expected %r' % \
+                    (imgdata.shape, self.image_sum.shape))
+        return imgdata, n
+    
+    def _serve(self, conn):
+        try:
+            self._authenticate(conn)
+        except Exception as e:
+            # e.g., a wrong key
+            print 'rejected a connection: %r' % (e, )
+            conn.close()
+            return
+        
+        with self.lock:
+            worker_id = self.n_workers
+            self.n_workers += 1
+            self.n_connected += 1
+        print 'worker %d connected' % worker_id
+        
+        assigned = None
+        try:
+            conn.send(('seed', self.base_seed + worker_id*self.SEED_STRIDE))
+            
+            while True:
+                msg = conn.recv()
+                if not isinstance(msg, tuple) or len(msg) == 0:
+                    raise FarmError('malformed message')
+                
+                if msg[0] == 'result':
+                    imgdata, n = self._check_result(msg, assigned)
+                    assigned = None
+                    self._merge(imgdata, n)
+                
+                elif msg[0] == 'request':
+                    if assigned is not None or len(msg) != 2:
+                        raise FarmError('unexpected request')
+                    assigned = self._assign(int(msg[1]))
+                    if assigned is None:
+                        conn.send(('done', ))
+                        break
+                    conn.send(('render', ) + assigned)
+                
+                else:
+                    raise FarmError('unknown message %r' % (msg[0], ))
+        
+        except Exception as e:
+            # any failure only loses the range of this worker
+            print 'worker %d failed: %r' % (worker_id, e)
+            if assigned is not None:
+                self._return_range(assigned)
+        finally:
+            conn.close()
+            with self.lock:
+                self.n_connected -= 1
+                self.lock.notify_all()
+    
+    def wait_for_samples(self, n_samples, timeout=None):
+        """
+        Wait until at least n_samples samples have been merged.
+        Returns the number of merged samples
+        """
+        with self.lock:
+            if self.samples_merged < n_samples:
+                self.lock.wait(timeout)
+            return self.samples_merged
+    
+    def lost_samples(self):
+        """
+        Number of samples in the returned ranges while no workers are
+        connected to render them
+        """
+        with self.lock:
+            if self.n_connected > 0: return 0
+            return sum([n for _, n in self.returned_ranges])
+    
+    def get_image(self):
+        """(image sum, number of samples) or (None, 0)"""
+        with self.lock:
+            if self.image_sum is None: return (None, 0)
+            return (self.image_sum.copy(), self.samples_merged)
+
+def run_coordinator(address, authkey, scene, samples_per_refresh, save_image, \
+        lost_timeout=60.0):
+    """
+    Merge the results of the workers until scene.samples_per_pixel samples
+    are done, calling save_image(imgdata) after each samples_per_refresh
+    merged samples. Gives up if the ranges of failed workers have had no
+    workers to render them for lost_timeout seconds
+    """
+    coordinator = Coordinator(address, authkey, scene.samples_per_pixel)
+    coordinator.start()
+    print 'waiting for workers at %s:%d' % address
+    
+    startup_time = time.time()
+    samples_saved = 0
+    lost_since = None
+    
+    while samples_saved < scene.samples_per_pixel:
+    
+        target = min(samples_saved + samples_per_refresh, scene.samples_per_pixel)
+        samples_done = coordinator.wait_for_samples(target, timeout=1.0)
+        
+        if samples_done < target:
+            n_lost = coordinator.lost_samples()
+            if n_lost == 0:
+                lost_since = None
+            elif lost_since is None:
+                lost_since = time.time()
+            elif time.time() - lost_since > lost_timeout:
+                print 'no workers left, %d samples lost' % n_lost
+                imgdata, samples_done = coordinator.get_image()
+                if samples_done > samples_saved: save_image(imgdata)
+                break
+            continue
+        
+        imgdata, samples_done = coordinator.get_image()
+        elapsed = time.time() - startup_time
+        
+        print '%d/%d,' % (samples_done, scene.samples_per_pixel), \
+            '%d workers,' % coordinator.n_workers,
+        print "elapsed: %.2f s" % elapsed
+        
+        save_image(imgdata)
+        samples_saved = samples_done
+
+def run_worker(address, authkey, renderer):
+    """Render the sample ranges given by the coordinator at address"""
+    
+    conn = Client(address, authkey=authkey)
+    
+    _, seed = conn.recv()
+    print 'worker seed', seed
+    np.random.seed(seed)
+    renderer.set_rng_seed(seed)
+    
+    last_image = renderer.get_image()
+    
+    while True:
+        conn.send(('request', renderer.samples_per_batch))
+        msg = conn.recv()
+        if msg[0] == 'done': break
+        
+        _, first, n = msg
+        
+        sample = first
+        while sample < first + n:
+            n_batch = min(renderer.samples_per_batch, first + n - sample)
+            renderer.render_sample(sample, n_batch)
+            sample += n_batch
+        
+        print 'rendered samples %d-%d' % (first, first+n-1)
+        
+        # send only the contribution of this sample range
+        image = renderer.get_image()
+        conn.send(('result', first, n, (image - last_image).astype(np.float32)))
+        last_image = image
+    
+    conn.close()
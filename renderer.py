@@ -1,11 +1,15 @@
 
 from accelerator import Accelerator
+from bvh import ObjectBVH
 import numpy as np
 import camera
 import utils
 import itertools
 import math
+import threading
+import time
 from cl_compiler import Compiler
+import checkpoint
 
 # pylint: disable-msg=W0201
 
@@ -21,16 +25,37 @@ class Renderer:
     """
     # TODO: refactor to better separated classes
     
+    # constant memory (bytes) left for the other constant arguments
+    # of the tracer kernels
+    CONSTANT_MEMORY_RESERVE = 1024
+    
     def get_image(self):
-        imgdata = self.img.get().astype(np.float32)
+        if self.adaptive_sampling:
+            imgdata = self._get_adaptive_image()
+        elif len(self.tiles) > 1:
+            imgdata = self.host_img
+        else:
+            imgdata = self._get_tile_image(self.n_pixels)
         img = np.empty(self.img_shape + (3,))
         img[self.image_order[:, 0], self.image_order[:, 1], :] = imgdata[..., 0:3]
         return img
         
+    def _get_tile_image(self, tile_n_pixels):
+        imgdata = self.img.get().astype(np.float32)
+        # sum the image slots of the samples in a batch
+        imgdata = imgdata[:tile_n_pixels*self.samples_per_batch]
+        return np.sum(imgdata.reshape((-1, tile_n_pixels, 4)), axis=0)
+    
+    def _get_adaptive_image(self):
+        # each pixel scaled to the total number of samples
+        count = np.maximum(self.pixel_count.get(), 1)
+        imgdata = self.pixel_sum.get().astype(np.float32)
+        return imgdata * (float(self.samples_rendered) / count)[:, np.newaxis]
+    
     def rays_per_sample(self):
         return self.img_shape[0]*self.img_shape[1]
     
-    def __init__(self, scene, args):
+    def __init__(self, scene, args, device=None):
         
         self.shader = scene.shader(scene)
         
@@ -38,15 +63,29 @@ class Renderer:
         self._group_objects()
         self._init_lights()
         
-        self.acc = Accelerator(args.choose_opencl_context)
+        self.acc = Accelerator(args.choose_opencl_context, args.asynchronous,
+            device)
         self._collect_tracer_data()
         self._init_misc()
         self._init_camera_and_image()
         self.ray_state = RayStateBuffers(self)
         self.shader.initialize_material_buffers(self.acc)
         
+        t0 = time.time()
         program_code = Compiler(self).make_program()
+        t1 = time.time()
         self.prog = self.acc.build_program(program_code, args.cl_build_options)
+        print 'code generation: %.2f s, compilation: %.2f s' % \
+            (t1 - t0, time.time() - t1)
+        
+        # identifies the renders that can be resumed from a checkpoint
+        self.scene_hash = checkpoint.scene_hash(program_code, self.scene_arrays)
+    
+    def output_profiling_info(self):
+        self.acc.output_profiling_info()
+    
+    def set_rng_seed(self, seed):
+        self.rng_seed = np.uint32(seed)
     
     def _group_objects(self):
         get_tracer_name = lambda obj: obj.tracer.tracer_kernel_name
@@ -81,10 +120,16 @@ class Renderer:
         self.vec_param_buf = np.zeros((self.max_broadcast_vecs, 4), dtype=np.float32)
         
         # Randomization init
+        if self.scene.quasirandom and self.scene.device_rng:
+            print 'quasirandom sampling uses host-side random numbers'
+            self.scene.device_rng = False
+        
+        self.rng_seed = np.uint32(np.random.randint(2**31))
         self.qdirs = camera.quasi_random_direction_sample(self.scene.samples_per_pixel)
         self.qdirs = np.random.permutation(self.qdirs)
     
-    def _init_camera_and_image(self):
+    def _camera_rays(self):
+        """Camera rays in the image order, also updates the camera basis"""
         scene = self.scene
         
         cam = self.scene.get_camera_rays()
@@ -92,16 +137,129 @@ class Renderer:
         fovx_rad = scene.camera_fov / 180.0 * np.pi
         self.pixel_angle = fovx_rad / scene.image.size[0]
         
+        return cam[self.image_order[:, 0], self.image_order[:, 1], 0:3]
+    
+    def _camera_params(self):
+        """
+        Camera basis, position and lens parameters for generating
+        the camera samples on the device
+        """
+        scene = self.scene
+        camera_params = np.zeros((5, 4))
+        camera_params[0:3, 0:3] = self.rotmat.transpose()
+        camera_params[3, 0:3] = scene.camera_position
+        camera_params[3, 3] = scene.camera_sharp_distance
+        camera_params[4, 0:2] = (self.pixel_angle, scene.camera_dof_fstop)
+        return camera_params
+    
+    def _init_camera_and_image(self):
+        scene = self.scene
+        
         self.img_shape = scene.image.size[::-1]
         self.n_pixels = self.img_shape[0] * self.img_shape[1]
         
         self.image_order = self.get_image_order()
         
-        cam = cam[self.image_order[:, 0], self.image_order[:, 1], 0:3]
+        cam = self._camera_rays()
+        self.scene_arrays += [cam, scene.camera_position, \
+            [scene.camera_sharp_distance, scene.camera_dof_fstop]]
+        
+        # the image is rendered in tiles that are contiguous ranges
+        # of the image order
+        self.tile_size = self._choose_tile_size()
+        self.tiles = [(begin, min(begin+self.tile_size, self.n_pixels)) \
+            for begin in range(0, self.n_pixels, self.tile_size)]
+        
+        self.samples_per_batch = self._choose_samples_per_batch()
+        self.n_rays = self.tile_size * self.samples_per_batch
+        
+        self.adaptive_sampling = scene.adaptive_sampling
+        if self.adaptive_sampling and (len(self.tiles) > 1 or not scene.device_rng):
+            print 'adaptive sampling requires device_rng and a single tile'
+            self.adaptive_sampling = False
         
         # Device buffers
-        self.cam = self.acc.make_vec3_array(cam)
-        self.img = self.acc.new_vec3_array((self.n_pixels, ))
+        if len(self.tiles) > 1:
+            print 'rendering in %d tiles of %d pixels' % \
+                (len(self.tiles), self.tile_size)
+            
+            # the camera rays are uploaded and the image is accumulated
+            # on the host one tile at a time
+            self.host_cam = np.zeros((self.n_pixels, 4), dtype=np.float32)
+            self.host_cam[:, 0:3] = cam
+            self.host_img = np.zeros((self.n_pixels, 4), dtype=np.float32)
+            self.cam = self.acc.new_vec3_array((self.tile_size, ))
+        else:
+            self.cam = self.acc.make_vec3_array(cam)
+        
+        # each ray of a batch has its own image slot so that
+        # the shaders can accumulate to it without atomics
+        self.img = self.acc.new_vec3_array((self.n_rays, ))
+        
+        if self.adaptive_sampling:
+            # per-pixel sums of the samples and their squared brightness,
+            # the image slots are cleared after each batch
+            self.pixel_sum = self.acc.new_vec3_array((self.n_pixels, ))
+            self.pixel_sum_sq = self.acc.new_array((self.n_pixels, ), np.float32, True)
+            self.pixel_count = self.acc.new_array((self.n_pixels, ), np.int32, True)
+            self.pixel_active = self.acc.new_array((self.n_pixels, ), np.int32, True)
+            self.active_pixels = self.acc.to_device( \
+                np.arange(self.n_pixels).astype(np.int32))
+            self.n_active_pixels = self.n_pixels
+        
+        self.samples_rendered = 0
+        
+        if scene.device_rng:
+            self.camera_params = self.acc.new_const_buffer(self._camera_params())
+    
+    # rough target for the number of rays in flight per compute unit
+    RAYS_PER_COMPUTE_UNIT = 16384
+    # approximate size of the ray state buffers and image slot per ray
+    BYTES_PER_RAY = 200
+    
+    def _max_device_rays(self):
+        """Number of rays whose state fits in the device memory"""
+        device = self.acc.device
+        # use at most a quarter of the device memory, the largest
+        # single buffers are the float3 arrays
+        return min(device.global_mem_size // 4 // self.BYTES_PER_RAY,
+            device.max_mem_alloc_size // 16)
+    
+    def _choose_tile_size(self):
+        """Number of pixels in a tile, limited by device memory"""
+        if self.scene.tile_size is not None:
+            size = self.scene.tile_size
+        else:
+            size = self._max_device_rays()
+        
+        if size >= self.n_pixels: return self.n_pixels
+        # whole 8x4 blocks of the image order
+        return max(size // 32 * 32, 32)
+    
+    def _choose_samples_per_batch(self):
+        """
+        Number of samples per pixel traced in one ray wavefront: enough
+        rays to keep the compute units busy, limited by device memory
+        """
+        scene = self.scene
+        
+        if not scene.device_rng:
+            # host-side random numbers are shared by all rays of a sample
+            return 1
+        
+        if scene.samples_per_batch is not None:
+            return scene.samples_per_batch
+        
+        target_rays = self.acc.device.max_compute_units * \
+            self.RAYS_PER_COMPUTE_UNIT
+        
+        k = int(math.ceil(float(target_rays) / self.tile_size))
+        k = min(k, self._max_device_rays() // self.tile_size,
+            scene.samples_per_pixel)
+        k = max(k, 1)
+        
+        print 'tracing %d samples per pixel in each batch' % k
+        return k
     
     def _init_lights(self):
         
@@ -127,44 +285,28 @@ class Renderer:
         data_sizes = { k : 0 for k in data_items }
         
         object_data_pointer_buffer = []
-        const_data_buffers = True
+        object_bounding_boxes = []
+        self.object_param_offsets = []
+        
+        # instances (see Tracer.instance) share the data of the original
+        # tracer: id(tracer) -> its vector and integer data offsets
+        shared_data_offsets = {}
         
         for obj in self.scene.objects:
             
-            if obj.tracer.has_data():
-                cur_data = obj.tracer.get_data()
+            object_bounding_boxes.append(obj.tracer.global_bounding_box())
+            
+            data_tracer = obj.tracer.instance_of or obj.tracer
+            shared_offsets = shared_data_offsets.get(id(data_tracer))
+            
+            if obj.tracer.has_data() and shared_offsets is None:
+                cur_data = data_tracer.get_data()
+                shared_data_offsets[id(data_tracer)] = \
+                    { k : data_sizes[k] for k in ['vector', 'integer'] }
             else:
                 cur_data = {}
-                
-            param_values_by_type = {}
-            local_param_offsets = []
-            
-            parameter_types = obj.tracer.parameter_types()
-            param_values = obj.tracer.parameter_values()
-            
-            # two affine transformations -> (3+1)*2 3-vectors
-            parameter_types += ['float3']*4
-            forward_affine = obj.tracer.global_to_tracer_coordinate_transform()
-            inverse_affine = forward_affine.inverse()
-            param_values += [
-                inverse_affine.linear[0,:],
-                inverse_affine.linear[1,:],
-                inverse_affine.linear[2,:],
-                inverse_affine.translation
-            ]
-            
-            for p_idx in range(len(parameter_types)):
-                cl_type = parameter_types[p_idx]
-                old = param_values_by_type.get(cl_type, [])
-                local_param_offsets.append(len(old))
-                param_values_by_type[cl_type] = old + [param_values[p_idx]]
-            
-            obj.tracer.local_param_offsets = local_param_offsets
-            
-            for cl_type, params in param_values_by_type.items():
-                param_type = 'param_' + cl_type
-                assert(param_type in data_items)
-                cur_data[param_type] = np.array(params)
+            
+            cur_data.update(self._object_parameters(obj))
             
             offset_buffer = []
             
@@ -172,7 +314,10 @@ class Renderer:
                 cur = cur_data.get(dtype)
                 n_data = data_sizes[dtype]
                 
-                offset_buffer.append(n_data)
+                if shared_offsets is not None and dtype in shared_offsets:
+                    offset_buffer.append(shared_offsets[dtype])
+                else:
+                    offset_buffer.append(n_data)
                 
                 if cur is not None:
                     if dtype in ['vector','param_float3']:
@@ -187,10 +332,15 @@ class Renderer:
                     data_sizes[dtype] = n_data
             
             object_data_pointer_buffer.append(offset_buffer)
+            self.object_param_offsets.append(dict(zip(data_items, offset_buffer)))
         
-        self.tracer_data_buffers = []
-        self.tracer_const_data_buffers = []
+        # host copies of the scene data, see scene_hash
+        self.scene_arrays = []
+        # parameter buffers by type and their host copies, see update_objects
+        self.param_buffers = {}
+        self.host_param_data = {}
         
+        host_data = {}
         for dtype in data_items:
             values = data[dtype]
             
@@ -205,7 +355,31 @@ class Renderer:
                     values = np.vstack(values)
                 else:
                     values = np.concatenate(values)
-                    
+                
+                self.scene_arrays.append(values)
+            
+            host_data[dtype] = values
+        
+        self.object_bounding_boxes = object_bounding_boxes
+        
+        if self.scene.object_bvh:
+            self.scene_bvh = ObjectBVH(object_bounding_boxes)
+            print 'scene BVH:', self.scene_bvh.n_nodes, 'nodes,', \
+                self.scene_bvh.n_bounded_objects, 'bounded and', \
+                len(self.scene_bvh.unbounded_objects), 'unbounded objects'
+        else:
+            self.scene_bvh = None
+        
+        self._choose_data_memory(host_data)
+        const_data_buffers = self.tracer_data_memory == '__constant'
+        
+        self.tracer_data_buffers = []
+        self.tracer_const_data_buffers = []
+        
+        for dtype in data_items:
+            values = host_data[dtype]
+            
+            if values is not None:
                 if dtype == 'vector':
                     if const_data_buffers:
                         values = self.acc.make_const_vec3_buffer(values)
@@ -217,14 +391,20 @@ class Renderer:
                     else:
                         values = self.acc.to_device(values.astype(np.int32))
                 elif dtype == 'param_float3':
+                    self.host_param_data[dtype] = values
                     values = self.acc.make_const_vec3_buffer(values)
                 elif dtype == 'param_float':
+                    self.host_param_data[dtype] = values
                     values = self.acc.new_const_buffer(values)
                 elif dtype == 'param_int':
+                    self.host_param_data[dtype] = values
                     values = self.acc.new_const_buffer(values, np.int32)
                 else:
                     assert(False)
                 
+                if dtype in self.host_param_data:
+                    self.param_buffers[dtype] = values
+                
             if dtype == 'vector':
                 buffers = self.tracer_data_buffers
             elif dtype == 'integer':
@@ -239,13 +419,194 @@ class Renderer:
                 assert(False)
             
             buffers.append(values)
+        
+        if self.scene_bvh is not None:
+            self.scene_bvh_buffers = (
+                self.acc.make_const_vec3_buffer(self.scene_bvh.bounds),
+                self.acc.new_const_buffer(self.scene_bvh.get_integer_data(), np.int32))
+    
+    def _choose_data_memory(self, host_data):
+        """
+        Places the object parameters (and the scene BVH) and the tracer
+        data in __constant memory if they fit in the constant buffer
+        limits of the device, and in __global memory otherwise. The
+        parameters are accessed by every ray, so they are placed first.
+        """
+        
+        def n_bytes(dtype, values):
+            if values is None: return 0
+            if dtype in ['vector', 'param_float3']:
+                return values.shape[0] * 4 * 4
+            return values.size * 4
+        
+        param_bytes = sum([n_bytes(k, host_data[k]) \
+            for k in ['param_float3', 'param_int', 'param_float']])
+        n_param_args = 3
+        if self.scene_bvh is not None:
+            param_bytes += n_bytes('vector', self.scene_bvh.bounds) + \
+                n_bytes('integer', self.scene_bvh.get_integer_data())
+            n_param_args += 2
+        
+        tracer_bytes = sum([n_bytes(k, host_data[k]) \
+            for k in ['vector', 'integer']])
+        n_tracer_args = 2
+        
+        device = self.acc.device
+        free_bytes = device.max_constant_buffer_size - \
+            self.__class__.CONSTANT_MEMORY_RESERVE
+        # the shadow kernels also take the broadcast vectors
+        free_args = device.max_constant_args - 1
+        
+        def choose(data_bytes, n_args):
+            if data_bytes <= free_bytes and n_args <= free_args:
+                return '__constant', free_bytes - data_bytes, free_args - n_args
+            return '__global', free_bytes, free_args
+        
+        self.param_data_memory, free_bytes, free_args = \
+            choose(param_bytes, n_param_args)
+        self.tracer_data_memory, free_bytes, free_args = \
+            choose(tracer_bytes, n_tracer_args)
+        
+        print 'object parameters: %.1f kB in %s memory' % \
+            (param_bytes / 1024.0, self.param_data_memory)
+        print 'tracer data: %.1f kB in %s memory' % \
+            (tracer_bytes / 1024.0, self.tracer_data_memory)
+    
+    def _object_parameters(self, obj):
+        """
+        Parameter values of the object grouped by type:
+        'param_' + OpenCL type -> array of values
+        """
+        
+        param_values_by_type = {}
+        local_param_offsets = []
+        
+        parameter_types = obj.tracer.parameter_types()
+        param_values = obj.tracer.parameter_values()
+        
+        # two affine transformations -> (3+1)*2 3-vectors
+        parameter_types += ['float3']*4
+        forward_affine = obj.tracer.global_to_tracer_coordinate_transform()
+        inverse_affine = forward_affine.inverse()
+        param_values += [
+            inverse_affine.linear[0,:],
+            inverse_affine.linear[1,:],
+            inverse_affine.linear[2,:],
+            inverse_affine.translation
+        ]
+        
+        for p_idx in range(len(parameter_types)):
+            cl_type = parameter_types[p_idx]
+            old = param_values_by_type.get(cl_type, [])
+            local_param_offsets.append(len(old))
+            param_values_by_type[cl_type] = old + [param_values[p_idx]]
+        
+        obj.tracer.local_param_offsets = local_param_offsets
+        
+        params = {}
+        for cl_type, values in param_values_by_type.items():
+            param_type = 'param_' + cl_type
+            assert(param_type in ['param_float3', 'param_int', 'param_float'])
+            params[param_type] = np.array(values)
+        return params
+    
+    # animation: the methods below update the scene on the device without
+    # recompiling the program. The image should be cleared after them
+    
+    def update_objects(self, objects=None):
+        """
+        Re-upload the parameters of the given objects (default: all),
+        including their position and orientation, after they have been
+        modified. The types of the parameters and the object data (e.g.,
+        triangle meshes) must not change
+        """
+        
+        if objects is None: objects = self.scene.objects
+        
+        for obj in objects:
+            offsets = self.object_param_offsets[self.scene.objects.index(obj)]
+            
+            for dtype, values in self._object_parameters(obj).items():
+                begin = offsets[dtype]
+                end = begin + len(values)
+                host = self.host_param_data[dtype]
+                if host[begin:end].shape != values.shape:
+                    raise RuntimeError('object parameters changed shape')
+                
+                host[begin:end] = values
+                self._upload_param_range(dtype, begin, end)
+            
+            idx = self.scene.objects.index(obj)
+            self.object_bounding_boxes[idx] = obj.tracer.global_bounding_box()
+        
+        if self.scene_bvh is not None:
+            # the shape of the tree only depends on the number of objects
+            self.scene_bvh = ObjectBVH(self.object_bounding_boxes)
+            bounds, integer_data = self.scene_bvh_buffers
+            self.acc.enqueue_copy(bounds, \
+                self._vec3_host_array(self.scene_bvh.bounds))
+            self.acc.enqueue_copy(integer_data, \
+                self.scene_bvh.get_integer_data().astype(np.int32))
+    
+    def _upload_param_range(self, dtype, begin, end):
+        values = self.host_param_data[dtype][begin:end]
+        if dtype == 'param_float3':
+            values = self._vec3_host_array(values)
+        elif dtype == 'param_int':
+            values = values.astype(np.int32)
+        else:
+            values = values.astype(np.float32)
+        
+        item_size = values.nbytes // (end - begin)
+        self.acc.enqueue_copy(self.param_buffers[dtype], values, \
+            device_offset=begin*item_size)
+    
+    def _vec3_host_array(self, vecs):
+        host = np.zeros((vecs.shape[0], 4), dtype=np.float32)
+        host[:, 0:3] = vecs
+        return host
+    
+    def update_camera(self):
+        """Re-upload the camera rays and parameters after modifying them"""
+        
+        scene = self.scene
+        cam = self._camera_rays()
+        
+        if len(self.tiles) > 1:
+            self.host_cam[:, 0:3] = cam
+        else:
+            self.acc.enqueue_copy(self.cam.data, self._vec3_host_array(cam))
+        
+        if scene.device_rng:
+            self.acc.enqueue_copy(self.camera_params, \
+                self._camera_params().astype(np.float32))
+    
+    def update_materials(self):
+        """Re-upload the material properties after modifying them"""
+        self.shader.update_material_buffers(self.acc)
+    
+    def clear_image(self):
+        """Start a new image, e.g., the next frame of an animation"""
+        
+        self.img.fill(0)
+        if len(self.tiles) > 1:
+            self.host_img[...] = 0
+        
+        if self.adaptive_sampling:
+            for buf in [self.pixel_sum, self.pixel_sum_sq, self.pixel_count]:
+                buf.fill(0)
+            self.acc.enqueue_copy(self.active_pixels.data, \
+                np.arange(self.n_pixels).astype(np.int32))
+            self.n_active_pixels = self.n_pixels
+        
+        self.samples_rendered = 0
 
     # helpers
     
     def _fill_vec(self, data, vec):
         hostbuf = np.float32(vec)
         self.acc.enqueue_copy(self.vec_broadcast, hostbuf)
-        self.acc.call('fill_vec_broadcast', self.n_pixels, (data, ), \
+        self.acc.call('fill_vec_broadcast', self.tile_n_pixels, (data, ), \
             value_args=(self.vec_broadcast, ))
 
     def new_camera_sample(self):
@@ -290,19 +651,98 @@ class Renderer:
         
         return cam_origin, mat4
 
-    def render_sample(self, sample_index):
+    def rng_params(self, sample_index, path_index):
+        return (self.tile_rng_seed, np.uint32(sample_index), np.uint32(path_index))
+
+    def render_sample(self, sample_index, n_samples=1):
+        """
+        Render samples sample_index, ..., sample_index+n_samples-1, where
+        n_samples is at most samples_per_batch
+        """
+        
+        assert n_samples <= self.samples_per_batch
+        
+        if self.adaptive_sampling and self.n_active_pixels == 0:
+            # all pixels have converged
+            self.samples_rendered += n_samples
+            return 0
+        
+        for tile_index in range(len(self.tiles)):
+            path_index = self._render_tile(tile_index, sample_index, n_samples)
+        
+        self.samples_rendered += n_samples
+        if self.adaptive_sampling:
+            self._update_active_pixels(n_samples)
+        
+        return path_index
     
-        scene = self.scene
+    def _update_active_pixels(self, n_samples):
+        """
+        Add the samples of the last batch to the per-pixel sums and
+        list the pixels whose error estimate is still too large
+        """
+        
         acc = self.acc
+        scene = self.scene
+        
+        acc.call('accumulate_pixel_samples', self.n_active_pixels, \
+            (self.img, self.active_pixels, self.pixel_sum, \
+             self.pixel_sum_sq, self.pixel_count),
+            value_args=(np.int32(self.n_active_pixels), np.int32(n_samples)))
+        self.img.fill(0)
+        
+        acc.call('select_active_pixels', self.n_pixels, \
+            (self.pixel_sum, self.pixel_sum_sq, self.pixel_count, \
+             self.pixel_active),
+            value_args=(np.float32(scene.adaptive_max_error), \
+                np.int32(scene.adaptive_min_samples)))
+        
+        # one blocking readback of the number of active pixels per batch
+        self.n_active_pixels = acc.find_non_negative(self.pixel_active, \
+            self.active_pixels, self.n_pixels)
+        
+        print 'active pixels: %d/%d' % (self.n_active_pixels, self.n_pixels)
     
-        cam_origin, mat4 = self.new_camera_sample()
+    def _render_tile(self, tile_index, sample_index, n_samples):
+    
+        scene = self.scene
+        acc = self.acc
         
-        acc.enqueue_copy(self.vec_broadcast,  mat4.astype(np.float32))
-        acc.call('subsample_transform_camera', self.n_pixels, \
-            (self.cam, self.ray_state.ray, self.ray_state.pixel), \
-            value_args=(self.vec_broadcast,))
+        begin, end = self.tiles[tile_index]
+        self.tile_n_pixels = end - begin
+        if self.adaptive_sampling:
+            # the camera rays are generated for the active pixels only
+            self.tile_n_pixels = self.n_active_pixels
+        n_rays = self.tile_n_pixels * n_samples
+        
+        # the ray indices are only unique within a tile
+        self.tile_rng_seed = np.uint32( \
+            (int(self.rng_seed) ^ (tile_index * 0x9E3779B9)) & 0xFFFFFFFF)
+        
+        if len(self.tiles) > 1:
+            acc.enqueue_copy(self.cam.data, self.host_cam[begin:end])
+            self.img.fill(0)
+        
+        if scene.device_rng:
+            pixel_params = (np.int32(self.tile_n_pixels), )
+            if self.adaptive_sampling:
+                pixel_params += (self.active_pixels.data, )
+            
+            acc.call('subsample_transform_camera', n_rays, \
+                (self.cam, self.ray_state.ray, self.ray_state.pixel, \
+                 self.ray_state.pos), \
+                value_args=(self.camera_params, ) + \
+                    self.rng_params(sample_index, 0)[:2] + pixel_params)
+        else:
+            cam_origin, mat4 = self.new_camera_sample()
+            
+            acc.enqueue_copy(self.vec_broadcast,  mat4.astype(np.float32))
+            acc.call('subsample_transform_camera', self.tile_n_pixels, \
+                (self.cam, self.ray_state.ray, self.ray_state.pixel), \
+                value_args=(self.vec_broadcast,))
+            
+            self._fill_vec(self.ray_state.pos, cam_origin)
         
-        self._fill_vec(self.ray_state.pos, cam_origin)
         self.ray_state.whichobject.fill(0)
         #self.ray_state.normal.fill(0)
         self.ray_state.raycolor.fill(1)
@@ -312,8 +752,14 @@ class Renderer:
         
         path_index = 0
         
-        self.shader.init_sample(self)
-        self.cur_n_pixels = self.n_pixels
+        self.cur_n_pixels = n_rays
+        self.shader.init_sample(self, sample_index)
+        
+        # pending readbacks of the number of active rays and the fraction
+        # of active rays in the list, see _compact_rays
+        self._ray_count_reads = []
+        self._last_compaction = -1
+        self._ray_occupancy = None
         
         for path_index in range(scene.max_bounces):
             if not self.compute_next_path_segment(sample_index, path_index, path_index == scene.max_bounces-1):
@@ -321,6 +767,9 @@ class Renderer:
     
         acc.finish()
         
+        if len(self.tiles) > 1:
+            self.host_img[begin:end] += self._get_tile_image(self.tile_n_pixels)
+        
         return path_index
 
     def compute_next_path_segment(self, sample_index, path_index, is_last):
@@ -335,20 +784,39 @@ class Renderer:
         self.ray_state.which_subobject, self.ray_state.last_which_subobject = \
           (self.ray_state.last_which_subobject, self.ray_state.which_subobject)
         
-        for tracer, count, offset in self.object_groups:
-            for object_index in range(offset, offset+count):
-                acc.call(tracer.tracer_kernel_name, self.cur_n_pixels, \
-                    self.ray_state.tracer_kernel_params() + \
-                    tuple(self.tracer_data_buffers),
-                    value_args=tuple(self.tracer_const_data_buffers) + \
-                        (np.int32(object_index+1),))
+        if self.scene_bvh is not None:
+            acc.call('scene_bvh_tracer_kernel', self.cur_n_pixels, \
+                self.ray_state.tracer_kernel_params() + \
+                tuple(self.tracer_data_buffers),
+                value_args=tuple(self.tracer_const_data_buffers) + \
+                    self.scene_bvh_buffers)
+        else:
+            for tracer, count, offset in self.object_groups:
+                if self.scene.group_tracer_kernels:
+                    ranges = [(offset, count)]
+                else:
+                    ranges = [(i, 1) for i in range(offset, offset+count)]
+                
+                for range_offset, range_count in ranges:
+                    acc.call(tracer.tracer_kernel_name, self.cur_n_pixels, \
+                        self.ray_state.tracer_kernel_params() + \
+                        tuple(self.tracer_data_buffers),
+                        value_args=tuple(self.tracer_const_data_buffers) + \
+                            (np.int32(range_offset+1), np.int32(range_count)))
+        
+        if self.scene.bin_rays:
+            self._bin_rays(path_index)
         
         for tracer, count, offset in self.object_groups:
+            normal_params = (np.int32(offset+1), np.int32(count))
+            if self.scene.bin_rays:
+                normal_params += (self.ray_state.bin_start.data, )
+            
             acc.call(tracer.normal_kernel_name, self.cur_n_pixels, \
                     self.ray_state.normal_kernel_params() + \
                     tuple(self.tracer_data_buffers),
                     value_args=tuple(self.tracer_const_data_buffers) + \
-                    (np.int32(offset+1), np.int32(count)))
+                    normal_params)
         
         if self.bidirectional:
             if path_index == 0:
@@ -381,27 +849,34 @@ class Renderer:
                         value_args=tuple(self.tracer_const_data_buffers) + \
                             (self.vec_broadcast, light_id1, np.int32(offset+1), np.int32(count)))
     
-        if self.scene.quasirandom and path_index == 1:
-            rand_vec = self.qdirs[sample_index, :]
-        else:
-            rand_vec = utils.normalize(np.random.normal(0, 1, (3, )))
+        if not self.scene.device_rng:
+            if self.scene.quasirandom and path_index == 1:
+                rand_vec = self.qdirs[sample_index % len(self.qdirs), :]
+            else:
+                rand_vec = utils.normalize(np.random.normal(0, 1, (3, )))
+                
+            rand_vec = np.array(rand_vec).astype(np.float32) 
+            rand_01 = np.float32(np.random.rand())
+            self.ray_state.prob[:self.cur_n_pixels].fill(rand_01)
             
-        rand_vec = np.array(rand_vec).astype(np.float32) 
-        rand_01 = np.float32(np.random.rand())
-        self.ray_state.prob[:self.cur_n_pixels].fill(rand_01)
+            self.vec_param_buf[0, :3] = rand_vec
+            self.vec_param_buf[1, :3] = np.random.normal(0, 1,( 3, ))
         
-        self.vec_param_buf[0, :3] = rand_vec
-        self.vec_param_buf[1, :3] = np.random.normal(0, 1,( 3, ))
-        # element 2 has color mask
         if self.bidirectional:
             self.vec_param_buf[3, :3] = light_point
             self.vec_param_buf[4, :3] = light_normal
             self.vec_param_buf[5, :3] = light_center
-        acc.enqueue_copy(self.vec_broadcast, self.vec_param_buf)
+        
+        # with device-side random numbers, the parameters only change
+        # once per sample, unless there are light points to sample
+        if not self.scene.device_rng or self.bidirectional or path_index == 0:
+            acc.enqueue_copy(self.vec_broadcast, self.vec_param_buf)
         
         constant_params = self.shader.material_buffers + [self.vec_broadcast]
         if self.bidirectional:
             constant_params = [light_id1, light_area, min_light_sampling_distance] + constant_params
+        if self.scene.device_rng:
+            constant_params += list(self.rng_params(sample_index, path_index))
         
         pipeline = ['volumetric', 'emission']
         if not is_last: pipeline += ['reflection', 'refraction', 'diffuse']
@@ -414,22 +889,106 @@ class Renderer:
         
         if not is_last:
             
-            russian_roulette_prob = np.float32(np.random.rand())
+            if self.scene.device_rng:
+                culler_params = self.rng_params(sample_index, path_index)
+            else:
+                culler_params = (np.float32(np.random.rand()), )
             
+            self.ray_state.n_active.fill(0)
             acc.call('culler', self.cur_n_pixels, \
-                (self.ray_state.pixel, self.ray_state.raycolor),
-                value_args=(russian_roulette_prob,),
+                (self.ray_state.pixel, self.ray_state.raycolor,
+                 self.ray_state.n_active),
+                value_args=culler_params,
                 work_group_size=(self.warp_size,))
             
-            self.cur_n_pixels = acc.find_non_negative(self.ray_state.pixel, \
-                self.ray_state.new_pixel, self.cur_n_pixels)
+            if self.scene.device_compaction:
+                if not self._compact_rays(path_index): return False
+            else:
+                self.cur_n_pixels = acc.find_non_negative(self.ray_state.pixel, \
+                    self.ray_state.new_pixel, self.cur_n_pixels)
+                
+                self.ray_state.pixel, self.ray_state.new_pixel = \
+                    [self.ray_state.new_pixel, self.ray_state.pixel]
+                
+                if self.cur_n_pixels == 0: return False
+            print '[', self.cur_n_pixels, ']',
+        
+        return True
+    
+    def _bin_rays(self, path_index):
+        """
+        Sort the ray list by the hit object on the device (see bin_rays_*
+        in static.cl) so that each normal kernel only processes its own
+        rays and the shader kernels see runs of the same material. The
+        culled rays are dropped from the list at the same time
+        """
+        
+        acc = self.acc
+        ray_state = self.ray_state
+        n_bins = np.int32(len(self.scene.objects) + 1)
+        
+        ray_state.bin_count.fill(0)
+        acc.call('bin_rays_count', self.cur_n_pixels, \
+            (ray_state.pixel, ray_state.whichobject, ray_state.bin_count))
+        acc.call('bin_rays_offsets', 1, \
+            (ray_state.bin_count, ray_state.bin_start), value_args=(n_bins, ))
+        
+        ray_state.new_pixel[:self.cur_n_pixels].view(np.int32).fill(-1)
+        acc.call('bin_rays_scatter', self.cur_n_pixels, \
+            (ray_state.pixel, ray_state.isec_dist, ray_state.whichobject,
+             ray_state.bin_count, ray_state.new_pixel, ray_state.new_isec_dist))
+        
+        ray_state.pixel, ray_state.new_pixel = \
+            [ray_state.new_pixel, ray_state.pixel]
+        ray_state.isec_dist, ray_state.new_isec_dist = \
+            [ray_state.new_isec_dist, ray_state.isec_dist]
+        
+        # equivalent to compacting after culling the previous segment
+        self._last_compaction = path_index - 1
+    
+    def _compact_rays(self, path_index):
+        """
+        Remove the culled rays from the ray list without waiting for the
+        device. The number of active rays is read back asynchronously and
+        used, when available, to shrink the launch size of the later path
+        segments. Returns False if no active rays are left
+        """
+        
+        acc = self.acc
+        
+        while len(self._ray_count_reads) > 0 and \
+              acc.is_complete(self._ray_count_reads[0][3]):
+            
+            read_path_index, launch_size, count, _ = self._ray_count_reads.pop(0)
+            count = int(count[0])
+            if count == 0: return False
             
-            self.ray_state.pixel, self.ray_state.new_pixel = \
-                [self.ray_state.new_pixel, self.ray_state.pixel]
+            self._ray_occupancy = float(count) / launch_size
             
-            if self.cur_n_pixels == 0: return False
-            print '[', self.cur_n_pixels, ']',
+            # after a compaction, the active rays are in the beginning
+            # of the list and their number never increases
+            if self._last_compaction >= read_path_index:
+                self.cur_n_pixels = min(self.cur_n_pixels, count)
+        
+        self._ray_count_reads.append((path_index, self.cur_n_pixels) + \
+            acc.start_read(self.ray_state.n_active))
+        
+        # the ray binning of the next segment compacts the list anyway
+        if self.scene.bin_rays:
+            return True
+        
+        # compacting is not worth it if most of the rays are still active
+        if self._ray_occupancy is not None and \
+           self._ray_occupancy > self.scene.compaction_occupancy_threshold:
+            return True
         
+        acc.compact_non_negative(self.ray_state.pixel, \
+            self.ray_state.new_pixel, self.cur_n_pixels)
+        
+        self.ray_state.pixel, self.ray_state.new_pixel = \
+            [self.ray_state.new_pixel, self.ray_state.pixel]
+        
+        self._last_compaction = path_index
         return True
         
     def get_image_order(self):
@@ -463,32 +1022,136 @@ class Renderer:
     def log_warp_size(self):
         return int(round(math.log(self.warp_size,2)))
 
+class MultiDeviceRenderer:
+    """
+    Renders the same scene on several OpenCL devices, each with its own
+    Renderer, program and buffers. The samples of each call to render_sample
+    are handed out to the devices in batches of their own size as they
+    finish the previous ones, so faster devices render more of them.
+    The images of the devices are summed on the host.
+    """
+    
+    # the samples of one call are split to roughly this many batches
+    # per device, which leaves room for load balancing
+    BATCHES_PER_DEVICE = 4
+    
+    def __init__(self, scene, args, devices):
+        self.renderers = []
+        for device in devices:
+            print 'initializing device', device.name
+            self.renderers.append(Renderer(scene, args, device))
+        
+        self.samples_per_batch = self.BATCHES_PER_DEVICE * \
+            sum([r.samples_per_batch for r in self.renderers])
+        self.samples_rendered = [0]*len(self.renderers)
+    
+    def get_image(self):
+        return sum([r.get_image() for r in self.renderers])
+    
+    def rays_per_sample(self):
+        return self.renderers[0].rays_per_sample()
+    
+    @property
+    def rng_seed(self):
+        return self.renderers[0].rng_seed
+    
+    @property
+    def scene_hash(self):
+        return self.renderers[0].scene_hash
+    
+    def set_rng_seed(self, seed):
+        for i in range(len(self.renderers)):
+            self.renderers[i].set_rng_seed(seed + i)
+    
+    def update_objects(self, objects=None):
+        for r in self.renderers: r.update_objects(objects)
+    
+    def update_camera(self):
+        for r in self.renderers: r.update_camera()
+    
+    def update_materials(self):
+        for r in self.renderers: r.update_materials()
+    
+    def clear_image(self):
+        for r in self.renderers: r.clear_image()
+    
+    def output_profiling_info(self):
+        for r, n in zip(self.renderers, self.samples_rendered):
+            print '---- device %s, %d samples' % (r.acc.device.name, n)
+            r.output_profiling_info()
+    
+    def render_sample(self, sample_index, n_samples=1):
+        """
+        Render samples sample_index, ..., sample_index+n_samples-1
+        """
+        
+        lock = threading.Lock()
+        next_sample = [sample_index]
+        end = sample_index + n_samples
+        depths = [0]*len(self.renderers)
+        errors = []
+        
+        def render_on_device(device_index):
+            renderer = self.renderers[device_index]
+            try:
+                while True:
+                    with lock:
+                        first = next_sample[0]
+                        n = min(renderer.samples_per_batch, end - first)
+                        next_sample[0] += n
+                    if n <= 0: break
+                    
+                    depths[device_index] = renderer.render_sample(first, n)
+                    self.samples_rendered[device_index] += n
+            except Exception as e:
+                errors.append(e)
+        
+        threads = [threading.Thread(target=render_on_device, args=(i,)) \
+            for i in range(len(self.renderers))]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        
+        if len(errors) > 0: raise errors[0]
+        return max(depths)
+
 class RayStateBuffers:
     def __init__(self, renderer):
-        n_pixels = renderer.n_pixels
+        n_rays = renderer.n_rays
         acc = renderer.acc
         self.bidirectional = renderer.bidirectional
         
-        self.whichobject = acc.new_array((n_pixels, ), np.uint32, True)
+        self.whichobject = acc.new_array((n_rays, ), np.uint32, True)
         self.which_subobject = acc.zeros_like(self.whichobject)
         self.last_whichobject = acc.zeros_like(self.whichobject)
         self.last_which_subobject = acc.zeros_like(self.whichobject)
-        self.pos = acc.new_vec3_array((n_pixels, ))
+        self.pos = acc.new_vec3_array((n_rays, ))
         self.ray = acc.zeros_like(self.pos)
         self.inside = acc.zeros_like(self.whichobject)
         self.normal = acc.zeros_like(self.pos)
-        self.isec_dist = acc.new_array((n_pixels, ), np.float32, True)
+        self.isec_dist = acc.new_array((n_rays, ), np.float32, True)
         self.diffusions_left = acc.zeros_like(self.whichobject)
         self.pixel = acc.zeros_like(self.whichobject)
         self.new_pixel = acc.zeros_like(self.whichobject)
+        self.n_active = acc.new_array((1, ), np.int32, True)
+        
+        if renderer.scene.bin_rays:
+            n_bins = len(renderer.scene.objects) + 1
+            self.new_isec_dist = acc.zeros_like(self.isec_dist)
+            self.bin_count = acc.new_array((n_bins, ), np.int32, True)
+            self.bin_start = acc.new_array((n_bins+1, ), np.int32, True)
         
         self.prob = acc.zeros_like(self.isec_dist)
-        self.raycolor = renderer.shader.new_ray_color_buffer(acc, (n_pixels, ))
-        self.pipeline_color = renderer.shader.new_ray_color_buffer(acc, (n_pixels, ))
+        self.raycolor = renderer.shader.new_ray_color_buffer(acc, (n_rays, ))
+        self.pipeline_color = renderer.shader.new_ray_color_buffer(acc, (n_rays, ))
+        
+        self.spectral = not renderer.shader.rgb
+        if self.spectral:
+            # index of the wavelength of each ray, see SpectrumShader
+            self.wavelength = acc.new_array((n_rays, ), np.int32, True)
         
         if self.bidirectional:
             self.shadow_mask = acc.zeros_like(self.isec_dist)
-            self.suppress_emission = acc.new_array((n_pixels, ), np.int32, True)
+            self.suppress_emission = acc.new_array((n_rays, ), np.int32, True)
     
     def tracer_kernel_params(self):
         return (self.pixel, self.pos, self.ray, \
@@ -512,6 +1175,8 @@ class RayStateBuffers:
             self.normal, self.isec_dist, self.pos, self.ray,
             self.raycolor, self.inside]
         
+        if self.spectral:
+            buffer_params += [self.wavelength]
         if self.bidirectional:
             buffer_params += [self.shadow_mask, self.suppress_emission]
         
@@ -1,9 +1,6 @@
 #!/bin/sh
 set -e
 
-rm -f out.raw.npy
-python clray.py "$@"
-while :
-do
-	python clray.py -a "$@"
-done
+# render until interrupted, see also clray.py --resume
+rm -f out.raw.npy out.checkpoint.npz
+python clray.py --continuous "$@"
@@ -56,3 +56,13 @@ class Scene:
         obj = Scene.Object(tracer, material, name)
         self.objects.append(obj)
         return obj
+    
+    def add_instance(self, obj, material=None, name=None, **affine_kwargs):
+        """
+        Adds a copy of an object (returned by add_object) moved by an affine
+        transformation, see Tracer.instance. The copies share the tracer
+        data on the device. The material defaults to that of the object.
+        """
+        if material is None: material = obj.material
+        return self.add_object(obj.tracer.instance(**affine_kwargs), \
+            material, name)
@@ -91,6 +91,43 @@ def default_settings(scene):
     scene.max_bounces = 4
     scene.min_russian_prob = 0.15
     
+    # Generate the random numbers on the device, separately for each ray,
+    # with a counter-based generator. Otherwise, all rays share the same
+    # random numbers on each path segment (required by quasirandom)
+    scene.device_rng = True
+    # Number of samples per pixel traced at once (requires device_rng).
+    # If None, chosen automatically from the device memory and compute units
+    scene.samples_per_batch = None
+    # Number of pixels rendered at once. If None, the whole image or as
+    # much as fits in the device memory
+    scene.tile_size = None
+    
+    # Adaptive sampling: stop sampling the pixels whose brightness has
+    # a relative standard error below adaptive_max_error after at least
+    # adaptive_min_samples samples (requires device_rng and one tile)
+    scene.adaptive_sampling = False
+    scene.adaptive_max_error = 0.02
+    scene.adaptive_min_samples = 16
+    
+    # Remove the culled rays from the ray list without reading the number
+    # of active rays back to the host after each bounce...
+    scene.device_compaction = True
+    # ...and skip the removal while the last measured fraction of active
+    # rays in the list is above this
+    scene.compaction_occupancy_threshold = 0.8
+    
+    # Sort the rays by the hit object after tracing so that the normal
+    # and shader kernels process coherent runs of rays. Costs three extra
+    # kernel calls per bounce, which pays off with many object types
+    scene.bin_rays = False
+    
+    # Trace rays through a bounding volume hierarchy over the objects
+    # instead of testing each object in a separate kernel call
+    scene.object_bvh = False
+    # Otherwise, trace all objects of the same type in a single kernel
+    # call (the alternative is one kernel call per object)
+    scene.group_tracer_kernels = True
+    
     # --- Default camera settings
     scene.camera_up = (0, 0, 1)
     scene.camera_fov = 55 # Field-of-view angle (horizontal)
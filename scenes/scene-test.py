@@ -40,6 +40,9 @@ def load_triangle_mesh(p, R, **kwargs):
 def load_triangle_mesh_in_octree(p, R, **kwargs):
     return Octree(load_triangle_mesh(p,R, **kwargs), max_depth=2, max_faces_per_leaf=1)
 
+def load_triangle_mesh_in_bvh(p, R, **kwargs):
+    return MeshBVH(load_triangle_mesh(p,R, **kwargs), max_faces_per_leaf=1)
+
 test_objects = [
     lambda p, R: Sphere(p,R),
     lambda p, R: Cone(p-numpy.array([0,0,R]), (0,0,1), R, R ),
@@ -71,7 +74,9 @@ test_objects = [
         LayerComponent( (1,0,0), 2.0*R ) ]),
     # Octree
     load_triangle_mesh_in_octree,
-    lambda p, R: DistanceField( tracer_code="dist = sqrt(x*x + y*y + z*z) - %g" % R, center=p )
+    lambda p, R: DistanceField( tracer_code="dist = sqrt(x*x + y*y + z*z) - %g" % R, center=p ),
+    # MeshBVH
+    load_triangle_mesh_in_bvh
 ]
 
 test_materials = [
@@ -41,7 +41,11 @@ class Shader:
         
         return properties
     
-    def init_sample(self, renderer):
+    def init_sample(self, renderer, sample_index):
+        pass
+    
+    def update_material_buffers(self, acc):
+        """Update the material buffers after modifying the materials"""
         pass
 
 class RgbShader(Shader):
@@ -81,11 +85,20 @@ class RgbShader(Shader):
         return acc.new_vec3_array(shape)
 
     def initialize_material_buffers(self, acc):
+        self.material_buffers = [acc.new_const_buffer(buf) \
+            for buf in self._material_buffer_data()]
+    
+    def update_material_buffers(self, acc):
+        for device_buffer, buf in zip(self.material_buffers, \
+                self._material_buffer_data()):
+            acc.enqueue_copy(device_buffer, buf.astype(np.float32))
+    
+    def _material_buffer_data(self):
         
         n_objects = len(self.scene.objects)
         p_buf_len = n_objects+1
         
-        self.material_buffers = []
+        buffers = []
         
         for color in [True, False]:
             
@@ -108,9 +121,9 @@ class RgbShader(Shader):
                     value = np.ones((3, ))*value[0]
                 buf[p_idx * p_buf_len + obj_idx, :value.size] = value
             
-            device_buffer = acc.new_const_buffer(buf)
-            
-            self.material_buffers.append(device_buffer)
+            buffers.append(buf)
+        
+        return buffers
     
 
 class SpectrumShader(Shader):
@@ -148,16 +161,35 @@ class SpectrumShader(Shader):
     def initialize_material_buffers(self, acc):
         
         spectrum = self.scene.spectrum
+        self.n_wavelengths = spectrum.resolution
+        
+        # the color response (RGB) of each wavelength
+        color_responses = spectrum.cie_1931_rgb().T
+        self.color_buffer = acc.make_const_vec3_buffer(color_responses)
+        
+        # the wavelengths are importance sampled on the device
+        self.wavelength_pdf = spectrum.visible_intensity()
+        self.wavelength_cdf = np.cumsum(self.wavelength_pdf)
+        self.wavelength_cdf /= self.wavelength_cdf[-1]
+        self.wavelength_buffers = [
+            acc.new_const_buffer(self.wavelength_cdf),
+            acc.new_const_buffer(self.wavelength_pdf)]
+        
+        self.device_material_buffer = None
+        self.update_material_buffers(acc)
+        self.device_material_buffer = \
+            acc.new_const_buffer(self.host_material_table)
+        
+        self.material_buffers = [self.device_material_buffer, self.color_buffer]
+    
+    def update_material_buffers(self, acc):
+        # the properties are tabulated at every wavelength of the
+        # spectrum and looked up on the device, see init_wavelengths
         
+        spectrum = self.scene.spectrum
         property_list = self.material_property_sets[0]
-        self.host_material_properties = []
-        
-        self.color_responses = spectrum.cie_1931_rgb()
         host_mat_y = []
         
-        self.color_intensity_pdf = spectrum.visible_intensity()
-        self.color_intensity_cdf = np.cumsum(self.color_intensity_pdf)
-            
         for _, __, value in self.each_object_material(property_list):
             
             y = np.ravel(np.array(value))
@@ -165,31 +197,23 @@ class SpectrumShader(Shader):
             
             host_mat_y.append( spectrum.map_left(x, y) )
         
-        self.host_mat_y = np.vstack(host_mat_y).astype(np.float32)
-        self.device_material_buffer = acc.new_const_buffer(self.host_mat_y[:, 0])
+        # one row of properties per wavelength
+        self.host_material_table = \
+            np.vstack(host_mat_y).T.astype(np.float32).copy()
+        self.n_material_scalars = self.host_material_table.shape[1]
         
-        self.material_buffers = [self.device_material_buffer]
+        if self.device_material_buffer is not None:
+            acc.enqueue_copy(self.device_material_buffer, \
+                self.host_material_table)
     
-    def init_sample(self, renderer):
-        
-        spectrum = self.scene.spectrum
-        
-        # importance sampling
-        omega = np.random.random()
-        wavelength = np.interp([omega], self.color_intensity_cdf, spectrum.wavelengths)
-        wavelength_prob = spectrum.map_right([wavelength], self.color_intensity_pdf)
+    def init_sample(self, renderer, sample_index):
         
-        #print wavelength, wavelength_prob
+        if renderer.scene.device_rng:
+            # a wavelength for each ray
+            sample_params = renderer.rng_params(sample_index, 0)[:2]
+        else:
+            sample_params = (np.float32(np.random.random()), )
         
-        renderer.ray_state.raycolor *= 1.0 / wavelength_prob
-        
-        wave_interp = lambda y: \
-            spectrum.map_right([wavelength], y).astype(np.float32)
-        
-        mat_props = wave_interp(self.host_mat_y)
-        renderer.acc.enqueue_copy(self.device_material_buffer, mat_props)
-        
-        color_mask = wave_interp(self.color_responses)
-        #print wavelength, color_mask
-        renderer.vec_param_buf[2, :3] = np.ravel(color_mask)
-    
+        renderer.acc.call('init_wavelengths', renderer.cur_n_pixels, \
+            (renderer.ray_state.wavelength, renderer.ray_state.raycolor), \
+            value_args=tuple(self.wavelength_buffers) + sample_params)
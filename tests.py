@@ -5,6 +5,29 @@ import numpy.random
 
 import transformations
 from transformations import Affine
+from bvh import ObjectBVH
+from objects import TriangleMesh, MeshBVH, QuaternionJuliaSet2
+from checkpoint import Checkpoint
+from imgutils import BackgroundWriter
+from cache import FileCache
+from render_farm import Coordinator
+from multiprocessing.connection import Client
+import mesh_formats
+import os, tempfile
+
+try:
+    from cl_compiler import collect_tracer_kernels, template_env
+    from scene import Scene
+    code_generation = True
+except ImportError:
+    # Jinja2 or PyOpenCL missing
+    code_generation = False
+
+try:
+    import accelerator
+except ImportError:
+    # PyOpenCL missing
+    accelerator = None
 
 EPSILON = 1e-9
 
@@ -83,6 +106,489 @@ class TestAffine(unittest.TestCase):
         mat0 = transformations.rotation_aligning_vectors(vec1, vec1)
         self.assertTrue( Affine(linear=mat0).is_identity() )
     
+class TestObjectBVH(unittest.TestCase):
+    
+    def randomBoxes(self, n):
+        centers = numpy.random.normal(size=(n,3))
+        sizes = numpy.random.uniform(0.1, 1.0, size=(n,3))
+        return [(centers[i]-sizes[i], centers[i]+sizes[i]) for i in range(n)]
+    
+    def test_all_objects_in_leaves(self):
+        boxes = self.randomBoxes(37)
+        boxes[5] = None
+        boxes[20] = None
+        
+        bvh = ObjectBVH(boxes)
+        
+        self.assertEqual(sorted(bvh.unbounded_objects), [6, 21])
+        self.assertEqual(sorted(bvh.objects), \
+            [i+1 for i in range(37) if boxes[i] is not None])
+    
+    def test_nodes_contain_children(self):
+        boxes = self.randomBoxes(50)
+        bvh = ObjectBVH(boxes)
+        
+        def node_box(i):
+            return bvh.bounds[2*i], bvh.bounds[2*i+1]
+        
+        for i in range(bvh.n_nodes):
+            bmin, bmax = node_box(i)
+            first, count = bvh.nodes[i]
+            if count > 0:
+                contents = [boxes[o-1] for o in bvh.objects[first:first+count]]
+            else:
+                contents = [node_box(first), node_box(first+1)]
+            for cmin, cmax in contents:
+                self.assertTrue(numpy.all(bmin <= cmin + 1e-6))
+                self.assertTrue(numpy.all(bmax >= cmax - 1e-6))
+        
+        self.assertTrue(bvh.depth <= 5)
+    
+    def test_only_unbounded(self):
+        bvh = ObjectBVH([None, None])
+        self.assertEqual(bvh.n_nodes, 0)
+        self.assertEqual(list(bvh.get_integer_data()), [1, 2, 0])
+
+class TestMeshBVH(unittest.TestCase):
+    
+    def setUp(self):
+        os.environ['CLRAY_CACHE_DIR'] = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        del os.environ['CLRAY_CACHE_DIR']
+    
+    def randomMesh(self, n):
+        centers = numpy.random.normal(size=(n,3))
+        # uneven density: half of the faces in a small cluster
+        centers[:n//2] *= 0.01
+        vertices = numpy.repeat(centers, 3, 0) + \
+            numpy.random.normal(scale=0.05, size=(3*n,3))
+        faces = numpy.arange(3*n).reshape((n,3))
+        return vertices, faces
+    
+    def test_leaves_and_bounds(self):
+        n = 500
+        vertices, faces = self.randomMesh(n)
+        
+        bvh = MeshBVH(TriangleMesh(vertices, faces), max_faces_per_leaf=3)
+        # (face, coordinate, vertex) like the (node, coordinate, min/max) bounds
+        triangles = numpy.transpose(bvh.triangle_mesh.vertices[faces], (0,2,1))
+        
+        leaf_faces = []
+        for i in range(bvh.n_nodes):
+            bmin, bmax = bvh.node_bounds[i,:,0], bvh.node_bounds[i,:,1]
+            first, count = bvh.nodes[i]
+            if count > 0:
+                self.assertTrue(count <= 3)
+                contents = triangles[bvh.face_list[first:first+count]]
+                leaf_faces.extend(bvh.face_list[first:first+count])
+            else:
+                contents = bvh.node_bounds[first:first+2]
+            self.assertTrue(numpy.all(bmin[numpy.newaxis,:,numpy.newaxis] <= contents))
+            self.assertTrue(numpy.all(bmax[numpy.newaxis,:,numpy.newaxis] >= contents))
+        
+        self.assertEqual(sorted(leaf_faces), range(n))
+    
+    def test_cached(self):
+        vertices, faces = self.randomMesh(100)
+        
+        bvh = MeshBVH(TriangleMesh(vertices, faces))
+        cached = MeshBVH(TriangleMesh(vertices, faces))
+        other = MeshBVH(TriangleMesh(vertices, faces), max_faces_per_leaf=1)
+        
+        self.assertEqual(len(os.listdir(os.path.join( \
+            os.environ['CLRAY_CACHE_DIR'], 'acceleration_structures'))), 2)
+        self.assertTrue(numpy.all(bvh.nodes == cached.nodes))
+        self.assertTrue(numpy.all(bvh.face_list == cached.face_list))
+        self.assertEqual(bvh.depth, cached.depth)
+        self.assertTrue(other.n_nodes > bvh.n_nodes)
+    
+    def test_instance(self):
+        vertices, faces = self.randomMesh(100)
+        
+        bvh = MeshBVH(TriangleMesh(vertices, faces, center=(1,0,0)))
+        copy = bvh.instance(position=(0,2,0), scaling=2.0)
+        
+        self.assertTrue(copy.instance_of is bvh)
+        self.assertTrue(copy.instance(position=(0,0,1)).instance_of is bvh)
+        self.assertTrue(copy.triangle_mesh.vertices is bvh.triangle_mesh.vertices)
+        self.assertEqual(copy.parameter_values(), bvh.parameter_values())
+        
+        p = numpy.array([1.0, 2.0, 3.0])
+        self.assertTrue(numpy.allclose(bvh.coordinates(p), p + (1,0,0)))
+        self.assertTrue(numpy.allclose(copy.coordinates(p), \
+            2*bvh.coordinates(p) + (0,2,0)))
+
+class TestMeshFormats(unittest.TestCase):
+    
+    # a square and a triangle
+    vertices = [[0,0,0], [1,0,0], [1,1,0], [0,1,0], [0,0,1]]
+    triangles = [[0,1,2], [0,2,3], [0,1,4]]
+    
+    def write(self, name, data):
+        filename = os.path.join(tempfile.mkdtemp(), name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+    
+    def assertMesh(self, vertices, faces):
+        self.assertEqual(numpy.asarray(vertices).tolist(), self.vertices)
+        self.assertEqual(numpy.asarray(faces).tolist(), self.triangles)
+    
+    def test_off(self):
+        self.assertMesh(*mesh_formats.read_off(self.write('m.off', '\n'.join([
+            'OFF', '5 2 0', '0 0 0', '1 0 0', '1 1 0', '0 1 0', '0 0 1',
+            # extra numbers (a color) after the vertex indices
+            '4 0 1 2 3 255 0 0', '3 0 1 4']))))
+    
+    def test_ascii_ply(self):
+        self.assertMesh(*mesh_formats.read_ply(self.write('m.ply', '\n'.join([
+            'ply', 'format ascii 1.0', 'element vertex 5',
+            'property float x', 'property float y', 'property float z',
+            'property float confidence', 'element face 2',
+            'property list uchar int vertex_indices', 'end_header',
+            '0 0 0 1', '1 0 0 1', '1 1 0 1', '0 1 0 1', '0 0 1 1',
+            '4 0 1 2 3', '3 0 1 4', '']))))
+    
+    def test_binary_ply(self):
+        header = '\n'.join(['ply', 'format binary_little_endian 1.0',
+            'element vertex 5', 'property float x', 'property float y',
+            'property float z', 'element face %d',
+            'property list uchar int vertex_indices', 'end_header', ''])
+        vertices = numpy.array(self.vertices, dtype='<f4').tobytes()
+        
+        def polygon(indices):
+            return numpy.array([len(indices)], dtype='u1').tobytes() + \
+                numpy.array(indices, dtype='<i4').tobytes()
+        
+        # same number of vertices in every polygon
+        self.assertMesh(*mesh_formats.read_ply(self.write('m.ply', \
+            (header % 3).encode('ascii') + vertices + \
+            b''.join([polygon(t) for t in self.triangles]))))
+        
+        # mixed polygons
+        self.assertMesh(*mesh_formats.read_ply(self.write('m.ply', \
+            (header % 2).encode('ascii') + vertices + \
+            polygon([0,1,2,3]) + polygon([0,1,4]))))
+    
+    def test_binary_stl(self):
+        triangles = numpy.zeros(2, dtype=[('normal', '<f4', (3,)), \
+            ('vertices', '<f4', (3,3)), ('attributes', '<u2')])
+        triangles['vertices'] = numpy.array(self.vertices)[numpy.array(self.triangles[:2])]
+        data = b' '*80 + numpy.array([2], dtype='<u4').tobytes() + triangles.tobytes()
+        
+        vertices, faces = mesh_formats.read_stl(self.write('m.stl', data))
+        self.assertEqual(faces.tolist(), [[0,1,2], [3,4,5]])
+        self.assertEqual(vertices[faces].tolist(), \
+            numpy.array(self.vertices)[numpy.array(self.triangles[:2])].tolist())
+    
+    def test_obj_and_cache(self):
+        filename = self.write('m.obj', '\n'.join([
+            '# comment', 'v 0 0 0', 'v\t1 0 0', 'v  1 1 0', ' v 0 1 0',
+            'vn 0 0 1', 'f\t1//1 2//1 3//1 4//1', 'v 0 0 1', 'f -5/1 -4/1 -1/1']))
+        self.assertMesh(*mesh_formats.read_obj(filename))
+        
+        self.assertMesh(*mesh_formats.read_mesh(filename))
+        self.assertTrue(os.path.exists(filename + '.vertices.npy'))
+        vertices, faces = mesh_formats.read_mesh(filename)
+        self.assertTrue(isinstance(vertices, numpy.memmap))
+        self.assertMesh(vertices, faces)
+        
+        # copy-on-write: the cache is not modified
+        vertices[0,0] = 5
+        self.assertMesh(*mesh_formats.read_mesh(filename))
+    
+    def test_remove_duplicate_faces(self):
+        faces = [[0,1,2], [2,0,3], [2,1,0], [0,2,3], [0,1,4]]
+        self.assertEqual(mesh_formats.remove_duplicate_faces(faces).tolist(), \
+            [[0,1,2], [2,0,3], [0,1,4]])
+    
+    def test_weld_by_distance(self):
+        vertices = numpy.array([
+            # on both sides of a grid cell boundary
+            [0.0999, 0, 0], [0.1001, 0, 0],
+            # in the same grid cell, but not closer than the tolerance
+            [0.1001, 0.1001, 0.1001], [0.1099, 0.1099, 0.1099],
+            # a chain of close vertices
+            [1, 1, 1], [1.008, 1, 1], [1.016, 1, 1]])
+        faces = numpy.array([[0,2,4], [1,3,5], [0,1,6]])
+        
+        welded, faces, kept = mesh_formats.weld_vertices(vertices, faces, 0.01)
+        self.assertEqual(kept.tolist(), [0, 2, 3, 4])
+        self.assertEqual(faces.tolist(), [[0,1,3], [0,2,3]])
+    
+    def test_weld_and_smooth_normals(self):
+        # separate vertices for each triangle, like in STL
+        triangles = numpy.array(self.vertices, dtype=float)[numpy.array(self.triangles)]
+        triangles[1,0,:] += 1e-6
+        soup = numpy.arange(9).reshape((3,3))
+        
+        vertices, faces, kept = mesh_formats.weld_vertices( \
+            triangles.reshape((-1,3)), soup, 1e-4)
+        self.assertEqual(vertices.tolist(), self.vertices)
+        self.assertEqual(faces.tolist(), self.triangles)
+        
+        mesh = TriangleMesh(triangles.reshape((-1,3)), soup, weld_tolerance=1e-4, \
+            shading='smooth', auto_smooth_normals=True)
+        self.assertEqual(mesh.n_vertices, 5)
+        # the average of the normals of the triangles around each vertex
+        expected = [[0,-1,2], [0,-1,1], [0,0,1], [0,0,1], [0,-1,0]]
+        expected /= numpy.sqrt(numpy.sum(numpy.square(expected), 1))[:,numpy.newaxis]
+        self.assertTrue(numpy.allclose(mesh.normals, expected, atol=1e-6))
+
+class TestCheckpoint(unittest.TestCase):
+    
+    def test_save_and_load(self):
+        image = numpy.random.normal(size=(4,5,3))
+        filename = os.path.join(tempfile.mkdtemp(), 'test.checkpoint.npz')
+        Checkpoint(image, 20, 1234, 'abc').save(filename)
+        
+        x = numpy.random.random()
+        c = Checkpoint.load(filename)
+        self.assertTrue(numpy.all(c.image == image))
+        self.assertEqual((c.n_samples, c.rng_seed, c.scene_hash), (20, 1234, 'abc'))
+        
+        # the random state is that of the save
+        numpy.random.set_state(c.np_rng_state)
+        self.assertEqual(numpy.random.random(), x)
+        
+        os.remove(filename)
+
+class TestBackgroundWriter(unittest.TestCase):
+    
+    def test_coalesces_snapshots(self):
+        import time
+        written = []
+        
+        def write(x):
+            time.sleep(0.01)
+            written.append(x)
+        
+        writer = BackgroundWriter(write)
+        for i in range(50):
+            writer.submit(i)
+        writer.close()
+        
+        self.assertEqual(written[-1], 49)
+        self.assertTrue(len(written) < 50)
+        self.assertEqual(written, sorted(written))
+
+class TestRenderFarm(unittest.TestCase):
+    
+    def setUp(self):
+        self.coordinator = Coordinator(('127.0.0.1', 0), 'test key', 4)
+        self.coordinator.start()
+    
+    def connect(self):
+        conn = Client(self.coordinator.listener.address, authkey='test key')
+        self.assertEqual(conn.recv()[0], 'seed')
+        return conn
+    
+    def exchange(self, conn, msg):
+        conn.send(msg)
+        self.assertTrue(conn.poll(5))
+        return conn.recv()
+    
+    def check_rendered_again(self, fail):
+        a, b = self.connect(), self.connect()
+        
+        self.assertEqual(self.exchange(b, ('request', 2)), ('render', 0, 2))
+        self.assertEqual(self.exchange(a, ('request', 2)), ('render', 2, 2))
+        a.send(('result', 2, 2, numpy.ones((2,3))))
+        
+        # a has finished and waits while b fails mid-batch
+        a.send(('request', 2))
+        self.assertFalse(a.poll(0.2))
+        fail(b)
+        
+        self.assertTrue(a.poll(5))
+        self.assertEqual(a.recv(), ('render', 0, 2))
+        a.send(('result', 0, 2, numpy.ones((2,3))))
+        self.assertEqual(self.exchange(a, ('request', 2)), ('done', ))
+        
+        self.assertEqual(self.coordinator.wait_for_samples(4, 5), 4)
+        image, n_samples = self.coordinator.get_image()
+        self.assertEqual(n_samples, 4)
+        self.assertTrue(numpy.all(image == 2))
+    
+    def test_dropped_worker(self):
+        self.check_rendered_again(lambda conn: conn.close())
+    
+    def test_malformed_result(self):
+        self.check_rendered_again(lambda conn: \
+            conn.send(('result', 0, 1, 'not an image')))
+    
+    def test_stalled_handshake(self):
+        self.coordinator.HANDSHAKE_TIMEOUT = 0.5
+        # connects without authenticating
+        stalled = Client(self.coordinator.listener.address)
+        
+        conn = self.connect()
+        self.assertEqual(self.exchange(conn, ('request', 4)), ('render', 0, 4))
+        
+        # the challenge, and then the connection is closed
+        stalled.recv_bytes()
+        self.assertTrue(stalled.poll(5))
+        self.assertRaises(EOFError, stalled.recv_bytes)
+        stalled.close()
+
+class TestFileCache(unittest.TestCase):
+    
+    def test_put_get_and_evict(self):
+        os.environ['CLRAY_CACHE_DIR'] = tempfile.mkdtemp()
+        cache = FileCache('test', max_size=25)
+        
+        keys = [FileCache.key('entry', i) for i in range(3)]
+        self.assertEqual(len(set(keys)), 3)
+        self.assertEqual(cache.get(keys[0]), None)
+        
+        cache.put(keys[0], b'0'*10)
+        cache.put(keys[1], b'1'*10)
+        # make entry 1 the least recently used
+        os.utime(cache._path(keys[1]), (0, 0))
+        cache.put(keys[2], b'2'*10)
+        
+        self.assertEqual(cache.get(keys[0]), b'0'*10)
+        self.assertEqual(cache.get(keys[1]), None)
+        self.assertEqual(cache.get(keys[2]), b'2'*10)
+        
+        del os.environ['CLRAY_CACHE_DIR']
+    
+    def test_temporary_files(self):
+        os.environ['CLRAY_CACHE_DIR'] = tempfile.mkdtemp()
+        cache = FileCache('test', max_size=25)
+        
+        keys = [FileCache.key('entry', i) for i in range(2)]
+        cache.put(keys[0], b'0'*10)
+        
+        # left by a failed writer and by one still writing
+        orphan = os.path.join(cache.directory, 'orphan.tmp')
+        live = os.path.join(cache.directory, 'live.tmp')
+        for path in (orphan, live):
+            with open(path, 'wb') as f:
+                f.write(b't'*10)
+        os.utime(orphan, (0, 0))
+        
+        cache.put(keys[1], b'1'*10)
+        
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(live))
+        # the live file counts towards the size limit
+        self.assertEqual(cache.get(keys[0]), None)
+        self.assertEqual(cache.get(keys[1]), b'1'*10)
+        
+        del os.environ['CLRAY_CACHE_DIR']
+
+class StubQueue:
+    """Records the flushes and checks the waits of a command queue"""
+    
+    def __init__(self, log):
+        self.log = log
+        self.n_commands = 0
+        self.n_flushed = 0
+    
+    def enqueue(self, name, wait_for):
+        for event in (wait_for or []):
+            if event.queue is not self:
+                # the spec requires this, otherwise the wait may never end
+                assert event.index < event.queue.n_flushed, \
+                    '%s waits for an unflushed %s' % (name, event.name)
+        self.log.append(name)
+        self.n_commands += 1
+        return StubEvent(self, name, self.n_commands - 1)
+    
+    def flush(self):
+        self.n_flushed = self.n_commands
+    
+    def finish(self):
+        self.enqueue('finish', [])
+        self.flush()
+
+class StubEvent:
+    def __init__(self, queue, name, index):
+        self.queue = queue
+        self.name = name
+        self.index = index
+        self.profile = StubEvent.Profile()
+    
+    class Profile:
+        start = 0
+        end = 0
+    
+    def wait(self):
+        assert self.index < self.queue.n_flushed
+
+@unittest.skipIf(accelerator is None, 'PyOpenCL not available')
+class TestAsynchronousAccelerator(unittest.TestCase):
+    
+    class StubCL:
+        class Buffer:
+            pass
+        
+        @staticmethod
+        def enqueue_copy(queue, dest, src, device_offset=0, \
+                is_blocking=True, wait_for=None):
+            return queue.enqueue('copy', wait_for)
+    
+    class StubProgram:
+        def __getattr__(self, kernel_name):
+            def kernel(queue, ndrange_size, work_group_size, *args, **kwargs):
+                return queue.enqueue(kernel_name, kwargs.get('wait_for'))
+            return kernel
+    
+    class StubAccelerator(accelerator.Accelerator if accelerator else object):
+        def __init__(self, log):
+            self.queue = StubQueue(log)
+            self.transfer_queue = StubQueue(log)
+            self.prog = TestAsynchronousAccelerator.StubProgram()
+            self._cl_arrays = []
+            self.asynchronous = True
+            self._unresolved_events = []
+            self._last_buffer_use = {}
+            self._pending_buffer_writes = {}
+            self._upload_host_buffers = []
+            self.profiling_info = {}
+    
+    def setUp(self):
+        self.cl = accelerator.cl
+        accelerator.cl = TestAsynchronousAccelerator.StubCL
+    
+    def tearDown(self):
+        accelerator.cl = self.cl
+    
+    def test_queues_flushed_before_waits(self):
+        log = []
+        acc = TestAsynchronousAccelerator.StubAccelerator(log)
+        buf = TestAsynchronousAccelerator.StubCL.Buffer()
+        
+        for i in range(3):
+            # the copy waits for the previous kernel and vice versa
+            acc.enqueue_copy(buf, numpy.zeros(4))
+            acc.call('kernel', 4, (buf,))
+        acc.finish()
+        
+        self.assertEqual(log, ['copy', 'kernel']*3 + ['finish']*2)
+        self.assertEqual(acc.profiling_info['kernel']['n'], 3)
+
+@unittest.skipIf(not code_generation, 'Jinja2 or PyOpenCL not available')
+class TestCodeGeneration(unittest.TestCase):
+    
+    def test_parameterized_tracers(self):
+        
+        objects = [Scene.Object(QuaternionJuliaSet2(c, 8), 'white') \
+            for c in [(-0.2,-0.4,-0.4,-0.4), (0.3,0.5,0.0,0.0)]]
+        for obj in objects:
+            # set by the Renderer: no parameters, just the affine transform
+            obj.tracer.local_param_offsets = range(4)
+        
+        kernels, functions = collect_tracer_kernels(objects, template_env())
+        code = '\n'.join(functions)
+        
+        names = [obj.tracer.tracer_function_name for obj in objects]
+        self.assertNotEqual(names[0], names[1])
+        for obj in objects:
+            self.assertTrue(obj.tracer.tracer_function_name in code)
+            self.assertTrue(obj.tracer.c_as_float4 in code)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,5 @@
 import numpy
+import copy
 from transformations import Affine, rotation_matrix
 
 class Tracer(object):
@@ -11,10 +12,13 @@ class Tracer(object):
     """
     
     def __init__(self, position=(0,0,0), **affine_kwargs):
-        # setting this to, e.g., id(obj), causes a tracer function to be
-        # generated for each instance, instead of one per Tracer (sub)class
+        # setting this to, e.g., a running number, causes a tracer function
+        # to be generated for each instance, instead of one per Tracer
+        # (sub)class. It must be unique if the code depends on the instance
         self.unique_tracer_id = ""
         self.coordinates = Affine(translation=position, **affine_kwargs)
+        # the tracer whose data this one shares, see instance
+        self.instance_of = None
     
     def _function_name_prefix(self):
         return self.__class__.__name__+self.unique_tracer_id
@@ -46,9 +50,9 @@ class Tracer(object):
         return self.__class__.__name__
         
     def _make_code(self, macro, template_env):
-        s = "{% import '" + self.template_file_name() + "' as a %}" + \
-            ("{{ a.%s }}\n" % macro)
-        return template_env.from_string(s).render(obj=self)
+        # the template is compiled only once per template_env
+        module = template_env.get_template(self.template_file_name()).module
+        return unicode(getattr(module, macro)(self))
     
     def make_functions(self, template_env):
         """
@@ -58,9 +62,9 @@ class Tracer(object):
         
         return { \
             self.tracer_function_name : \
-                self._make_code('tracer_function(obj)', template_env),
+                self._make_code('tracer_function', template_env),
             self.normal_function_name : \
-                self._make_code('normal_function(obj)', template_env)
+                self._make_code('normal_function', template_env)
         }
 
     def make_kernels(self, template_env):
@@ -71,11 +75,11 @@ class Tracer(object):
         
         return { \
             self.tracer_kernel_name : \
-                self._make_code('tracer_kernel(obj)', template_env),
+                self._make_code('tracer_kernel', template_env),
             self.shadow_kernel_name : \
-                self._make_code('shadow_kernel(obj)', template_env),
+                self._make_code('shadow_kernel', template_env),
             self.normal_kernel_name : \
-                self._make_code('normal_kernel(obj)', template_env)
+                self._make_code('normal_kernel', template_env)
         }
         
     def parameter_declarations(self):
@@ -110,6 +114,28 @@ class Tracer(object):
     def tracer_coordinate_system(self):
         return Affine.identity()
     
+    def get_bounding_box(self):
+        """
+        Axis-aligned bounding box of the object in the tracer coordinate
+        system as a list of [min, max] pairs, one per coordinate, or None
+        if the object is unbounded
+        """
+        return None
+    
+    def global_bounding_box(self):
+        """
+        Axis-aligned bounding box in the global coordinate system as
+        a pair of 3-vectors (min, max) or None if the object is unbounded
+        """
+        box = self.get_bounding_box()
+        if box is None: return None
+        
+        transform = self.global_to_tracer_coordinate_transform()
+        corners = numpy.array([transform((x, y, z)) \
+            for x in box[0] for y in box[1] for z in box[2]])
+        
+        return (numpy.min(corners, 0), numpy.max(corners, 0))
+    
     def global_to_tracer_coordinate_transform(self):
         return self.coordinates(self.tracer_coordinate_system())
     
@@ -149,6 +175,22 @@ class Tracer(object):
             translation=value
         )
 
+    def instance(self, position=(0,0,0), **affine_kwargs):
+        """
+        A copy of this tracer moved by the given affine transformation
+        (same arguments as in the constructor). The copies share the
+        tracer code and data (e.g., the vertices and the octree of a mesh)
+        and only differ in their coordinate systems
+        """
+        tracer = self._shallow_copy()
+        tracer.instance_of = self.instance_of or self
+        tracer.coordinates = Affine(translation=position, \
+            **affine_kwargs)(self.coordinates)
+        return tracer
+    
+    def _shallow_copy(self):
+        return copy.copy(self)
+
 def cl_parameter_string(params):
     if len(params) == 0: return ''
     else: return ', '.join([''] + params)